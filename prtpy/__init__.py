@@ -5,7 +5,7 @@ __version__ = (HERE / "VERSION").read_text().strip()
 
 import prtpy.outputtypes as out
 import prtpy.objectives as obj
-from prtpy.binners import BinsArray, Binner, BinnerKeepingContents, BinnerKeepingSums, printbins
+from prtpy.binners import BinsArray, Binner, BinnerKeepingContents, BinnerKeepingSums, BinnerKeepingAssignment, BinnerKeepingCounts, BinnerKeepingPersistentContents, BatchBinner, printbins
 
 from prtpy.packing.adaptors import pack, pack_random_items
 from prtpy.partitioning.adaptors import partition, partition_random_items, compare_algorithms, compare_algorithms_on_random_items
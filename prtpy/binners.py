@@ -13,11 +13,13 @@ Since:  2022-07
 
 from abc import ABC, abstractmethod
 
-import numpy as np, itertools
-from typing import Any, Callable, List, Tuple, Iterator
+import numpy as np, itertools, heapq, bisect, weakref
+from typing import Any, Callable, List, Tuple, Iterator, Hashable
 
 BinsArray = Any
 
+MAX_EXACT_INT64_SUM = 2**62   # If the total absolute value of the items is below this bound, no sum or difference of sums overflows int64.
+
 class Binner(ABC):
     """
     An abstract bins-array manager.
@@ -28,6 +30,9 @@ class Binner(ABC):
     """
     def __init__(self, valueof: Callable = lambda x:x):
         self.valueof = valueof
+        # Maps id(bins) to a pair (weak reference to bins, list of the (item, bin_index) pairs pushed into bins and not yet undone).
+        # The weak reference removes the entry when the bins-array is garbage-collected, before its id can be reused.
+        self.trails = {}
 
     @abstractmethod
     def new_bins(self, numbins:int)->BinsArray:
@@ -76,6 +81,55 @@ class Binner(ABC):
         """
         return bins
 
+    @abstractmethod
+    def remove_item_from_bin(self, bins:BinsArray, bin_index: int, item_index: int)->BinsArray:
+        """
+        Remove the item with the given index from the given bin in the given array.
+        Return the bins after the removal.
+        """
+        return bins
+
+    @abstractmethod
+    def remove_last_item_from_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        Remove the given item, which was the last item added to the given bin, from the given bin.
+        Return the bins after the removal.
+        """
+        return bins
+
+    def push_item(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        Add the given item to the given bin in-place, and record the change in the trail of the bins-array,
+        so that it can be reverted later by `undo`.
+        This lets depth-first algorithms mutate a single bins-array, instead of copying it for every child.
+        NOTE: bins are not re-sorted, so the bin indices remain valid until the change is undone.
+        """
+        self.add_item_to_bin(bins, item, bin_index)
+        self._trail(bins).append((item, bin_index))
+        return bins
+
+    def undo(self, bins:BinsArray)->BinsArray:
+        """
+        Revert the latest change made to the given bins-array by `push_item`.
+        """
+        item, bin_index = self._trail(bins).pop()
+        return self.remove_last_item_from_bin(bins, item, bin_index)
+
+    def clear_trail(self, bins:BinsArray):
+        """
+        Forget all changes recorded for the given bins-array (without reverting them).
+        """
+        self.trails.pop(id(bins), None)
+
+    def _trail(self, bins:BinsArray)->list:
+        """
+        The list of changes recorded for the given bins-array; created on first use.
+        """
+        entry = self.trails.get(id(bins))
+        if entry is None or entry[0]() is not bins:
+            key, trails = id(bins), self.trails
+            entry = self.trails[key] = (weakref.ref(bins, lambda _: trails.pop(key, None)), [])
+        return entry[1]
 
     @abstractmethod
     def sort_by_ascending_sum(self, bins:BinsArray):
@@ -85,6 +139,16 @@ class Binner(ABC):
         pass
         # return bins
 
+    def add_item_and_resort(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        Add the given item to the given bin of a bins-array that is sorted by ascending sum, and keep the bins-array sorted.
+        Return the bins after the change.
+        The default implementation re-sorts all bins; subclasses move only the changed bin.
+        """
+        self.add_item_to_bin(bins, item, bin_index)
+        self.sort_by_ascending_sum(bins)
+        return bins
+
     @abstractmethod
     def numitems(self, bins: BinsArray, bin_index:int) -> float:
         """
@@ -106,6 +170,20 @@ class Binner(ABC):
         """
         return None
 
+    def state_key(self, bins: BinsArray, ignore_order: bool=False) -> Hashable:
+        """
+        Return a hashable key of the sums of the given bins-array, for keeping sets of seen states.
+        If ignore_order is True, bins-arrays with the same sums in a different order have the same key.
+        """
+        sums = self.sums(bins)
+        return tuple(sorted(sums)) if ignore_order else tuple(sums)
+
+    def sums_from_key(self, key: Hashable) -> Tuple[float]:
+        """
+        Return the sums encoded in the given key (the inverse of state_key).
+        """
+        return key
+
     @abstractmethod
     def combine_bins(self, bins1:BinsArray, ibin1:int, bins2:BinsArray, ibin2:int):
         """
@@ -115,10 +193,11 @@ class Binner(ABC):
         pass
 
     @abstractmethod
-    def all_combinations(self, bins1: BinsArray, bins2: BinsArray)->Iterator[BinsArray]:
+    def all_combinations(self, bins1: BinsArray, bins2: BinsArray, order_by_spread:bool=False)->Iterator[BinsArray]:
         '''
         generate all the possible combinations of bins between two object bins
-        NOTE: duplicate combinations are not returned.
+        NOTE: duplicate combinations are not returned. Bins with equal sums are considered interchangeable.
+        If order_by_spread is True, the combinations are generated lazily, by ascending difference between the largest and smallest sum.
         '''
         pass
 
@@ -176,17 +255,102 @@ class BinnerKeepingSums(Binner):
     >>> printbins(binner.remove_bins(bins, 1))
     Bin #0: sum=0.0
     Bin #1: sum=3.0
+
+    Changes made by push_item can be reverted by undo:
+    >>> printbins(binner.push_item(bins, item="d", bin_index=0))
+    Bin #0: sum=5.0
+    Bin #1: sum=3.0
+    Bin #2: sum=9.0
+    >>> printbins(binner.undo(bins))
+    Bin #0: sum=0.0
+    Bin #1: sum=3.0
+    Bin #2: sum=9.0
     """
 
-    def __init__(self, valueof: Callable = lambda x:x):
+    def __init__(self, valueof: Callable = lambda x:x, dtype=float):
         super().__init__(valueof)
+        self.dtype = dtype   # The dtype of the sums. Can be changed to an exact integer dtype by use_exact_sums.
 
     BinsArray = np.ndarray    # Here, the bins-array is simply an array of the sums.
 
+    def use_exact_sums(self, items: List[Any])->str:
+        """
+        Choose the dtype of the sums according to the values of the given items, and return the name of the chosen mode:
+         * "int64"  - if all values are integers, and the sum of their absolute values is small enough, so that no sum or difference of sums can overflow.
+         * "bigint" - if all values are integers, but their sums might overflow int64. Then the sums are kept as Python ints (in arrays of dtype object).
+         * "float"  - otherwise.
+        Should be called once, before any bins-array is created.
+
+        >>> binner = BinnerKeepingSums()
+        >>> binner.use_exact_sums([1, 2, np.int64(3)])
+        'int64'
+        >>> binner.use_exact_sums([1, 2.5, 3])
+        'float'
+        >>> binner.use_exact_sums([2**61, 2**61, 2**61])
+        'bigint'
+        >>> bins = binner.new_bins(2)
+        >>> for item in [2**61, 2**61, 2**61, 1]: _=binner.add_item_to_bin(bins, item, 0)
+        >>> printbins(bins)
+        Bin #0: sum=6917529027641081857
+        Bin #1: sum=0
+        """
+        values = [self.valueof(item) for item in items]
+        if not all(isinstance(value, (int, np.integer)) for value in values):
+            self.dtype = float
+        elif sum(abs(int(value)) for value in values) < MAX_EXACT_INT64_SUM:
+            self.dtype = np.int64
+        else:
+            self.dtype = object
+            # Convert numpy integers to Python ints, so that adding them to the sums cannot overflow.
+            valueof = self.valueof
+            self.valueof = lambda item: int(valueof(item))
+        return self.numeric_mode
+
+    @property
+    def numeric_mode(self)->str:
+        """
+        The name of the current dtype of the sums: "float", "int64" or "bigint".
+        """
+        if self.dtype is object:
+            return "bigint"
+        elif self.dtype is np.int64:
+            return "int64"
+        else:
+            return "float"
+
     def new_bins(self, numbins)->BinsArray:
-        bins = np.zeros(numbins)
+        bins = np.zeros(numbins, dtype=self.dtype)
         return bins
 
+    def state_key(self, bins: BinsArray, ignore_order: bool=False) -> Hashable:
+        """
+        The key is the raw bytes of the sums: 8 bytes per bin, instead of a tuple of boxed numpy scalars.
+        In bigint mode, the sums are Python objects, so the key is a tuple.
+
+        >>> binner = BinnerKeepingSums()
+        >>> bins = binner.add_item_to_bin(binner.new_bins(3), 5, 0)
+        >>> key = binner.state_key(bins)
+        >>> len(key)
+        24
+        >>> binner.sums_from_key(key)
+        array([5., 0., 0.])
+        >>> binner.sums_from_key(binner.state_key(bins, ignore_order=True))
+        array([0., 0., 5.])
+        >>> binner.state_key(bins, ignore_order=True) == binner.state_key(np.array([0., 5., 0.]), ignore_order=True)
+        True
+        """
+        sums = self.sums(bins)
+        if self.dtype is object:
+            return super().state_key(bins, ignore_order)
+        if ignore_order:
+            sums = np.sort(sums)
+        return np.asarray(sums, dtype=self.dtype).tobytes()
+
+    def sums_from_key(self, key: Hashable) -> np.ndarray:
+        if self.dtype is object:
+            return np.array(key, dtype=object)
+        return np.frombuffer(key, dtype=self.dtype).copy()
+
     def copy_bins(self, bins: BinsArray)->BinsArray:
         return np.array(bins)
 
@@ -209,6 +373,13 @@ class BinnerKeepingSums(Binner):
         bins[bin_index] += self.valueof(item)
         return bins
 
+    def remove_item_from_bin(self, bins: BinsArray, bin_index: int, item_index: int)->BinsArray:
+        raise NotImplementedError("Bins keeping sums do not keep track of the items, so they cannot remove an item by index.")
+
+    def remove_last_item_from_bin(self, bins: BinsArray, item: Any, bin_index: int)->BinsArray:
+        bins[bin_index] -= self.valueof(item)
+        return bins
+
     def numitems(self, bins: BinsArray, bin_index:int) -> Tuple[float]:
         raise NotImplementedError("Bins keeping sums do not keep track of the number of items.")
 
@@ -224,10 +395,25 @@ class BinnerKeepingSums(Binner):
     def sort_by_ascending_sum(self, bins:BinsArray)->BinsArray:
         bins.sort()
 
+    def add_item_and_resort(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        >>> binner = BinnerKeepingSums()
+        >>> bins = np.array([1., 3., 5., 7.])
+        >>> binner.add_item_and_resort(bins, 5, 0)
+        array([3., 5., 6., 7.])
+        >>> binner.add_item_and_resort(bins, -4, 3)
+        array([3., 3., 5., 6.])
+        """
+        new_sum = bins[bin_index] + self.valueof(item)
+        new_index = _resorted_index(bins, bin_index, new_sum)
+        _move_bin(bins, bin_index, new_index)
+        bins[new_index] = new_sum
+        return bins
+
     def combine_bins(self, bins1:BinsArray, ibin1:int, bins2:BinsArray, ibin2:int):
         bins1[ibin1] += bins2[ibin2]
 
-    def all_combinations(self, bins1: BinsArray, bins2: BinsArray)->Iterator[BinsArray]:
+    def all_combinations(self, bins1: BinsArray, bins2: BinsArray, order_by_spread:bool=False)->Iterator[BinsArray]:
         """
         >>> binner = BinnerKeepingSums()
         >>> b1 = [1,2,3]
@@ -247,11 +433,22 @@ class BinnerKeepingSums(Binner):
         [24, 350, 601]
         [51, 304, 620]
         [70, 304, 601]
+        >>> for perm in binner.all_combinations(b1, b2, order_by_spread=True): perm
+        [70, 304, 601]
+        [51, 304, 620]
+        [24, 350, 601]
+        [5, 350, 620]
+        [24, 51, 900]
+        [5, 70, 900]
+
+        Bins with equal sums are interchangeable, so there are only 2 combinations here (rather than 4!=24 permutations):
+        >>> for perm in binner.all_combinations([0,0,0,5], [0,0,0,7]): perm
+        [0, 0, 0, 12]
+        [0, 0, 5, 7]
         """
         yielded = set()   # prevent duplicates
         numbins = self.numbins(bins1)
-        for perm in itertools.permutations(range(numbins)):
-            # print("perm=",perm)
+        for perm in distinct_matchings(bins1, bins2, order_by_spread):
             new_sums = [bins1[perm[i]] + bins2[i] for i in range(numbins)]
             new_sums.sort()   # to avoid duplicates
             new_sums_tuple = tuple(new_sums)
@@ -260,6 +457,199 @@ class BinnerKeepingSums(Binner):
                 yield new_sums
 
 
+class BatchBinner:
+    """
+    A binner that manages a whole frontier of bins-arrays keeping sums, such as a layer of a dynamic program.
+    The frontier is a single 2-D array, with one row per bins-array (= state) and one column per bin,
+    so that an operation on all states is a single numpy call rather than a python loop over the states.
+
+    >>> binner = BatchBinner()
+    >>> frontier = binner.new_bins(3)
+    >>> frontier
+    array([[0., 0., 0.]])
+    >>> frontier = binner.add_item_to_all_bins(frontier, 5)
+    >>> frontier
+    array([[5., 0., 0.],
+           [0., 5., 0.],
+           [0., 0., 5.]])
+    >>> binner.sort_by_ascending_sum(frontier)
+    >>> binner.remove_duplicates(frontier)
+    array([[0., 0., 5.]])
+
+    The item is added to each bin of each state; the child of state i with the item in bin j is in row i*numbins+j:
+    >>> frontier = binner.add_item_to_all_bins(np.array([[0., 0., 5.], [1., 2., 3.]]), 4)
+    >>> frontier
+    array([[4., 0., 5.],
+           [0., 4., 5.],
+           [0., 0., 9.],
+           [5., 2., 3.],
+           [1., 6., 3.],
+           [1., 2., 7.]])
+    >>> binner.numstates(frontier), binner.numbins(frontier)
+    (6, 3)
+
+    expand combines the three steps:
+    >>> frontier = binner.new_bins(2)
+    >>> for item in [3, 3, 2]: frontier = binner.expand(frontier, item)
+    >>> frontier
+    array([[0., 8.],
+           [2., 6.],
+           [3., 5.]])
+    >>> binner.sums(frontier, 1)
+    array([2., 6.])
+    """
+
+    def __init__(self, valueof: Callable = lambda x:x, dtype=float):
+        self.valueof = valueof
+        self.dtype = dtype
+
+    BinsArray = np.ndarray    # Here, the bins-array is a 2-D array of sums, with one row per state.
+
+    def new_bins(self, numbins:int)->BinsArray:
+        """
+        Return a frontier with a single state, in which all bins are empty.
+        """
+        return np.zeros((1, numbins), dtype=self.dtype)
+
+    def copy_bins(self, bins:BinsArray)->BinsArray:
+        return np.array(bins)
+
+    def numstates(self, bins:BinsArray)->int:
+        return bins.shape[0]
+
+    def numbins(self, bins:BinsArray)->int:
+        return bins.shape[1]
+
+    def sums(self, bins:BinsArray, state_index:int)->np.ndarray:
+        """
+        Return the sums of the given state.
+        """
+        return bins[state_index]
+
+    def add_item_to_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        Add the given item to the given bin in all states (in-place).
+        """
+        bins[:, bin_index] += self.valueof(item)
+        return bins
+
+    def add_item_to_all_bins(self, bins:BinsArray, item: Any)->BinsArray:
+        """
+        Return a new frontier, containing all the states obtained by adding the given item to a single bin of a state in the given frontier.
+        The child of state i, in which the item is added to bin j, is in row i*numbins+j.
+        """
+        numstates, numbins = bins.shape
+        children = np.repeat(bins, numbins, axis=0)
+        children[np.arange(numstates*numbins), np.tile(np.arange(numbins), numstates)] += self.valueof(item)
+        return children
+
+    def sort_by_ascending_sum(self, bins:BinsArray):
+        """
+        Sort the bins of each state by ascending sum (in-place).
+        """
+        bins.sort(axis=1)
+
+    def remove_duplicates(self, bins:BinsArray)->BinsArray:
+        """
+        Return a new frontier with the distinct states of the given frontier, in lexicographic order.
+        Should be called after sort_by_ascending_sum, so that states that differ only in the order of their bins are considered duplicates.
+
+        Non-negative integer states whose sums fit in a single int64 key (in base max+1) are deduplicated by sorting the keys;
+        other states are sorted lexicographically by np.lexsort, and a row is kept if it differs from the previous one.
+        Both are much faster than np.unique(bins, axis=0), which sorts the rows as structured records.
+
+        >>> binner = BatchBinner(dtype=np.int64)
+        >>> binner.remove_duplicates(np.array([[1, 5], [0, 6], [1, 5], [0, 7]]))
+        array([[0, 6],
+               [0, 7],
+               [1, 5]])
+        >>> binner.remove_duplicates(np.array([[1.5, 5.], [0., 6.], [1.5, 5.]]))
+        array([[0. , 6. ],
+               [1.5, 5. ]])
+        """
+        return bins[self.distinct_indices(bins)]
+
+    def distinct_indices(self, bins:BinsArray)->np.ndarray:
+        """
+        Return the indices of the first occurrences of the distinct states of the given frontier, in lexicographic order of the states.
+        This lets the caller keep other per-state arrays (e.g. the parent of each state) aligned with the deduplicated frontier.
+
+        >>> binner = BatchBinner(dtype=np.int64)
+        >>> binner.distinct_indices(np.array([[1, 5], [0, 6], [1, 5], [0, 7]]))
+        array([1, 3, 0])
+        >>> binner.distinct_indices(np.array([[1.5, 5.], [0., 6.], [1.5, 5.]]))
+        array([1, 0])
+        """
+        if len(bins) <= 1:
+            return np.arange(len(bins))
+        if np.issubdtype(bins.dtype, np.integer) and bins.min() >= 0:
+            radix = int(bins.max()) + 1
+            if radix ** bins.shape[1] <= np.iinfo(np.int64).max:
+                keys = np.zeros(len(bins), dtype=np.int64)
+                for column in bins.T:
+                    keys = keys * radix + column
+                _, indices = np.unique(keys, return_index=True)
+                return indices
+        order = np.lexsort(bins.T[::-1])   # lexsort is stable, so the first row of each group of equal rows is its first occurrence.
+        sorted_bins = bins[order]
+        is_new_row = np.empty(len(sorted_bins), dtype=bool)
+        is_new_row[0] = True
+        np.any(sorted_bins[1:] != sorted_bins[:-1], axis=1, out=is_new_row[1:])
+        return order[is_new_row]
+
+    def expand(self, bins:BinsArray, item: Any)->BinsArray:
+        """
+        Return the distinct sorted states obtained by adding the given item to some bin of some state in the given frontier.
+        """
+        children = self.add_item_to_all_bins(bins, item)
+        self.sort_by_ascending_sum(children)
+        return self.remove_duplicates(children)
+
+
+class BinsArrayWithContents:
+    """
+    A base class for bins-arrays that keep both the sums and the contents of the bins.
+    The sums are in the field "sums"; the lists of items are returned by the method "lists".
+    For compatibility, it can also be used like a (sums, lists) tuple: bins[0] is the array of sums, and bins[1] is the list of lists of items.
+    """
+    __slots__ = ("__weakref__",)   # lets the binner keep the trail of changes of a bins-array without keeping it alive.
+
+    def lists(self) -> List[List]:
+        raise NotImplementedError("Choose a specific bins-array")
+
+    def __getitem__(self, index: int):
+        if index == 0:
+            return self.sums
+        elif index == 1:
+            return self.lists()
+        else:
+            raise IndexError(f"Bins-array index should be 0 (sums) or 1 (lists), but it is {index}")
+
+    def __iter__(self):
+        yield self.sums
+        yield self.lists()
+
+    def __len__(self):
+        return 2
+
+    def __repr__(self) -> str:
+        return repr((self.sums, self.lists()))
+
+
+class ContentsBins(BinsArrayWithContents):
+    """
+    A bins-array that keeps a list of items per bin. It is created by BinnerKeepingContents.
+    """
+    __slots__ = ("sums", "contents")
+
+    def __init__(self, sums: np.ndarray, contents: List[List]):
+        self.sums = sums                # sums[i] is the sum of bin i.
+        self.contents = contents        # contents[i] is the list of items in bin i.
+
+    def lists(self) -> List[List]:
+        return self.contents
+
+
 class BinnerKeepingContents(BinnerKeepingSums):
     """
     A binner that creates bin-arrays that keep track of the entire contents of each bin.
@@ -320,32 +710,40 @@ class BinnerKeepingContents(BinnerKeepingSums):
     >>> printbins(binner.remove_bins(bins, 1))
     Bin #0: [], sum=0.0
     Bin #1: ['a'], sum=3.0
+
+    Changes made by push_item can be reverted by undo, in reverse order:
+    >>> _=binner.push_item(bins, item="d", bin_index=0)
+    >>> printbins(binner.push_item(bins, item="e", bin_index=1))
+    Bin #0: ['d'], sum=5.0
+    Bin #1: ['a', 'e'], sum=8.0
+    Bin #2: ['b', 'c'], sum=9.0
+    >>> printbins(binner.undo(bins))
+    Bin #0: ['d'], sum=5.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['b', 'c'], sum=9.0
+    >>> printbins(binner.undo(bins))
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['b', 'c'], sum=9.0
     """
 
-    def __init__(self, valueof: Callable = lambda x:x):
-        super().__init__(valueof)
+    def __init__(self, valueof: Callable = lambda x:x, dtype=float):
+        super().__init__(valueof, dtype)
 
-    BinsArray = Tuple[np.ndarray, List[List]]  # Here, each bins-array is a tuple: sums,lists. sums is an array of sums; lists is a list of lists of items.
+    BinsArray = ContentsBins
 
     def new_bins(self, numbins:int)->BinsArray:
-        sums  = np.zeros(numbins)
-        lists = [[] for _ in range(numbins)]
-        return (sums, lists)
+        return ContentsBins(np.zeros(numbins, dtype=self.dtype), [[] for _ in range(numbins)])
 
     def copy_bins(self, bins: BinsArray)->BinsArray:
-        sums, lists = bins
-        return (np.array(sums), list(map(list, lists)))
+        return ContentsBins(np.array(bins.sums), list(map(list, bins.contents)))
 
     def concatenate_bins(self, bins1:BinsArray, bins2:BinsArray):
         """
         Concatenate the bins in bins1 with the bins in bins2.
         NOTE: Returns a new BinsArray. bins1 and bins2 are not modified.
         """
-        sums1, lists1 = bins1
-        sums2, lists2 = bins2
-        new_sums = np.append(sums1, sums2)
-        new_lists = lists1 + lists2
-        return (new_sums, new_lists)
+        return ContentsBins(np.append(bins1.sums, bins2.sums), bins1.contents + bins2.contents)
 
     def remove_bins(self, bins: BinsArray, numbins:int)->BinsArray:
         '''
@@ -353,53 +751,75 @@ class BinnerKeepingContents(BinnerKeepingSums):
         Returns a copy of "bins" with the removed bins.
         NOTE: This does NOT change bins in-place; it returns a copy.
         '''
-        sums, lists = bins
-        new_sums =  sums[0:len(sums)-numbins]
-        new_lists = lists[0:len(lists)-numbins]
-        return (new_sums, new_lists)
+        new_numbins = len(bins.sums)-numbins
+        new_contents = bins.contents[0:new_numbins]
+        return ContentsBins(bins.sums[0:new_numbins], new_contents)
 
     def add_item_to_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
-        sums, lists = bins
-        value = self.valueof(item)
-        sums[bin_index] += value
-        lists[bin_index].append(item)
+        bins.sums[bin_index] += self.valueof(item)
+        bins.contents[bin_index].append(item)
+        return bins
+
+    def remove_item_from_bin(self, bins:BinsArray, bin_index: int, item_index: int)->BinsArray:
+        item = bins.contents[bin_index].pop(item_index)
+        bins.sums[bin_index] -= self.valueof(item)
+        return bins
+
+    def remove_last_item_from_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        bins.contents[bin_index].pop()
+        bins.sums[bin_index] -= self.valueof(item)
         return bins
 
     def sums(self, bins: BinsArray) -> Tuple[float]:
-        return bins[0]
+        return bins.sums
 
-    def numitems(self, bins: BinsArray, bin_index:int) -> Tuple[float]:
+    def numitems(self, bins: BinsArray, bin_index:int) -> int:
         """
         Return the number of items in the given bin.
         """
-        sums, lists = bins
-        return len(lists[bin_index])
+        return len(bins.contents[bin_index])
 
     def numbins(self, bins: BinsArray) -> int:
         """
         Return the number of bins in the given bins-array.
         """
-        return len(bins[0])
+        return len(bins.sums)
 
     def sort_by_ascending_sum(self, bins: BinsArray) -> BinsArray:
-        sums, lists = bins
-        numbins = self.numbins(bins)
-        sorted_indices = sorted(range(numbins), key=lambda i: sums[i])
+        sums, contents = bins.sums, bins.contents
+        sorted_indices = sorted(range(len(sums)), key=sums.__getitem__)
         sums[:] = list(map(sums.__getitem__, sorted_indices))
-        lists[:] = list(map(lists.__getitem__, sorted_indices))
+        contents[:] = list(map(contents.__getitem__, sorted_indices))
         # return bins
 
+    def add_item_and_resort(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        >>> binner = BinnerKeepingContents()
+        >>> bins = binner.new_bins(3)
+        >>> for item in [4, 2, 5]: _=binner.add_item_and_resort(bins, item, 0)
+        >>> printbins(bins)
+        Bin #0: [2], sum=2.0
+        Bin #1: [4], sum=4.0
+        Bin #2: [5], sum=5.0
+        """
+        sums, contents = bins.sums, bins.contents
+        new_sum = sums[bin_index] + self.valueof(item)
+        new_index = _resorted_index(sums, bin_index, new_sum)
+        _move_bin(sums, bin_index, new_index)
+        sums[new_index] = new_sum
+        contents[bin_index].append(item)
+        contents.insert(new_index, contents.pop(bin_index))
+        return bins
+
     def combine_bins(self, bins1:BinsArray, ibin1:int, bins2:BinsArray, ibin2:int):
-        sums1, lists1 = bins1
-        sums2, lists2 = bins2
-        sums1[ibin1] += sums2[ibin2]
-        lists1[ibin1] += lists2[ibin2]
+        bins1.sums[ibin1] += bins2.sums[ibin2]
+        bins1.contents[ibin1] += bins2.contents[ibin2]
 
-    def all_combinations(self, bins1: BinsArray, bins2: BinsArray)->Iterator[BinsArray]:
+    def all_combinations(self, bins1: BinsArray, bins2: BinsArray, order_by_spread:bool=False)->Iterator[BinsArray]:
         """
         >>> binner = BinnerKeepingContents()
-        >>> b1 = ([1, 20, 300],  [[1], [20], [300]])
-        >>> b2 = ([4, 50, 600],  [[1, 3], [4, 46], [600]])
+        >>> b1 = ContentsBins([1, 20, 300],  [[1], [20], [300]])
+        >>> b2 = ContentsBins([4, 50, 600],  [[1, 3], [4, 46], [600]])
         >>> for perm in binner.all_combinations(b1,b2): perm[1]
         [[1, 1, 3], [4, 20, 46], [300, 600]]
         [[1, 1, 3], [4, 46, 300], [20, 600]]
@@ -409,32 +829,836 @@ class BinnerKeepingContents(BinnerKeepingSums):
         [[4, 20, 46], [1, 3, 300], [1, 600]]
         """
         yielded = set() # to avoid duplicates
-        sums1, lists1 = bins1
-        sums2, lists2 = bins2
+        sums1, lists1 = bins1.sums, bins1.contents
+        sums2, lists2 = bins2.sums, bins2.contents
         numbins = len(sums1)
         if len(sums2)!=numbins:
             raise ValueError(f"Inputs should have the same number of bins, but they have {numbins} and {len(sums2)} bins.")
-        for perm in itertools.permutations(range(numbins)):
+        for perm in distinct_matchings(sums1, sums2, order_by_spread):
             new_sums =  [sums1[perm[i]] + sums2[i] for i in range(numbins)]
             new_lists = [sorted(lists1[perm[i]] + lists2[i]) for i in range(numbins)]  # sorting to avoid duplicates
-            new_bins = (new_sums, new_lists)
+            new_bins = ContentsBins(new_sums, new_lists)
+            self.sort_by_ascending_sum(new_bins)
+            new_lists_tuple = tuple(map(tuple,new_bins.contents))
+            if new_lists_tuple not in yielded:
+                yielded.add(new_lists_tuple)
+                yield new_bins
+
+
+class AssignmentBins(BinsArrayWithContents):
+    """
+    A bins-array that keeps, instead of a list of items per bin, a compact matrix that maps each item to its bin.
+    It is created by BinnerKeepingAssignment.
+
+    bins[1] (the list of lists of items) is constructed on demand.
+    """
+    __slots__ = ("sums", "placement", "num_insertions", "items")
+
+    def __init__(self, sums: np.ndarray, placement: np.ndarray, num_insertions: int, items: List):
+        self.sums = sums                       # sums[i] is the sum of bin i.
+        self.placement = placement             # placement[j] = (bin, rank) of the item in slot j: its bin (or -1 if it is not in any bin),
+                                               # and the number of items that were added to this bins-array before it.
+        self.num_insertions = num_insertions   # the rank of the next added item. The ranks of the items are distinct, and smaller than it.
+        self.items = items                     # items[j] is the item in slot j. Shared by all bins-arrays of the same binner.
+
+    @property
+    def assignment(self) -> np.ndarray:
+        """ assignment[j] is the bin of the item in slot j, or -1 if this item is not in any bin (a view of the placement). """
+        return self.placement[:, 0]
+
+    def slots_in_insertion_order(self) -> np.ndarray:
+        """
+        Return the slots of the items in all bins, in insertion order.
+        The ranks are distinct and smaller than num_insertions, so the slots are ordered by a single bucket pass, without sorting.
+        """
+        assigned = np.flatnonzero(self.placement[:, 0] >= 0)
+        slot_of_rank = np.full(self.num_insertions, -1, dtype=np.int64)
+        slot_of_rank[self.placement[assigned, 1]] = assigned
+        return slot_of_rank[slot_of_rank >= 0]
+
+    def slots_in_bin(self, bin_index: int) -> np.ndarray:
+        """
+        Return the slots of the items in the given bin, in insertion order.
+        """
+        slots = self.slots_in_insertion_order()
+        return slots[self.placement[slots, 0] == bin_index]
+
+    def lists(self) -> List[List]:
+        lists = [[] for _ in range(len(self.sums))]
+        placement, items = self.placement, self.items
+        for slot in self.slots_in_insertion_order():
+            lists[placement[slot, 0]].append(items[slot])
+        return lists
+
+
+class BinnerKeepingAssignment(BinnerKeepingSums):
+    """
+    A binner that creates bin-arrays that keep track of the entire contents of each bin, like BinnerKeepingContents.
+    But instead of a list of items per bin, each bins-array keeps a compact int32 matrix that maps each item to its bin and its rank in the insertion order.
+    So copying a bins-array copies only two numpy arrays, and the lists of items are constructed only when the output is extracted.
+    The items of each bin are listed in insertion order, like in BinnerKeepingContents.
+
+    >>> values = {"a":3, "b":4, "c":5, "d":5, "e":5}
+    >>> binner = BinnerKeepingAssignment(lambda x: values[x])
+    >>> bins = binner.new_bins(3)
+    >>> printbins(binner.add_item_to_bin(bins, item="a", bin_index=0))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: [], sum=0.0
+    Bin #2: [], sum=0.0
+    >>> _=binner.add_item_to_bin(bins, item="b", bin_index=1)
+    >>> _=binner.add_item_to_bin(bins, item="c", bin_index=1)
+    >>> printbins(bins)
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['b', 'c'], sum=9.0
+    Bin #2: [], sum=0.0
+
+    Adding to a clone should not change the original:
+    >>> printbins(binner.add_item_to_bin(binner.copy_bins(bins), item="d", bin_index=1))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['b', 'c', 'd'], sum=14.0
+    Bin #2: [], sum=0.0
+    >>> printbins(bins)
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['b', 'c'], sum=9.0
+    Bin #2: [], sum=0.0
+    >>> binner.sort_by_ascending_sum(bins)
+    >>> printbins(bins)
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['b', 'c'], sum=9.0
+    >>> [binner.numitems(bins, i) for i in range(3)]
+    [0, 1, 2]
+    >>> printbins(binner.remove_item_from_bin(bins, bin_index=2, item_index=0))
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['c'], sum=5.0
+
+    >>> printbins(binner.add_empty_bins(bins, 1))
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['c'], sum=5.0
+    Bin #3: [], sum=0.0
+    >>> printbins(binner.remove_bins(bins, 1))
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+
+    The same item may appear several times:
+    >>> binner = BinnerKeepingAssignment()
+    >>> bins = binner.new_bins(2)
+    >>> for bin_index in [0,1,1]: _=binner.add_item_to_bin(bins, item=7, bin_index=bin_index)
+    >>> printbins(bins)
+    Bin #0: [7], sum=7.0
+    Bin #1: [7, 7], sum=14.0
+    >>> printbins(binner.undo(binner.push_item(bins, item=7, bin_index=0)))
+    Bin #0: [7], sum=7.0
+    Bin #1: [7, 7], sum=14.0
+    """
+
+    def __init__(self, valueof: Callable = lambda x:x, dtype=float):
+        super().__init__(valueof, dtype)
+        self.items = []      # The item in each slot. Shared by all bins-arrays created by this binner (this is the FlyWeight).
+        self.slots_of = {}   # Maps id(item) to the list of slots of this item. Since self.items holds the items, their ids are not reused.
+
+    BinsArray = AssignmentBins
+
+    def new_bins(self, numbins:int)->BinsArray:
+        return AssignmentBins(np.zeros(numbins, dtype=self.dtype), np.full((len(self.items), 2), -1, dtype=np.int32), 0, self.items)
+
+    def copy_bins(self, bins: BinsArray)->BinsArray:
+        return AssignmentBins(np.array(bins.sums), bins.placement.copy(), bins.num_insertions, self.items)
+
+    def _place_item(self, bins: BinsArray, item: Any, bin_index: int)->int:
+        """
+        Put the given item in a slot that is not used in the given bins-array, assign it to the given bin, and rank it after all other items.
+        Registers a new slot if all slots of this item are used, and grows the placement matrix if needed. Returns the slot.
+        """
+        slots = self.slots_of.setdefault(id(item), [])
+        placement = bins.placement
+        for slot in slots:
+            if slot >= len(placement) or placement[slot, 0] < 0:
+                break
+        else:
+            slot = len(self.items)
+            self.items.append(item)
+            slots.append(slot)
+        if slot >= len(placement):
+            new_length = max(len(self.items), 2*len(placement))
+            bins.placement = placement = np.concatenate((placement, np.full((new_length-len(placement), 2), -1, dtype=np.int32)))
+        placement[slot] = (bin_index, bins.num_insertions)
+        bins.num_insertions += 1
+        return slot
+
+    def _unplace_slot(self, bins: BinsArray, slot: int):
+        """
+        Remove the item in the given slot from its bin. If it was the last added item, its rank is reused by the next one,
+        so that the ranks do not grow when items are repeatedly added and removed (as in push_item and undo).
+        """
+        bins.placement[slot, 0] = -1
+        if bins.placement[slot, 1] == bins.num_insertions - 1:
+            bins.num_insertions -= 1
+
+    def concatenate_bins(self, bins1:BinsArray, bins2:BinsArray):
+        """
+        Concatenate the bins in bins1 with the bins in bins2.
+        NOTE: Returns a new BinsArray. bins1 and bins2 are not modified.
+        """
+        new_bins = AssignmentBins(np.append(bins1.sums, bins2.sums), bins1.placement.copy(), bins1.num_insertions, self.items)
+        numbins1 = len(bins1.sums)
+        for slot in bins2.slots_in_insertion_order():
+            self._place_item(new_bins, self.items[slot], bins2.placement[slot, 0] + numbins1)
+        return new_bins
+
+    def remove_bins(self, bins: BinsArray, numbins:int)->BinsArray:
+        '''
+        Remove some bins from the end of the given BinsArray.
+        Returns a copy of "bins" with the removed bins.
+        NOTE: This does NOT change bins in-place; it returns a copy.
+        '''
+        new_numbins = len(bins.sums)-numbins
+        new_placement = bins.placement.copy()
+        new_placement[new_placement[:, 0] >= new_numbins, 0] = -1
+        return AssignmentBins(bins.sums[0:new_numbins], new_placement, bins.num_insertions, self.items)
+
+    def add_item_to_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        self._place_item(bins, item, bin_index)
+        bins.sums[bin_index] += self.valueof(item)
+        return bins
+
+    def remove_item_from_bin(self, bins:BinsArray, bin_index: int, item_index: int)->BinsArray:
+        slot = bins.slots_in_bin(bin_index)[item_index]
+        self._unplace_slot(bins, slot)
+        bins.sums[bin_index] -= self.valueof(self.items[slot])
+        return bins
+
+    def remove_last_item_from_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        placement = bins.placement
+        last_slot = None
+        for slot in self.slots_of[id(item)]:
+            if slot < len(placement) and placement[slot, 0]==bin_index:
+                if last_slot is None or placement[slot, 1] > placement[last_slot, 1]:
+                    last_slot = slot
+        if last_slot is not None:
+            self._unplace_slot(bins, last_slot)
+        bins.sums[bin_index] -= self.valueof(item)
+        return bins
+
+    def sums(self, bins: BinsArray) -> Tuple[float]:
+        return bins.sums
+
+    def numitems(self, bins: BinsArray, bin_index:int) -> int:
+        """
+        Return the number of items in the given bin.
+        """
+        return int(np.count_nonzero(bins.assignment == bin_index))
+
+    def numbins(self, bins: BinsArray) -> int:
+        """
+        Return the number of bins in the given bins-array.
+        """
+        return len(bins.sums)
+
+    def sort_by_ascending_sum(self, bins: BinsArray):
+        sorted_indices = np.argsort(bins.sums, kind="stable")
+        bins.sums[:] = bins.sums[sorted_indices]
+        new_index_of = np.empty(len(sorted_indices), dtype=np.int32)
+        new_index_of[sorted_indices] = np.arange(len(sorted_indices))
+        assignment = bins.assignment
+        assigned = assignment >= 0
+        assignment[assigned] = new_index_of[assignment[assigned]]
+
+    def add_item_and_resort(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        """
+        >>> binner = BinnerKeepingAssignment()
+        >>> bins = binner.new_bins(3)
+        >>> for item in [4, 2, 5, 3]: _=binner.add_item_and_resort(bins, item, 0)
+        >>> printbins(bins)
+        Bin #0: [4], sum=4.0
+        Bin #1: [2, 3], sum=5.0
+        Bin #2: [5], sum=5.0
+        """
+        new_index = _resorted_index(bins.sums, bin_index, bins.sums[bin_index] + self.valueof(item))
+        self.add_item_to_bin(bins, item, bin_index)
+        if new_index != bin_index:
+            new_sum = bins.sums[bin_index]
+            _move_bin(bins.sums, bin_index, new_index)
+            bins.sums[new_index] = new_sum
+            # Relabel only the bins between the old and the new index.
+            new_index_of = np.arange(len(bins.sums), dtype=np.int32)
+            if new_index > bin_index:
+                new_index_of[bin_index+1:new_index+1] -= 1
+            else:
+                new_index_of[new_index:bin_index] += 1
+            new_index_of[bin_index] = new_index
+            assignment = bins.assignment
+            assigned = assignment >= 0
+            assignment[assigned] = new_index_of[assignment[assigned]]
+        return bins
+
+    def combine_bins(self, bins1:BinsArray, ibin1:int, bins2:BinsArray, ibin2:int):
+        bins1.sums[ibin1] += bins2.sums[ibin2]
+        for slot in bins2.slots_in_bin(ibin2):
+            self._place_item(bins1, self.items[slot], ibin1)
+
+    def all_combinations(self, bins1: BinsArray, bins2: BinsArray, order_by_spread:bool=False)->Iterator[BinsArray]:
+        """
+        >>> binner = BinnerKeepingAssignment()
+        >>> b1 = binner.new_bins(3)
+        >>> for item,ibin in [(1,0), (20,1), (300,2)]: _=binner.add_item_to_bin(b1, item, ibin)
+        >>> b2 = binner.new_bins(3)
+        >>> for item,ibin in [(1,0), (3,0), (4,1), (46,1), (600,2)]: _=binner.add_item_to_bin(b2, item, ibin)
+        >>> for perm in binner.all_combinations(b1,b2): perm[1]
+        [[1, 1, 3], [4, 20, 46], [300, 600]]
+        [[1, 1, 3], [4, 46, 300], [20, 600]]
+        [[1, 3, 20], [1, 4, 46], [300, 600]]
+        [[1, 3, 20], [4, 46, 300], [1, 600]]
+        [[1, 4, 46], [1, 3, 300], [20, 600]]
+        [[4, 20, 46], [1, 3, 300], [1, 600]]
+        """
+        yielded = set() # to avoid duplicates
+        numbins = len(bins1.sums)
+        if len(bins2.sums)!=numbins:
+            raise ValueError(f"Inputs should have the same number of bins, but they have {numbins} and {len(bins2.sums)} bins.")
+        lists1, lists2 = bins1.lists(), bins2.lists()
+        for perm in distinct_matchings(bins1.sums, bins2.sums, order_by_spread):
+            new_bins = self.new_bins(numbins)
+            for i in range(numbins):
+                new_bins.sums[i] = bins1.sums[perm[i]] + bins2.sums[i]
+                for item in sorted(lists1[perm[i]] + lists2[i]):  # sorting to avoid duplicates, as in BinnerKeepingContents
+                    self._place_item(new_bins, item, i)
+            self.sort_by_ascending_sum(new_bins)
+            new_lists_tuple = tuple(map(tuple, new_bins.lists()))
+            if new_lists_tuple not in yielded:
+                yielded.add(new_lists_tuple)
+                yield new_bins
+
+
+class CountsBins(BinsArrayWithContents):
+    """
+    A bins-array that keeps, instead of a list of items per bin, a matrix with the number of copies of each distinct item in each bin.
+    It is created by BinnerKeepingCounts.
+
+    bins[1] (the list of lists of items) is constructed on demand.
+    """
+    __slots__ = ("sums", "counts", "types")
+
+    def __init__(self, sums: np.ndarray, counts: np.ndarray, types: List):
+        self.sums = sums       # sums[i] is the sum of bin i.
+        self.counts = counts   # counts[i][t] is the number of copies of the item types[t] in bin i. May have fewer columns than types.
+        self.types = types     # types[t] is the t-th distinct item. Shared by all bins-arrays of the same binner.
+
+    def lists(self) -> List[List]:
+        return [
+            [self.types[t] for t in range(len(row)) for _ in range(row[t])]
+            for row in self.counts
+        ]
+
+
+class BinnerKeepingCounts(BinnerKeepingSums):
+    """
+    A binner that creates bin-arrays that keep track of the entire contents of each bin, like BinnerKeepingContents.
+    But equal items are stored as a single item type, and each bins-array keeps only a small int32 matrix with the number of copies of each type in each bin.
+    So inputs with many copies of few distinct items (e.g. 10000 items of 20 sizes) are copied in O(numbins*numtypes), regardless of the number of items.
+    The items must be hashable.
+
+    >>> binner = BinnerKeepingCounts()
+    >>> bins = binner.new_bins(3)
+    >>> for item,ibin in [(5,0), (5,0), (3,1), (5,1), (5,0)]: _=binner.add_item_to_bin(bins, item, ibin)
+    >>> printbins(bins)
+    Bin #0: [5, 5, 5], sum=15.0
+    Bin #1: [5, 3], sum=8.0
+    Bin #2: [], sum=0.0
+    >>> bins.counts
+    array([[3, 0],
+           [1, 1],
+           [0, 0]], dtype=int32)
+    >>> [binner.numitems(bins, i) for i in range(3)]
+    [3, 2, 0]
+
+    Adding to a clone should not change the original:
+    >>> printbins(binner.add_item_to_bin(binner.copy_bins(bins), item=7, bin_index=2))
+    Bin #0: [5, 5, 5], sum=15.0
+    Bin #1: [5, 3], sum=8.0
+    Bin #2: [7], sum=7.0
+    >>> printbins(bins)
+    Bin #0: [5, 5, 5], sum=15.0
+    Bin #1: [5, 3], sum=8.0
+    Bin #2: [], sum=0.0
+    >>> binner.sort_by_ascending_sum(bins)
+    >>> printbins(bins)
+    Bin #0: [], sum=0.0
+    Bin #1: [5, 3], sum=8.0
+    Bin #2: [5, 5, 5], sum=15.0
+    >>> printbins(binner.remove_item_from_bin(bins, bin_index=1, item_index=1))
+    Bin #0: [], sum=0.0
+    Bin #1: [5], sum=5.0
+    Bin #2: [5, 5, 5], sum=15.0
+    >>> printbins(binner.add_item_and_resort(bins, item=7, bin_index=0))
+    Bin #0: [5], sum=5.0
+    Bin #1: [7], sum=7.0
+    Bin #2: [5, 5, 5], sum=15.0
+    >>> printbins(binner.undo(binner.push_item(bins, item=3, bin_index=1)))
+    Bin #0: [5], sum=5.0
+    Bin #1: [7], sum=7.0
+    Bin #2: [5, 5, 5], sum=15.0
+
+    >>> printbins(binner.add_empty_bins(bins, 1))
+    Bin #0: [5], sum=5.0
+    Bin #1: [7], sum=7.0
+    Bin #2: [5, 5, 5], sum=15.0
+    Bin #3: [], sum=0.0
+    >>> printbins(binner.remove_bins(bins, 1))
+    Bin #0: [5], sum=5.0
+    Bin #1: [7], sum=7.0
+    """
+
+    def __init__(self, valueof: Callable = lambda x:x, dtype=float):
+        super().__init__(valueof, dtype)
+        self.types = []     # The distinct items. Shared by all bins-arrays created by this binner (this is the FlyWeight).
+        self.type_of = {}   # Maps each distinct item to its index in self.types.
+
+    BinsArray = CountsBins
+
+    def _type(self, item: Any)->int:
+        """
+        Return the index of the type of the given item, registering a new type if needed.
+        """
+        t = self.type_of.get(item)
+        if t is None:
+            t = self.type_of[item] = len(self.types)
+            self.types.append(item)
+        return t
+
+    def _counts_with_all_types(self, bins: BinsArray)->np.ndarray:
+        """
+        Return the counts matrix of the given bins-array, after adding columns for the types registered after it was created.
+        """
+        missing_types = len(self.types) - bins.counts.shape[1]
+        if missing_types > 0:
+            bins.counts = np.hstack((bins.counts, np.zeros((bins.counts.shape[0], missing_types), dtype=np.int32)))
+        return bins.counts
+
+    def new_bins(self, numbins:int)->BinsArray:
+        return CountsBins(np.zeros(numbins, dtype=self.dtype), np.zeros((numbins, len(self.types)), dtype=np.int32), self.types)
+
+    def copy_bins(self, bins: BinsArray)->BinsArray:
+        return CountsBins(np.array(bins.sums), bins.counts.copy(), self.types)
+
+    def concatenate_bins(self, bins1:BinsArray, bins2:BinsArray):
+        """
+        Concatenate the bins in bins1 with the bins in bins2.
+        NOTE: Returns a new BinsArray. bins1 and bins2 are not modified.
+        """
+        counts = np.vstack((self._counts_with_all_types(bins1), self._counts_with_all_types(bins2)))
+        return CountsBins(np.append(bins1.sums, bins2.sums), counts, self.types)
+
+    def remove_bins(self, bins: BinsArray, numbins:int)->BinsArray:
+        """
+        Remove some bins from the end of the given BinsArray.
+        Returns a copy of "bins" with the removed bins.
+        NOTE: This does NOT change bins in-place; it returns a copy.
+        """
+        new_numbins = len(bins.sums)-numbins
+        return CountsBins(bins.sums[0:new_numbins], bins.counts[0:new_numbins].copy(), self.types)
+
+    def add_item_to_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        t = self._type(item)
+        self._counts_with_all_types(bins)[bin_index, t] += 1
+        bins.sums[bin_index] += self.valueof(item)
+        return bins
+
+    def remove_item_from_bin(self, bins:BinsArray, bin_index: int, item_index: int)->BinsArray:
+        t = int(np.searchsorted(np.cumsum(bins.counts[bin_index]), item_index, side="right"))
+        bins.counts[bin_index, t] -= 1
+        bins.sums[bin_index] -= self.valueof(self.types[t])
+        return bins
+
+    def remove_last_item_from_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        bins.counts[bin_index, self.type_of[item]] -= 1
+        bins.sums[bin_index] -= self.valueof(item)
+        return bins
+
+    def sums(self, bins: BinsArray) -> Tuple[float]:
+        return bins.sums
+
+    def numitems(self, bins: BinsArray, bin_index:int) -> int:
+        """
+        Return the number of items in the given bin.
+        """
+        return int(bins.counts[bin_index].sum())
+
+    def numbins(self, bins: BinsArray) -> int:
+        """
+        Return the number of bins in the given bins-array.
+        """
+        return len(bins.sums)
+
+    def sort_by_ascending_sum(self, bins: BinsArray):
+        sorted_indices = np.argsort(bins.sums, kind="stable")
+        bins.sums[:] = bins.sums[sorted_indices]
+        bins.counts[:] = bins.counts[sorted_indices]
+
+    def add_item_and_resort(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        new_index = _resorted_index(bins.sums, bin_index, bins.sums[bin_index] + self.valueof(item))
+        self.add_item_to_bin(bins, item, bin_index)
+        if new_index != bin_index:
+            new_sum, new_counts = bins.sums[bin_index], bins.counts[bin_index].copy()
+            _move_bin(bins.sums, bin_index, new_index)
+            _move_bin(bins.counts, bin_index, new_index)
+            bins.sums[new_index], bins.counts[new_index] = new_sum, new_counts
+        return bins
+
+    def combine_bins(self, bins1:BinsArray, ibin1:int, bins2:BinsArray, ibin2:int):
+        bins1.sums[ibin1] += bins2.sums[ibin2]
+        self._counts_with_all_types(bins1)[ibin1] += self._counts_with_all_types(bins2)[ibin2]
+
+    def all_combinations(self, bins1: BinsArray, bins2: BinsArray, order_by_spread:bool=False)->Iterator[BinsArray]:
+        """
+        >>> binner = BinnerKeepingCounts()
+        >>> b1 = binner.new_bins(3)
+        >>> for item,ibin in [(1,0), (20,1), (300,2)]: _=binner.add_item_to_bin(b1, item, ibin)
+        >>> b2 = binner.new_bins(3)
+        >>> for item,ibin in [(1,0), (3,0), (4,1), (46,1), (600,2)]: _=binner.add_item_to_bin(b2, item, ibin)
+        >>> for perm in binner.all_combinations(b1,b2): perm[1]
+        [[1, 1, 3], [20, 4, 46], [300, 600]]
+        [[1, 1, 3], [300, 4, 46], [20, 600]]
+        [[1, 20, 3], [1, 4, 46], [300, 600]]
+        [[1, 20, 3], [300, 4, 46], [1, 600]]
+        [[1, 4, 46], [1, 300, 3], [20, 600]]
+        [[20, 4, 46], [1, 300, 3], [1, 600]]
+        """
+        yielded = set() # to avoid duplicates
+        numbins = len(bins1.sums)
+        if len(bins2.sums)!=numbins:
+            raise ValueError(f"Inputs should have the same number of bins, but they have {numbins} and {len(bins2.sums)} bins.")
+        for perm in distinct_matchings(bins1.sums, bins2.sums, order_by_spread):
+            new_bins = self.new_bins(numbins)
+            for i in range(numbins):
+                self.combine_bins(new_bins, i, bins1, perm[i])
+                self.combine_bins(new_bins, i, bins2, i)
+            self.sort_by_ascending_sum(new_bins)
+            new_counts_key = new_bins.counts.tobytes()
+            if new_counts_key not in yielded:
+                yielded.add(new_counts_key)
+                yield new_bins
+
+
+class PersistentBins(BinsArrayWithContents):
+    """
+    A bins-array in which the contents of each bin is an immutable linked list, that may be shared with other bins-arrays.
+    It is created by BinnerKeepingPersistentContents.
+
+    Each linked list is either None (an empty bin) or a cell (item, rest, length), where "rest" is the linked list of the items added before "item".
+    Adding an item creates a new cell on top of the old list, so a child bins-array shares all its lists with its parent.
+
+    bins[1] (the list of lists of items) is constructed on demand.
+    """
+    __slots__ = ("sums", "heads")
+
+    def __init__(self, sums: np.ndarray, heads: List[Tuple]):
+        self.sums = sums     # sums[i] is the sum of bin i.
+        self.heads = heads   # heads[i] is the last cell of the linked list of bin i, or None if it is empty.
+
+    @staticmethod
+    def items_in(head: Tuple) -> List:
+        """
+        Return the items in the given linked list, in the order in which they were added.
+        """
+        items = []
+        while head is not None:
+            items.append(head[0])
+            head = head[1]
+        items.reverse()
+        return items
+
+    def lists(self) -> List[List]:
+        return [PersistentBins.items_in(head) for head in self.heads]
+
+
+def _push_cell(head: Tuple, item: Any) -> Tuple:
+    return (item, head, 1 if head is None else head[2]+1)
+
+
+class BinnerKeepingPersistentContents(BinnerKeepingSums):
+    """
+    A binner that creates bin-arrays that keep track of the entire contents of each bin, like BinnerKeepingContents.
+    But the contents of each bin is a persistent linked list, which is shared between a bins-array and its copies.
+    So copying a bins-array takes O(numbins) time, regardless of the number of items, and adding an item takes O(1) time.
+    Useful for branch-and-bound algorithms, in which each child changes only one or two bins of its parent.
+
+    >>> values = {"a":3, "b":4, "c":5, "d":5, "e":5}
+    >>> binner = BinnerKeepingPersistentContents(lambda x: values[x])
+    >>> bins = binner.new_bins(3)
+    >>> printbins(binner.add_item_to_bin(bins, item="a", bin_index=0))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: [], sum=0.0
+    Bin #2: [], sum=0.0
+    >>> _=binner.add_item_to_bin(bins, item="b", bin_index=1)
+    >>> _=binner.add_item_to_bin(bins, item="c", bin_index=1)
+    >>> printbins(bins)
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['b', 'c'], sum=9.0
+    Bin #2: [], sum=0.0
+
+    Adding to a clone should not change the original, although the clone shares its lists with the original:
+    >>> clone = binner.copy_bins(bins)
+    >>> printbins(binner.add_item_to_bin(clone, item="d", bin_index=1))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['b', 'c', 'd'], sum=14.0
+    Bin #2: [], sum=0.0
+    >>> printbins(bins)
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['b', 'c'], sum=9.0
+    Bin #2: [], sum=0.0
+    >>> clone.heads[1][1] is bins.heads[1]
+    True
+    >>> binner.sort_by_ascending_sum(bins)
+    >>> printbins(bins)
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['b', 'c'], sum=9.0
+    >>> [binner.numitems(bins, i) for i in range(3)]
+    [0, 1, 2]
+    >>> printbins(binner.remove_item_from_bin(bins, bin_index=2, item_index=0))
+    Bin #0: [], sum=0.0
+    Bin #1: ['a'], sum=3.0
+    Bin #2: ['c'], sum=5.0
+    >>> printbins(binner.add_item_and_resort(bins, item="e", bin_index=0))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['e'], sum=5.0
+    Bin #2: ['c'], sum=5.0
+    >>> printbins(binner.undo(binner.push_item(bins, item="b", bin_index=1)))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['e'], sum=5.0
+    Bin #2: ['c'], sum=5.0
+
+    >>> printbins(binner.add_empty_bins(bins, 1))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['e'], sum=5.0
+    Bin #2: ['c'], sum=5.0
+    Bin #3: [], sum=0.0
+    >>> printbins(binner.remove_bins(bins, 1))
+    Bin #0: ['a'], sum=3.0
+    Bin #1: ['e'], sum=5.0
+    """
+
+    def __init__(self, valueof: Callable = lambda x:x, dtype=float):
+        super().__init__(valueof, dtype)
+
+    BinsArray = PersistentBins
+
+    def new_bins(self, numbins:int)->BinsArray:
+        return PersistentBins(np.zeros(numbins, dtype=self.dtype), [None]*numbins)
+
+    def copy_bins(self, bins: BinsArray)->BinsArray:
+        return PersistentBins(np.array(bins.sums), list(bins.heads))
+
+    def concatenate_bins(self, bins1:BinsArray, bins2:BinsArray):
+        """
+        Concatenate the bins in bins1 with the bins in bins2.
+        NOTE: Returns a new BinsArray. bins1 and bins2 are not modified.
+        """
+        return PersistentBins(np.append(bins1.sums, bins2.sums), bins1.heads + bins2.heads)
+
+    def remove_bins(self, bins: BinsArray, numbins:int)->BinsArray:
+        """
+        Remove some bins from the end of the given BinsArray.
+        Returns a copy of "bins" with the removed bins.
+        NOTE: This does NOT change bins in-place; it returns a copy.
+        """
+        new_numbins = len(bins.sums)-numbins
+        return PersistentBins(bins.sums[0:new_numbins], bins.heads[0:new_numbins])
+
+    def add_item_to_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        bins.heads[bin_index] = _push_cell(bins.heads[bin_index], item)
+        bins.sums[bin_index] += self.valueof(item)
+        return bins
+
+    def remove_item_from_bin(self, bins:BinsArray, bin_index: int, item_index: int)->BinsArray:
+        # The cells above the removed item are rebuilt; the cells below it remain shared.
+        items = PersistentBins.items_in(bins.heads[bin_index])
+        head = bins.heads[bin_index]
+        for _ in range(len(items)-item_index):
+            head = head[1]
+        for item in items[item_index+1:]:
+            head = _push_cell(head, item)
+        bins.heads[bin_index] = head
+        bins.sums[bin_index] -= self.valueof(items[item_index])
+        return bins
+
+    def remove_last_item_from_bin(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        bins.heads[bin_index] = bins.heads[bin_index][1]
+        bins.sums[bin_index] -= self.valueof(item)
+        return bins
+
+    def sums(self, bins: BinsArray) -> Tuple[float]:
+        return bins.sums
+
+    def numitems(self, bins: BinsArray, bin_index:int) -> int:
+        """
+        Return the number of items in the given bin.
+        """
+        head = bins.heads[bin_index]
+        return 0 if head is None else head[2]
+
+    def numbins(self, bins: BinsArray) -> int:
+        """
+        Return the number of bins in the given bins-array.
+        """
+        return len(bins.sums)
+
+    def sort_by_ascending_sum(self, bins: BinsArray):
+        sorted_indices = np.argsort(bins.sums, kind="stable")
+        bins.sums[:] = bins.sums[sorted_indices]
+        bins.heads[:] = [bins.heads[i] for i in sorted_indices]
+
+    def add_item_and_resort(self, bins:BinsArray, item: Any, bin_index: int)->BinsArray:
+        new_sum = bins.sums[bin_index] + self.valueof(item)
+        new_index = _resorted_index(bins.sums, bin_index, new_sum)
+        _move_bin(bins.sums, bin_index, new_index)
+        bins.sums[new_index] = new_sum
+        bins.heads.insert(new_index, _push_cell(bins.heads.pop(bin_index), item))
+        return bins
+
+    def combine_bins(self, bins1:BinsArray, ibin1:int, bins2:BinsArray, ibin2:int):
+        head = bins1.heads[ibin1]
+        for item in PersistentBins.items_in(bins2.heads[ibin2]):
+            head = _push_cell(head, item)
+        bins1.heads[ibin1] = head
+        bins1.sums[ibin1] += bins2.sums[ibin2]
+
+    def all_combinations(self, bins1: BinsArray, bins2: BinsArray, order_by_spread:bool=False)->Iterator[BinsArray]:
+        """
+        >>> binner = BinnerKeepingPersistentContents()
+        >>> b1 = binner.new_bins(3)
+        >>> for item,ibin in [(1,0), (20,1), (300,2)]: _=binner.add_item_to_bin(b1, item, ibin)
+        >>> b2 = binner.new_bins(3)
+        >>> for item,ibin in [(1,0), (3,0), (4,1), (46,1), (600,2)]: _=binner.add_item_to_bin(b2, item, ibin)
+        >>> for perm in binner.all_combinations(b1,b2): perm[1]
+        [[1, 1, 3], [20, 4, 46], [300, 600]]
+        [[1, 1, 3], [300, 4, 46], [20, 600]]
+        [[20, 1, 3], [1, 4, 46], [300, 600]]
+        [[20, 1, 3], [300, 4, 46], [1, 600]]
+        [[1, 4, 46], [300, 1, 3], [20, 600]]
+        [[20, 4, 46], [300, 1, 3], [1, 600]]
+        """
+        yielded = set() # to avoid duplicates
+        numbins = len(bins1.sums)
+        if len(bins2.sums)!=numbins:
+            raise ValueError(f"Inputs should have the same number of bins, but they have {numbins} and {len(bins2.sums)} bins.")
+        for perm in distinct_matchings(bins1.sums, bins2.sums, order_by_spread):
+            new_bins = PersistentBins(np.array(bins1.sums)[list(perm)], [bins1.heads[perm[i]] for i in range(numbins)])
+            for i in range(numbins):
+                self.combine_bins(new_bins, i, bins2, i)
             self.sort_by_ascending_sum(new_bins)
-            new_lists_tuple = tuple(map(tuple,new_bins[1]))
+            new_lists_tuple = tuple(map(tuple, map(sorted, new_bins.lists())))
             if new_lists_tuple not in yielded:
                 yielded.add(new_lists_tuple)
                 yield new_bins
 
 
+def _resorted_index(sums: List[float], bin_index: int, new_sum: float)->int:
+    """
+    Return the index to which the given bin should move, in an array of sums sorted in ascending order, when its sum changes to new_sum.
+    Uses binary search, so it needs O(log k) comparisons.
+    """
+    if new_sum >= sums[bin_index]:
+        return bisect.bisect_left(sums, new_sum, bin_index+1) - 1
+    else:
+        return bisect.bisect_right(sums, new_sum, 0, bin_index)
+
+
+def _move_bin(sums: np.ndarray, bin_index: int, new_index: int):
+    """
+    Shift the sums between bin_index and new_index by one place, to make room for the sum of bin_index at new_index.
+    """
+    if new_index > bin_index:
+        sums[bin_index:new_index] = sums[bin_index+1:new_index+1]
+    elif new_index < bin_index:
+        sums[new_index+1:bin_index+1] = sums[new_index:bin_index]
+
+
+def distinct_matchings(sums1: List[float], sums2: List[float], order_by_spread:bool=False)->Iterator[Tuple[int]]:
+    """
+    Generate the matchings between the bins of two bins-arrays, given by their sums.
+    Each matching is a tuple "perm", in which bin perm[i] of the first array is matched to bin i of the second array.
+    Bins with equal sums are interchangeable, so only one matching is generated for each multiset of matched pairs of sums.
+    This is done by assigning, to the bins of the second array in ascending order of sum, classes of equal sums in the first array (a multiset permutation),
+    where consecutive bins with equal sums in the second array must get non-decreasing classes.
+
+    :param order_by_spread: if True, the matchings are generated lazily (best-first),
+       by ascending difference between the largest and the smallest sum of a matched pair.
+
+    >>> list(distinct_matchings([1,2,3], [4,5,6]))
+    [(0, 1, 2), (0, 2, 1), (1, 0, 2), (1, 2, 0), (2, 0, 1), (2, 1, 0)]
+    >>> list(distinct_matchings([0,0,5], [0,7,0]))
+    [(0, 2, 1), (0, 1, 2)]
+    >>> list(distinct_matchings([1,2,3], [4,5,6], order_by_spread=True))
+    [(2, 1, 0), (2, 0, 1), (1, 2, 0), (1, 0, 2), (0, 2, 1), (0, 1, 2)]
+    >>> len(list(distinct_matchings([0]*7+[1], [0]*7+[2])))
+    2
+    """
+    numbins = len(sums1)
+    if len(sums2)!=numbins:
+        raise ValueError(f"Inputs should have the same number of bins, but they have {numbins} and {len(sums2)} bins.")
+    # The bins of the first array, grouped into classes of equal sums:
+    classes1 = []
+    for ibin in sorted(range(numbins), key=sums1.__getitem__):
+        if len(classes1)>0 and sums1[classes1[-1][0]]==sums1[ibin]:
+            classes1[-1].append(ibin)
+        else:
+            classes1.append([ibin])
+    values1 = [sums1[bin_class[0]] for bin_class in classes1]
+    # The bins of the second array, in ascending order of sum; same_as_previous[j] is True iff the j-th bin has the same sum as the (j-1)-th bin.
+    order2 = sorted(range(numbins), key=sums2.__getitem__)
+    same_as_previous = [j>0 and sums2[order2[j]]==sums2[order2[j-1]] for j in range(numbins)]
+
+    def children(chosen: Tuple[int]) -> Iterator[int]:
+        # The classes that can be matched to the next bin of the second array.
+        j = len(chosen)
+        min_class = chosen[-1] if same_as_previous[j] else 0
+        for c in range(min_class, len(classes1)):
+            if chosen.count(c) < len(classes1[c]):
+                yield c
+
+    def matching(chosen: Tuple[int]) -> Tuple[int]:
+        perm = [None]*numbins
+        next_in_class = [0]*len(classes1)
+        for j,c in enumerate(chosen):
+            perm[order2[j]] = classes1[c][next_in_class[c]]
+            next_in_class[c] += 1
+        return tuple(perm)
+
+    if not order_by_spread:
+        stack = [()]
+        while len(stack)>0:
+            chosen = stack.pop()
+            if len(chosen)==numbins:
+                yield matching(chosen)
+                continue
+            stack.extend(chosen + (c,) for c in reversed(list(children(chosen))))
+    else:
+        # The spread of a partial matching can only grow when it is extended, so it is a valid key for best-first search.
+        heap = [(0, 0, (), np.inf, -np.inf)]   # spread, tie-breaker, chosen classes, smallest sum, largest sum
+        counter = itertools.count(1)
+        while len(heap)>0:
+            _, _, chosen, smallest, largest = heapq.heappop(heap)
+            if len(chosen)==numbins:
+                yield matching(chosen)
+                continue
+            value2 = sums2[order2[len(chosen)]]
+            for c in children(chosen):
+                new_sum = values1[c] + value2
+                new_smallest, new_largest = min(smallest, new_sum), max(largest, new_sum)
+                heapq.heappush(heap, (new_largest-new_smallest, next(counter), chosen + (c,), new_smallest, new_largest))
+
+
 def bins2str(bins: BinsArray)->str:
-    try:
-        # bins is a tuple (sums,lists):
-        sums, lists = bins
-        numbins = len(sums)
-        bins_str = [f"Bin #{i}: {lists[i]}, sum={sums[i]}" for i in range(numbins)]
-    except:
+    if isinstance(bins, BinsArrayWithContents):
+        sums, lists = bins.sums, bins.lists()
+        bins_str = [f"Bin #{i}: {lists[i]}, sum={sums[i]}" for i in range(len(sums))]
+    else:
         # bins is an array of sums:
-        numbins = len(bins)
-        bins_str = [f"Bin #{i}: sum={bins[i]}" for i in range(numbins)]
+        bins_str = [f"Bin #{i}: sum={bins[i]}" for i in range(len(bins))]
     return "\n".join(bins_str)
 
 def printbins(bins:BinsArray):
@@ -20,9 +20,13 @@ Define various optimization objectives for a partition algorithm.
 
 from typing import List
 from abc import ABC, abstractmethod
+from itertools import accumulate
 import numpy as np
 
 class Objective(ABC):
+    # False if the value depends on the order of the bins, so that it cannot be computed from the sums in ascending order.
+    supports_ascending_order = True
+
     @abstractmethod
     def value_to_minimize(self, sums:list, are_sums_in_ascending_order:bool=False)->float:
         pass
@@ -37,10 +41,62 @@ class Objective(ABC):
         """
         return -np.inf     # this means that there is essentially no lower bound (no branch will be pruned).
 
+    def values_to_minimize(self, sums:np.ndarray, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        """
+        Returns the values of several states at once: sums is a matrix whose rows are the bin sums of the states.
+        The default implementation calls value_to_minimize for each row; simple objectives override it with a vectorized computation.
+        """
+        return np.array([self.value_to_minimize(row, are_sums_in_ascending_order) for row in sums])
+
+    def lower_bounds(self, sums:np.ndarray, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        """
+        Returns the lower bounds of several states at once: sums is a matrix whose rows are the bin sums of the states.
+        The default implementation calls lower_bound for each row; objectives with a simple bound override it with a vectorized computation.
+        """
+        return np.array([self.lower_bound(row, sum_of_remaining_items, are_sums_in_ascending_order) for row in sums], dtype=float)
+
+    def prepare(self, values: List[float], numbins: int, relative_values: List[float] = None) -> "ObjectiveContext":
+        """
+        Computes, once per input, the constants used for evaluating the bounds of this objective in branch-and-bound algorithms.
+        :param values: the item values, in the order in which the algorithm processes them.
+        """
+        return ObjectiveContext(self, values, numbins, relative_values)
+
+
+class ObjectiveContext:
+    """
+    The constants of a specific input that are used for evaluating the bounds of an objective.
+    Created by Objective.prepare before the search starts, so that the bound at each vertex takes O(numbins) time, regardless of the number of items.
+
+    >>> context = MinimizeDistAvg.prepare([5, 3, 2], numbins=2)
+    >>> context.sums_of_remaining_values, context.total, context.average
+    ([10, 5, 2, 0], 10, 5.0)
+    >>> context = MinimizeDistAvg.prepare([5, 3, 2], numbins=2, relative_values=[0.2, 0.8])
+    >>> context.bin_offsets, context.bin_shares
+    ([6.0, 0.0], [2.0, 8.0])
+    """
+    def __init__(self, objective: Objective, values: List[float], numbins: int, relative_values: List[float] = None):
+        self.objective = objective
+        self.numbins = numbins
+        self.relative_values = relative_values
+        # sums_of_remaining_values[i] is the sum of values[i:]; computed in O(n) rather than O(n^2).
+        self.sums_of_remaining_values = list(accumulate(reversed(values), initial=0))[::-1]
+        self.total = self.sums_of_remaining_values[0]
+        self.average = self.total / numbins
+        if relative_values:
+            # Each bin i starts with an offset, so that all bins are compared to the same target; its own share of the total is total*relative_values[i].
+            largest_relative_value = max(relative_values)
+            self.bin_offsets = [largest_relative_value * self.total - relative_value * self.total for relative_value in relative_values]
+            self.bin_shares = [self.total * relative_value for relative_value in relative_values]
+        else:
+            self.bin_offsets = self.bin_shares = None
+
 
 class MaximizeTheSmallestSum(Objective):
     def value_to_minimize(self, sums:list, are_sums_in_ascending_order:bool=False)->float:
         return -sums[0] if are_sums_in_ascending_order else -min(sums)
+    def values_to_minimize(self, sums:np.ndarray, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        return -(sums[:, 0] if are_sums_in_ascending_order else sums.min(axis=1))
     def __str__(self) -> str:
         return "maximize-smallest-sum"
     # def lower_bound(self, current_sums:list, value_to_add:float, bin_index:int, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->float:
@@ -68,10 +124,25 @@ class MaximizeTheSmallestSum(Objective):
                 return -np.floor(sum_of_remaining_items/i)
             sum_of_remaining_items += sorted_sums[i]
         return -np.floor(sum_of_remaining_items/len(sorted_sums))
+
+    def lower_bounds(self, sums:np.ndarray, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        """
+        The same bound as lower_bound, for each row of sums: the remaining items fill the i smallest bins up to the level (sum_of_remaining_items + their sum)/i,
+        and the best level is the minimum over i.
+
+        >>> MaximizeSmallestSum.lower_bounds(np.array([[10,20,30,40,50], [50,40,30,20,10], [0,0,0,0,0]]), sum_of_remaining_items=45)
+        array([-35., -35.,  -9.])
+        """
+        if sums.dtype == object:    # big integers
+            return super().lower_bounds(sums, sum_of_remaining_items, are_sums_in_ascending_order)
+        sorted_sums = sums if are_sums_in_ascending_order else np.sort(sums, axis=1)
+        levels = (sum_of_remaining_items + np.cumsum(sorted_sums, axis=1)) / np.arange(1, sorted_sums.shape[1] + 1)
+        return -np.floor(levels.min(axis=1))
 MaximizeSmallestSum = MaximizeTheSmallestSum()
 
 
 class MaximizeSmallestWeightedSum(Objective):
+    supports_ascending_order = False
     def __init__(self, weights: List[float]):
         self.weights = weights
     def value_to_minimize(self, sums: List[float], are_sums_in_ascending_order=False) -> float:
@@ -96,6 +167,8 @@ class MaximizeKSmallestSums(Objective):
 class MinimizeTheLargestSum(Objective):
     def value_to_minimize(self, sums:list, are_sums_in_ascending_order:bool=False)->float:
         return sums[-1] if are_sums_in_ascending_order else max(sums)
+    def values_to_minimize(self, sums:np.ndarray, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        return sums[:, -1] if are_sums_in_ascending_order else sums.max(axis=1)
     def __str__(self) -> str:
         return "minimize-largest-sum"
     # def lower_bound(self, current_sums:list, value_to_add:float, bin_index:int, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->float:
@@ -117,6 +190,18 @@ class MinimizeTheLargestSum(Objective):
         """
         current_largest_sum = sums[-1] if are_sums_in_ascending_order else max(sums)
         return max(current_largest_sum, np.ceil((sum(sums)+sum_of_remaining_items)/len(sums)))
+
+    def lower_bounds(self, sums:np.ndarray, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        """
+        The same bound as lower_bound, for each row of sums.
+
+        >>> MinimizeLargestSum.lower_bounds(np.array([[10,20,30,40,50], [0,0,0,0,0]]), sum_of_remaining_items=54)
+        array([50., 11.])
+        """
+        if sums.dtype == object:    # big integers
+            return super().lower_bounds(sums, sum_of_remaining_items, are_sums_in_ascending_order)
+        largest_sums = sums[:, -1] if are_sums_in_ascending_order else sums.max(axis=1)
+        return np.maximum(largest_sums, np.ceil((sums.sum(axis=1) + sum_of_remaining_items) / sums.shape[1]))
     
 
 MinimizeLargestSum = MinimizeTheLargestSum()
@@ -133,6 +218,14 @@ class MinimizeKLargestSums(Objective):
 class MinimizeTheDifference(Objective):
     def value_to_minimize(self, sums: List[float], are_sums_in_ascending_order=False) -> float:
         return sums[-1] - sums[0] if are_sums_in_ascending_order else max(sums) - min(sums)
+    def values_to_minimize(self, sums:np.ndarray, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        """
+        >>> MinimizeDifference.values_to_minimize(np.array([[1, 2, 3], [3, 1, 2], [2, 2, 2]]))
+        array([2, 2, 0])
+        """
+        if are_sums_in_ascending_order:
+            return sums[:, -1] - sums[:, 0]
+        return sums.max(axis=1) - sums.min(axis=1)
     def __str__(self) -> str:
         return "minimize-largest-difference"
     # def lower_bound(self, current_sums:list, value_to_add:float, bin_index:int, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->float:
@@ -152,9 +245,38 @@ class MinimizeTheDifference(Objective):
         """
         return MaximizeSmallestSum.lower_bound(sums, sum_of_remaining_items, are_sums_in_ascending_order) \
              + MinimizeLargestSum.lower_bound(sums, sum_of_remaining_items, are_sums_in_ascending_order)
+
+    def lower_bounds(self, sums:np.ndarray, sum_of_remaining_items:float, are_sums_in_ascending_order:bool=False)->np.ndarray:
+        """
+        >>> MinimizeDifference.lower_bounds(np.array([[10,20,30,40,50], [0,0,0,0,0]]), sum_of_remaining_items=54)
+        array([12.,  1.])
+        """
+        return MaximizeSmallestSum.lower_bounds(sums, sum_of_remaining_items, are_sums_in_ascending_order) \
+             + MinimizeLargestSum.lower_bounds(sums, sum_of_remaining_items, are_sums_in_ascending_order)
 MinimizeDifference = MinimizeTheDifference()
 
 
+class MinimizeTheDistAvg(Objective):
+    def value_to_minimize(self, sums: List[float], are_sums_in_ascending_order=False) -> float:
+        """
+        Returns the total distance of the bin sums above the average sum.
+
+        >>> MinimizeDistAvg.value_to_minimize([1,2,3,4,5])
+        3.0
+        >>> MinimizeDistAvg.value_to_minimize([3,3,3])
+        0
+        """
+        avg = sum(sums) / len(sums)
+        diff_from_avg = 0
+        for s in sums:
+            if s > avg:
+                diff_from_avg += s - avg
+        return diff_from_avg
+    def __str__(self) -> str:
+        return "minimize-distance-from-avg"
+MinimizeDistAvg = MinimizeTheDistAvg()
+
+
 
 if __name__ == "__main__":
     import doctest
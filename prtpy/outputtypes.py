@@ -4,7 +4,7 @@ Define the various available output formats for a partition algorithm.
 
 from abc import ABC
 from typing import Any, List, Callable
-from prtpy.binners import Binner, BinnerKeepingContents, BinnerKeepingSums, BinsArray
+from prtpy.binners import Binner, BinnerKeepingContents, BinnerKeepingSums, BinnerKeepingAssignment, BinnerKeepingCounts, BinnerKeepingPersistentContents, BinsArray, BinsArrayWithContents
 
 class OutputType(ABC):
     @classmethod
@@ -39,11 +39,7 @@ class Sums(OutputType):
 
     @classmethod
     def extract_output_from_binsarray(cls, bins: BinsArray) -> List:
-        try:
-            bins[0][0]           # If it succeeds, it means that bins is a tuple (sums,lists).
-            sums = bins[0]
-        except:
-            sums = bins          # If it fails, it means that bins is a singleton: sums.
+        sums = bins.sums if isinstance(bins, BinsArrayWithContents) else bins
         return cls.extract_output_from_sums(sums)
 
 
@@ -103,7 +99,45 @@ class Partition(OutputType):
 
     @classmethod
     def extract_output_from_binsarray(cls, bins: BinsArray) -> List:
-        return cls.extract_output_from_sums_and_lists(bins[0], bins[1])
+        return cls.extract_output_from_sums_and_lists(bins.sums, bins.lists())
+
+
+class CompactPartition(Partition):
+    """ 
+    Output the set of all bins, like Partition.
+    But during the algorithm, each bins-array keeps only a compact vector that maps each item to its bin;
+    the lists of items are constructed only once, when the output is extracted.
+    Useful for algorithms that copy many bins-arrays, such as complete-greedy.
+    """
+
+    @classmethod
+    def create_binner(cls, valueof: Callable) -> List:
+        return BinnerKeepingAssignment(valueof)
+
+
+class CountedPartition(Partition):
+    """ 
+    Output the set of all bins, like Partition.
+    But during the algorithm, equal items are kept as a single item type, and each bins-array keeps only the number of copies of each type in each bin.
+    Useful for inputs with many copies of the same items.
+    """
+
+    @classmethod
+    def create_binner(cls, valueof: Callable) -> List:
+        return BinnerKeepingCounts(valueof)
+
+
+class PersistentPartition(Partition):
+    """ 
+    Output the set of all bins, like Partition.
+    But during the algorithm, the contents of each bin is a persistent linked list, shared between a bins-array and its copies,
+    so copying a bins-array takes O(numbins) time regardless of the number of items.
+    Useful for branch-and-bound algorithms, such as complete-greedy and complete-karmarkar-karp.
+    """
+
+    @classmethod
+    def create_binner(cls, valueof: Callable) -> List:
+        return BinnerKeepingPersistentContents(valueof)
 
 
 class PartitionAndSumsTuple(Partition):
@@ -11,18 +11,23 @@ Since: 2022-07
 """
 
 import numpy as np
+import logging, inspect
 
 import prtpy
 from prtpy import outputtypes as out, objectives as obj
 from prtpy.binners import Binner
 from typing import Callable, List, Any
 
+logger = logging.getLogger(__name__)
+
 def partition(
     algorithm: Callable,
     numbins: int,
     items: Any,
     valueof: Callable[[Any], float] = None,
     outputtype: out.OutputType = out.Partition,
+    exact: bool = False,
+    use_copies: bool = False,
     **kwargs
 ):
     """
@@ -45,6 +50,14 @@ def partition(
 
     :param outputtype: what output to return. See `outputtypes.py'.
 
+    :param exact: if True, and all values are integers, the bin sums are kept as exact integers: int64 if they cannot overflow, and Python ints otherwise.
+       Default is False (the bin sums are floats).
+
+    :param use_copies: if True, and `algorithm` accepts a `copies` argument that is not given, then equal items are collapsed into a single item,
+       and their multiplicities are sent as `copies`. Currently these are only integer_programming and integer_programming_avg,
+       whose models then have one integer variable per distinct item and bin, instead of one binary variable per item and bin.
+       Other algorithms get all the items. Default is False.
+
     :param kwargs: any other arguments expected by `algorithm`.
 
     :return: a partition, or a list of sums - depending on outputtype.
@@ -52,22 +65,36 @@ def partition(
     >>> prt = prtpy.partitioning
     >>> import numpy as np
     >>> partition(algorithm=prt.dp, numbins=2, items=[1,2,3,3,5,9,9])
-    [[2, 5, 9], [1, 3, 3, 9]]
+    [[1, 3, 3, 9], [2, 5, 9]]
     >>> partition(algorithm=prt.dp, numbins=3, items=[1,2,3,3,5,9,9])
-    [[2, 9], [1, 9], [3, 3, 5]]
+    [[1, 9], [2, 9], [3, 3, 5]]
     >>> partition(algorithm=prt.dp, numbins=2, items=np.array([1,2,3,3,5,9,9]), outputtype=out.Sums)
     [16.0, 16.0]
     >>> int(partition(algorithm=prt.dp, numbins=3, items=[1,2,3,3,5,9,9], outputtype=out.LargestSum))
     11
     >>> partition(algorithm=prt.dp, numbins=2, items={"a":1, "b":2, "c":3, "d":3, "e":5, "f":9, "g":9})
-    [['b', 'e', 'f'], ['a', 'c', 'd', 'g']]
+    [['a', 'c', 'd', 'f'], ['b', 'e', 'g']]
     >>> partition(algorithm=prt.dp, numbins=3, items={"a":1, "b":2, "c":3, "d":3, "e":5, "f":9, "g":9})
-    [['b', 'g'], ['a', 'f'], ['c', 'd', 'e']]
+    [['a', 'g'], ['b', 'f'], ['c', 'd', 'e']]
 
     >>> traversc_example = [18, 12, 22, 22]
     >>> print(prtpy.partition(algorithm=prt.integer_programming, numbins=2, items=traversc_example, outputtype=out.PartitionAndSums))
     Bin #0: [12, 22], sum=34.0
     Bin #1: [18, 22], sum=40.0
+
+    Many copies of a few distinct items:
+    >>> partition(algorithm=prt.integer_programming, numbins=3, items=[5]*1000 + [7]*1000, outputtype=out.Sums, use_copies=True)
+    [4000.0, 4000.0, 4000.0]
+    >>> bins = partition(algorithm=prt.greedy, numbins=2, items=[5]*1000 + [7]*1000, outputtype=out.CountedPartition)
+    >>> [(len(bin), sum(bin)) for bin in bins]
+    [(1000, 6000), (1000, 6000)]
+
+    With large integers, exact sums distinguish partitions that floats cannot:
+    >>> large_items = [2**60+1, 2**60, 2**60, 2**60, 1, 1]
+    >>> partition(algorithm=prt.dp, numbins=2, items=large_items, outputtype=out.Difference)
+    0.0
+    >>> partition(algorithm=prt.dp, numbins=2, items=large_items, outputtype=out.Difference, exact=True)
+    1
     """
     if isinstance(items, dict):  # items is a dict mapping an item to its value.
         item_names = items.keys()
@@ -77,11 +104,60 @@ def partition(
         item_names = items
         if valueof is None:
             valueof = lambda item: item
+    if use_copies and "copies" not in kwargs and _accepts_argument(algorithm, "copies"):
+        distinct_items, copies = collapse_copies(item_names)
+        if len(distinct_items) < len(item_names):
+            logger.info("Collapsed %d items into %d distinct items", len(item_names), len(distinct_items))
+            item_names, kwargs["copies"] = distinct_items, copies
     binner = outputtype.create_binner(valueof)
+    if exact:
+        numeric_mode = binner.use_exact_sums(item_names)
+        logger.info("Bin sums are kept in %s mode", numeric_mode)
     bins   = algorithm(binner, numbins, item_names, **kwargs)
     return outputtype.extract_output_from_binsarray(bins)
 
 
+def _accepts_argument(algorithm: Callable, name: str) -> bool:
+    """
+    Returns True if the given algorithm has a parameter with the given name.
+    Returns False if its signature cannot be inspected (e.g. some builtins).
+
+    >>> _accepts_argument(collapse_copies, "items"), _accepts_argument(collapse_copies, "copies"), _accepts_argument(max, "copies")
+    (True, False, False)
+    """
+    try:
+        return name in inspect.signature(algorithm).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def collapse_copies(items: List[Any]):
+    """
+    Collapse equal items into a single item.
+    Returns the list of distinct items (in order of first appearance), and the list of their multiplicities.
+    Items are equal only if they also have the same type, so that e.g. 1, 1.0 and True remain distinct.
+    If the items are not hashable, they are returned as is, each with multiplicity 1.
+
+    >>> collapse_copies([5, 7, 5, 5, 3, 7])
+    ([5, 7, 3], [3, 2, 1])
+    >>> collapse_copies([1, 1.0, True, 1])
+    ([1, 1.0, True], [2, 1, 1])
+    >>> collapse_copies([[1], [1]])
+    ([[1], [1]], [1, 1])
+    """
+    copies_of = {}   # maps (type, item) to [item, multiplicity]
+    try:
+        for item in items:
+            key = (type(item), item)
+            if key in copies_of:
+                copies_of[key][1] += 1
+            else:
+                copies_of[key] = [item, 1]
+    except TypeError:   # unhashable items
+        return list(items), [1]*len(items)
+    return [item for item, _ in copies_of.values()], [numcopies for _, numcopies in copies_of.values()]
+
+
 def partition_random_items(numitems: int, bitsperitem: int, **kwargs):
     """
     Generates a uniformly-random list of items and partitions them using the given algorithm.
@@ -12,33 +12,49 @@
     Programmer: Erel Segal-Halevi
 """
 import math
-from typing import List, Tuple, Callable, Iterator, Any
+from typing import List, Tuple, Callable, Iterator, Any, Hashable
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
 import numpy as np
-import logging, time
+from itertools import count
+import logging, time, sys, heapq
 
-from cvxpy.utilities.key_utils import to_int
-from prtpy import objectives as obj, Binner, BinsArray
+from prtpy import objectives as obj, Binner, BinsArray, BinnerKeepingSums
+from prtpy.binners import MAX_EXACT_INT64_SUM
+from prtpy.partitioning import complete_greedy_kernel as kernel
+from prtpy.partitioning.greedy import greedy
+from prtpy.partitioning.karmarkar_karp_sy import kk
+from prtpy.partitioning.multifit import multifit
 
 logger = logging.getLogger(__name__)
 
+# Heuristics that can compute an initial incumbent for the search (see the parameter warm_start):
+WARM_STARTS = {"kk": kk, "greedy": greedy, "multifit": multifit}
+
+# The orders in which the search tree can be traversed (see the parameter strategy):
+STRATEGIES = ("dfs", "lds", "beam")
+
+# The engines that can run the search (see the parameter engine), and the objectives supported by the kernel:
+ENGINES = ("auto", "python", "kernel")
+KERNEL_OBJECTIVES = {
+    obj.MinimizeLargestSum: kernel.MINIMIZE_LARGEST_SUM,
+    obj.MaximizeSmallestSum: kernel.MAXIMIZE_SMALLEST_SUM,
+    obj.MinimizeDifference: kernel.MINIMIZE_DIFFERENCE,
+}
+
 
 def anytime(
         binner: Binner, numbins: int, items: List[any], relative_value: List[any] = None,
         objective: obj.Objective = obj.MinimizeDifference,
-        use_lower_bound: bool = True,
-        # Prune branches whose lower bound (= optimistic value) is at least as large as the current minimum.
-        use_fast_lower_bound: bool = True,
-        # A faster lower bound, that does not create the branch at all. Useful for min-max max-min and min-dist-avg objectives.
-        use_heuristic_3: bool = False,
-        # An improved stopping condition, applicable for min-max only. Not very useful in experiments.
-        use_set_of_seen_states: bool = True,
-        time_limit: float = np.inf,
-) -> Iterator:
+        engine: str = "auto",
+        **kwargs,
+) -> BinsArray:
     """
     Finds a partition in which the largest sum is minimal, using the Complete Greedy algorithm.
+    Returns the last (best) solution yielded by anytime_solutions. The other keyword arguments are passed to anytime_solutions (see there for their meaning).
 
     :param objective: represents the function that should be optimized. Default is minimizing the difference between bin sums.
-    :param time_limit: determines how much time (in seconds) the function should run before it stops. Default is infinity.
+    :param engine: "python", "kernel" or "auto" (see anytime_solutions). Default is "auto", since only the final solution is needed.
 
     >>> from prtpy import BinnerKeepingContents, BinnerKeepingSums, printbins
     >>> printbins(anytime(BinnerKeepingContents(), 2, [4,5,6,7,8], objective=obj.MinimizeDifference))
@@ -141,6 +157,112 @@ def anytime(
     >>> objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2)
     True
 
+    Compare results with and without the in-place search:
+    >>> random_numbers = np.random.randint(1, 2**16-1, 10, dtype=np.int64)
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, in_place=True)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, in_place=False)
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+    >>> printbins(anytime(BinnerKeepingContents(), 3, walter_numbers, objective=obj.MinimizeLargestSum, in_place=True))
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [46, 16], sum=62.0
+    Bin #2: [39, 13, 10], sum=62.0
+
+    Compare results with and without a bound on the set of seen states:
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, max_seen_states=10)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, max_memory_mb=0.001, in_place=True)
+    ...     bins3=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective)
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins3)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+
+    Compare results with and without a warm start:
+    >>> for warm_start in ["kk", "greedy", "multifit"]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=obj.MinimizeLargestSum, warm_start=warm_start)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=obj.MinimizeLargestSum)
+    ...     print(max(bins1)==max(bins2))
+    True
+    True
+    True
+    >>> printbins(anytime(BinnerKeepingContents(), 2, [4,5,6,7,8], objective=obj.MinimizeDifference, warm_start="kk"))
+    Bin #0: [6, 5, 4], sum=15.0
+    Bin #1: [8, 7], sum=15.0
+
+    Compare results of limited discrepancy search and depth-first search:
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, strategy="lds")
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, strategy="dfs")
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+    >>> printbins(anytime(BinnerKeepingContents(), 3, walter_numbers, objective=obj.MinimizeLargestSum, strategy="beam", beam_width=3))
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [39, 13, 10], sum=62.0
+    Bin #2: [46, 16], sum=62.0
+
+    Compare results with and without symmetry breaking, on inputs with duplicate values:
+    >>> duplicate_numbers = np.random.randint(1, 10, 14, dtype=np.int64)
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, duplicate_numbers, objective=objective, use_symmetry_breaking=True)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, duplicate_numbers, objective=objective, use_symmetry_breaking=False)
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+    >>> printbins(anytime(BinnerKeepingContents(), 3, [5,5,5,5,3,3,2], objective=obj.MinimizeLargestSum, use_symmetry_breaking=True))
+    Bin #0: [3, 3, 2], sum=8.0
+    Bin #1: [5, 5], sum=10.0
+    Bin #2: [5, 5], sum=10.0
+
+    Compare results with and without vectorized children:
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, vectorized=True)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, vectorized=False)
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+    >>> printbins(anytime(BinnerKeepingContents(), 3, walter_numbers, objective=obj.MinimizeLargestSum, vectorized=True))
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [39, 13, 10], sum=62.0
+    Bin #2: [46, 16], sum=62.0
+
+    Compare results with and without restarts:
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, restarts=5, restart_unit=10, seed=1)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, portfolio=2, restarts=3, restart_unit=10, seed=1)
+    ...     bins3=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective)
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2)==objective.value_to_minimize(bins3))
+    True
+    True
+    True
+
+    Compare results of the kernel and the Python search:
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, engine="kernel")
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, engine="python")
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+
+    Compare results with and without parallel workers:
+    >>> for objective in [obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum]:
+    ...     bins1=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective, workers=2)
+    ...     bins2=anytime(BinnerKeepingSums(), 3, random_numbers, objective=objective)
+    ...     print(objective.value_to_minimize(bins1)==objective.value_to_minimize(bins2))
+    True
+    True
+    True
+    >>> max(anytime(BinnerKeepingContents(), 3, walter_numbers, objective=obj.MinimizeLargestSum, workers=2).sums)
+    62.0
+
     Partitioning items with names:
     >>> from prtpy import partition, outputtypes as out
     >>> partition(algorithm=anytime, numbins=3, items={"a":1, "b":2, "c":3, "d":3, "e":5, "f":9, "g":9})
@@ -148,14 +270,118 @@ def anytime(
     >>> partition(algorithm=anytime, numbins=2, items={"a":1, "b":2, "c":3, "d":3, "e":5, "f":9, "g":9}, outputtype=out.Sums)
     [16.0, 16.0]
     """
+    best_bins = None
+    for best_bins, _ in anytime_solutions(binner, numbins, items, relative_value, objective=objective, engine=engine, **kwargs):
+        pass
+    return best_bins
+
+
+def anytime_solutions(
+        binner: Binner, numbins: int, items: List[any], relative_value: List[any] = None,
+        objective: obj.Objective = obj.MinimizeDifference,
+        use_lower_bound: bool = True,
+        # Prune branches whose lower bound (= optimistic value) is at least as large as the current minimum.
+        use_fast_lower_bound: bool = True,
+        # A faster lower bound, that does not create the branch at all. Useful for min-max max-min and min-dist-avg objectives.
+        use_heuristic_3: bool = False,
+        # An improved stopping condition, applicable for min-max only. Not very useful in experiments.
+        use_set_of_seen_states: bool = None,
+        # Skip vertices whose state was already searched. None (the default) means True, unless the search runs in the kernel, which does not keep them.
+        max_seen_states: int = None,
+        max_memory_mb: float = None,
+        # Bound the size of the set of seen states; when it is full, the least-recently-used state is evicted.
+        time_limit: float = np.inf,
+        in_place: bool = False,
+        # Run the DFS on a single bins-array, which is changed in-place by binner.push_item and reverted by binner.undo when backtracking.
+        # Avoids allocating a new bins-array for every vertex, so the memory does not grow with the size of the stack.
+        workers: int = 1,
+        # If larger than 1, split the top levels of the search tree into subtrees, and search them in a pool of this many processes.
+        initial_solution: BinsArray = None,
+        warm_start: str = None,
+        # Start with an incumbent solution (given, or computed by a fast heuristic), so that the bounds can prune from the first vertex.
+        engine: str = "python",
+        # "kernel" runs the search in complete_greedy_kernel (compiled by numba if available); "python" runs it here;
+        # "auto" chooses the kernel when numba is available and the input and the options allow it.
+        strategy: str = "dfs",
+        beam_width: int = 100,
+        # The order in which the search tree is traversed: "dfs" (depth-first), "lds" (limited discrepancy search) or "beam" (beam search by lower bound).
+        use_symmetry_breaking: bool = False,
+        # Assign each run of equal-valued items at once, trying each distribution of counts among the bins only once.
+        vectorized: bool = False,
+        # Build the sums of all children of a vertex as one NumPy matrix, and compute their lower bounds in one pass.
+        restarts: int = 0,
+        restart_unit: int = 100,
+        portfolio: int = 1,
+        seed: int = None,
+        # Restart the DFS on a Luby schedule with randomized tie-breaking, optionally in several randomized copies running in parallel.
+) -> Iterator[Tuple[BinsArray, dict]]:
+    """
+    A generator version of complete-greedy: yields every improving solution as soon as it is found,
+    so that the caller can use intermediate solutions, and decide when to stop (by simply not continuing the iteration).
+
+    :param objective: represents the function that should be optimized. Default is minimizing the difference between bin sums.
+    :param max_seen_states: the maximum number of states kept in the set of seen states. Default is unbounded.
+    :param max_memory_mb: an alternative bound on the set of seen states, in megabytes (estimated from the size of the state keys).
+    :param time_limit: determines how much time (in seconds) the function should run before it stops. Default is infinity.
+    :param in_place: if True, the search mutates a single bins-array and backtracks, instead of copying the bins-array for every vertex.
+    :param workers: the number of worker processes. If larger than 1, the subtrees are searched in parallel (each by copying bins-arrays, so in_place is ignored),
+             and the best objective value found by any worker is shared with all others for pruning.
+             On platforms without "fork", the binner and the items must be picklable.
+    :param initial_solution: a bins-array (of the same binner) used as the initial incumbent. It is not modified.
+    :param warm_start: the name of a heuristic that computes the initial incumbent: "kk", "greedy" or "multifit". Ignored if initial_solution is given.
+    :param engine: "python", "kernel" or "auto". The kernel can be used only with a plain BinnerKeepingSums, non-negative integer items,
+             the objectives min-max, max-min or min-difference, no relative values, no symmetry breaking or vectorized children, a single worker and no time limit.
+             It does not use the set of seen states or Heuristic 3, and it yields only the final solution (not the intermediate ones).
+             Hence "auto" chooses the kernel only if numba is available, and use_set_of_seen_states is not True and use_heuristic_3 is False;
+             otherwise it runs the Python search. Default is "python", since the kernel yields only the final solution (anytime uses "auto").
+    :param strategy: the order of the search:
+             * "dfs" - depth-first search, trying the bin with the smallest sum first.
+             * "lds" - limited discrepancy search: repeated depth-first searches, where the i-th iteration allows only paths that deviate from the greedy choice at most i times
+                       (adding an item to the j-th smallest bin counts as j deviations). It finds good solutions early, and it is still complete.
+             * "beam" - beam search: at each depth, keep only the beam_width vertices with the smallest objective lower bound. It is fast, but not complete.
+             Only "dfs" can be combined with in_place, workers or the kernel engine.
+    :param use_symmetry_breaking: if True, all items of a run of equal values are assigned in a single step:
+             the children of a vertex are the distributions of the number of copies among the bins, where bins with equal sums are interchangeable.
+             This avoids exploring permutations of identical items across bins, which is useful for inputs with many duplicate values.
+             It cannot be combined with in_place or the kernel engine.
+    :param vectorized: if True, the children of each vertex are built as the rows of a (numchildren, numbins) matrix of sums,
+             which is sorted row-wise, and the lower bounds of all children are computed in one pass (see Objective.lower_bounds).
+             Only the children that are not pruned are created as bins-arrays. This reduces the per-child overhead when there are many bins.
+             The fast lower bound is not used, since for min-max and max-min it is implied by the lower bound.
+             It cannot be combined with in_place or the kernel engine.
+    :param restarts: the number of times the DFS is restarted. The run before the i-th restart expands at most restart_unit * luby(i) vertices,
+             where luby(i) is the i-th element of the Luby sequence 1, 1, 2, 1, 1, 2, 4, ...; the last run is not limited, so the search remains complete.
+             Every run except the first breaks ties between children with equal lower bounds at random.
+             The incumbent and the fully-searched states in the set of seen states are kept across restarts.
+    :param portfolio: the number of randomized copies of the search (each with its own restarts) that run in parallel processes.
+             The copies share the best objective value found so far; when one copy completes, the others stop, and the best solution of all copies is returned.
+    :param seed: the seed of the random tie-breaking (for restarts and portfolio).
+             Restarts and portfolio can be used only with the "dfs" strategy, and cannot be combined with in_place, workers or the kernel engine.
+
+    Each yielded element is a pair (bins, stats), where stats is a snapshot of the search statistics:
+    the objective value of bins, the global lower bound and the gap between them, the elapsed time in seconds,
+    and the counters of expanded vertices and of pruning by each heuristic.
+
+    >>> from prtpy import BinnerKeepingContents
+    >>> for bins, stats in anytime_solutions(BinnerKeepingContents(), 2, [4,5,6,7,8], objective=obj.MinimizeLargestSum):
+    ...     print(bins.lists(), stats["objective_value"], stats["gap"])
+    [[8, 5], [7, 6, 4]] 17.0 2.0
+    [[8, 6], [7, 5, 4]] 16.0 1.0
+    [[6, 5, 4], [8, 7]] 15.0 0.0
+    >>> solutions = anytime_solutions(BinnerKeepingContents(), 2, [4,5,6,7,8], objective=obj.MinimizeLargestSum, warm_start="greedy")
+    >>> bins, stats = next(solutions)    # the warm start
+    >>> bins.lists(), stats["objective_value"], stats["intermediate_partitions_checked"]
+    ([[7, 6], [8, 5, 4]], 17.0, 0)
+    """
     numitems = len(items)
     start_time = time.perf_counter()
     end_time = start_time + time_limit
 
     sorted_items = sorted(items, key=binner.valueof, reverse=True)
-    sums_of_remaining_items = [sum(map(binner.valueof, sorted_items[i:])) for i in range(numitems)] + [
-        0]  # For Heuristic 3
-    best_bins, best_objective_value = None, np.inf
+    sorted_values = [binner.valueof(item) for item in sorted_items]
+    context = objective.prepare(sorted_values, numbins, relative_value)
+    sums_of_remaining_items = context.sums_of_remaining_values   # For Heuristic 3
+    value_class_ends = _value_class_ends(sorted_values)
 
     global_lower_bound = objective.lower_bound(np.zeros(numbins), sums_of_remaining_items[0],
                                                are_sums_in_ascending_order=True)
@@ -163,138 +389,788 @@ def anytime(
     logger.info("\nComplete Greedy %s Partitioning of %d items into %d parts. Lower bound: %s", objective, numitems,
                 numbins, global_lower_bound)
 
-    # Create a stack whose elements are a partition and the current depth.
-    # Initially, it contains a single tuple: an empty partition with depth 0.
+    search = _Search(binner=binner, numbins=numbins, relative_value=relative_value, context=context,
+                     sorted_items=sorted_items, sorted_values=sorted_values, sums_of_remaining_items=sums_of_remaining_items,
+                     value_class_ends=value_class_ends, objective=objective, global_lower_bound=global_lower_bound,
+                     use_lower_bound=use_lower_bound, use_fast_lower_bound=use_fast_lower_bound,
+                     use_heuristic_3=use_heuristic_3, use_set_of_seen_states=use_set_of_seen_states, use_symmetry_breaking=use_symmetry_breaking,
+                     vectorized=vectorized,
+                     max_seen_states=max_seen_states, max_memory_mb=max_memory_mb,
+                     time_limit=time_limit, end_time=end_time)
+
+    best_bins, best_objective_value = None, np.inf
+    if initial_solution is None and warm_start is not None:
+        if warm_start not in WARM_STARTS:
+            raise ValueError(f"warm_start should be one of {list(WARM_STARTS)}, but it is {warm_start!r}")
+        if numitems > 0:   # the heuristics do not support empty inputs, and the search is trivial anyway.
+            initial_solution = WARM_STARTS[warm_start](binner, numbins, items)
+            missing_bins = numbins - binner.numbins(initial_solution)
+            if missing_bins > 0:   # multifit might return fewer bins than numbins.
+                initial_solution = binner.add_empty_bins(initial_solution, missing_bins)
+    if initial_solution is not None:
+        if relative_value:
+            raise ValueError("An initial solution cannot be used together with relative values")
+        best_bins = initial_solution
+        best_objective_value = objective.value_to_minimize(binner.sums(best_bins))
+        logger.info("  Initial solution: %s, with value %s", best_bins, best_objective_value)
+        yield _solution(search, best_bins), _snapshot(search, best_objective_value, start_time)
+
+    # The root of the DFS tree: an empty partition with depth 0.
     first_bins = binner.new_bins(numbins)
     if (relative_value):
         for i in range(numbins):
-            binner.add_item_to_bin(first_bins, (max(relative_value) * sum(items) - relative_value[i] * sum(items)), i)
-    first_vertex = (first_bins, 0)
-    stack: List[Tuple[BinsArray, int]] = [first_vertex]
-    if use_set_of_seen_states:
-        seen_states = set(tuple(binner.sums(first_bins)))
-    # For logging and profiling:
-    complete_partitions_checked = 0
-    intermediate_partitions_checked = 1
-
-    times_fast_lower_bound_activated = 0
-    times_lower_bound_activated = 0
-    times_heuristic_3_activated = 0
-    times_seen_state_skipped = 0
+            binner.add_item_to_bin(first_bins, context.bin_offsets[i], i)
+
+    # The other strategies, restarts and portfolio check the engine themselves.
+    use_kernel = strategy == "dfs" and restarts == 0 and portfolio <= 1 and _use_kernel(search, engine, workers)
+    if search.use_set_of_seen_states is None:
+        search.use_set_of_seen_states = not use_kernel
+
+    if best_objective_value <= global_lower_bound:
+        logger.info("    Initial solution matches global lower bound - stopping")
+        solutions = []
+    elif strategy != "dfs":
+        if strategy not in STRATEGIES:
+            raise ValueError(f"strategy should be one of {STRATEGIES}, but it is {strategy!r}")
+        if in_place or workers > 1 or engine == "kernel" or restarts > 0 or portfolio > 1:
+            raise ValueError(f"The strategy {strategy!r} cannot be combined with in_place, workers, the kernel engine, restarts or portfolio")
+        if strategy == "lds":
+            solutions = _search_with_lds(search, first_bins, best_bins, best_objective_value)
+        else:
+            solutions = _search_with_beam(search, first_bins, beam_width, best_bins, best_objective_value)
+    elif restarts > 0 or portfolio > 1:
+        if in_place or workers > 1 or engine == "kernel":
+            raise ValueError("Restarts and portfolio cannot be combined with in_place, workers or the kernel engine")
+        from prtpy.partitioning.complete_greedy_drivers import _search_portfolio, _search_with_restarts
+        if portfolio > 1:
+            solutions = _search_portfolio(search, first_bins, portfolio, restarts, restart_unit, seed, best_bins, best_objective_value)
+        else:
+            solutions = _search_with_restarts(search, first_bins, restarts, restart_unit, np.random.default_rng(seed), False, best_bins, best_objective_value)
+    elif use_kernel:
+        solutions = _search_with_kernel(search, best_bins, best_objective_value)
+    elif workers > 1:
+        from prtpy.partitioning.complete_greedy_drivers import _search_in_parallel
+        solutions = _search_in_parallel(search, first_bins, workers, best_bins, best_objective_value)
+    elif in_place:
+        if use_symmetry_breaking or vectorized:
+            raise ValueError("Symmetry breaking and vectorized children cannot be combined with in_place")
+        solutions = _search_in_place(search, first_bins, best_bins, best_objective_value)
+    else:
+        seen_states = search.new_seen_states(search.state_key(first_bins, 0))
+        solutions = _search_with_stack(search, [(first_bins, 0)], seen_states, best_bins, best_objective_value)
+    for best_bins, best_objective_value in solutions:
+        yield _solution(search, best_bins), _snapshot(search, best_objective_value, start_time)
+
+    stats = search.stats
+    logger.info("Checked %d out of %d complete partitions, and %d intermediate partitions.",
+                stats["complete_partitions_checked"], numbins ** numitems, stats["intermediate_partitions_checked"])
+    logger.info("  Heuristics: fast lower bound = %d, lower bound = %d, seen state = %d, heuristic 3 = %d.",
+                stats["times_fast_lower_bound_activated"], stats["times_lower_bound_activated"], stats["times_seen_state_skipped"],
+                stats["times_heuristic_3_activated"])
+    if search.use_set_of_seen_states:
+        logger.info("  Seen states: %d lookups, %d hits, %d evictions.",
+                    stats["seen_state_lookups"], stats["times_seen_state_skipped"], stats["seen_state_evictions"])
+
+
+def _solution(search: "_Search", bins: BinsArray) -> BinsArray:
+    """
+    Returns a copy of the given bins-array of the search, in the form returned to the caller:
+    without the initial items that represent relative values, sorted by ascending sum, and with integral sums.
+    """
+    binner, numbins = search.binner, search.numbins
+    bins = binner.copy_bins(bins)
+    if search.relative_value:
+        for i in range(numbins):
+            binner.remove_item_from_bin(bins, i, 0)
+    else:
+        binner.sort_by_ascending_sum(bins)
+
+    sums = binner.sums(bins)
+    for i in range(numbins):
+        if not isinstance(sums[i], (int, np.integer)):   # exact integer sums must not pass through float
+            sums[i] = math.floor(sums[i])
+    return bins
+
+
+STATS_COUNTERS = ("intermediate_partitions_checked", "complete_partitions_checked",
+                  "times_fast_lower_bound_activated", "times_lower_bound_activated", "times_seen_state_skipped", "times_heuristic_3_activated",
+                  "seen_state_lookups", "seen_state_evictions", "restarts")
+
+def _snapshot(search: "_Search", objective_value: float, start_time: float) -> dict:
+    """
+    Returns a snapshot of the statistics of the search, for a solution with the given objective value.
+    """
+    snapshot = {counter: search.stats[counter] for counter in STATS_COUNTERS}
+    snapshot["objective_value"] = objective_value
+    snapshot["global_lower_bound"] = search.global_lower_bound
+    snapshot["gap"] = objective_value - search.global_lower_bound
+    snapshot["elapsed_time"] = time.perf_counter() - start_time
+    return snapshot
+
+
+@dataclass
+class _Search:
+    """
+    The data that is common to all vertices of a single complete-greedy search.
+    """
+    binner: Binner
+    numbins: int
+    relative_value: List[Any]
+    context: obj.ObjectiveContext
+    sorted_items: List[Any]                 # the items in descending order of value; the item at depth d is sorted_items[d].
+    sorted_values: List[float]              # sorted_values[d] is the value of sorted_items[d].
+    sums_of_remaining_items: List[float]    # sums_of_remaining_items[d] is the sum of sorted_items[d:].
+    value_class_ends: List[int]             # sorted_items[d:value_class_ends[d]] all have the same value as sorted_items[d] (see _value_class_ends).
+    objective: obj.Objective
+    global_lower_bound: float
+    use_lower_bound: bool
+    use_fast_lower_bound: bool
+    use_heuristic_3: bool
+    use_set_of_seen_states: bool
+    use_symmetry_breaking: bool
+    vectorized: bool
+    max_seen_states: int
+    max_memory_mb: float
+    time_limit: float
+    end_time: float
+    stats: Counter = field(default_factory=Counter)   # for logging and profiling.
+
+    def state_key(self, bins: BinsArray, depth: int, ignore_order: bool = False) -> Hashable:
+        """
+        Returns the key of the given vertex in the set of seen states.
+        It includes the depth, since with zero-valued items, a vertex and its child may have the same sums.
+        """
+        return depth, self.binner.state_key(bins, ignore_order=ignore_order)
+
+    def new_seen_states(self, first_key) -> "_SeenStates":
+        """ Returns a new set of seen states containing the given key, or None if the set of seen states is not used. """
+        if not self.use_set_of_seen_states:
+            return None
+        return _SeenStates([first_key], self.max_seen_states, self.max_memory_mb, self.stats)
+
+
+def _value_class_ends(sorted_values: List[float]) -> List[int]:
+    """
+    Returns a list that contains, for each index d, the index after the last value equal to sorted_values[d] (which are consecutive, since the values are sorted).
+    >>> _value_class_ends([9, 5, 5, 5, 2, 2])
+    [1, 4, 4, 4, 6, 6]
+    """
+    value_class_ends = list(range(1, len(sorted_values) + 1))
+    for d in reversed(range(len(sorted_values) - 1)):
+        if sorted_values[d] == sorted_values[d + 1]:
+            value_class_ends[d] = value_class_ends[d + 1]
+    return value_class_ends
+
+
+class _SeenStates:
+    """
+    The set of keys of the states seen so far in the search (a transposition table).
+    If max_size or max_memory_mb is given, the set is bounded: when it is full, the least-recently-used key is evicted.
+    An evicted state may be searched again, so the search remains correct; only some of the pruning is lost.
+
+    >>> stats = Counter()
+    >>> seen = _SeenStates([b"a"], max_size=2, stats=stats)
+    >>> seen.add(b"b")
+    >>> b"a" in seen      # "a" becomes the most-recently-used key
+    True
+    >>> seen.add(b"c")    # evicts "b"
+    >>> b"b" in seen, len(seen), stats["seen_state_lookups"], stats["seen_state_evictions"]
+    (False, 2, 2, 1)
+    """
+    ENTRY_OVERHEAD_BYTES = 100   # an estimate of the memory used by the ordered dict for each key, besides the key itself.
+
+    def __init__(self, keys: List, max_size: int = None, max_memory_mb: float = None, stats: Counter = None):
+        self.max_size = max_size
+        self.max_memory_mb = max_memory_mb
+        self.stats = Counter() if stats is None else stats
+        if max_size is None and max_memory_mb is None:
+            self.keys = set(keys)
+        else:
+            self.keys = OrderedDict()
+            for key in keys:
+                self.add(key)
+
+    def __contains__(self, key) -> bool:
+        self.stats["seen_state_lookups"] += 1
+        if key not in self.keys:
+            return False
+        if self.max_size is not None or self.max_memory_mb is not None:
+            self.keys.move_to_end(key)
+        return True
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def discard(self, key):
+        if isinstance(self.keys, set):
+            self.keys.discard(key)
+        else:
+            self.keys.pop(key, None)
+
+    def add(self, key):
+        if isinstance(self.keys, set):
+            self.keys.add(key)
+            return
+        if self.max_memory_mb is not None:   # The size of the keys is known only when the first key arrives.
+            key_size = sys.getsizeof(key) + (sum(map(sys.getsizeof, key)) if isinstance(key, tuple) else 0)
+            max_size_by_memory = int(self.max_memory_mb * 2**20 // (key_size + self.ENTRY_OVERHEAD_BYTES))
+            self.max_size = max_size_by_memory if self.max_size is None else min(self.max_size, max_size_by_memory)
+            self.max_memory_mb = None
+        self.keys[key] = None
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+            self.stats["seen_state_evictions"] += 1
+
+
+def _search_with_stack(search: _Search, stack: List[Tuple[BinsArray, int]], seen_states: _SeenStates,
+        best_bins: BinsArray = None, best_objective_value: float = np.inf,
+        shared_bound: "_SharedBound" = None, split_depth: int = None, frontier: List[Tuple[BinsArray, int]] = None,
+) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Run the DFS from the vertices in the given stack, creating a new bins-array for every new vertex.
+    Yields each solution that is better than the previous ones, with its objective value.
+
+    :param stack: a list of vertices, each of which is a pair (bins-array, depth).
+    :param seen_states: the keys of the states seen so far (see _SeenStates); updated in-place. None if the set of seen states is not used.
+    :param best_bins, best_objective_value: the incumbent solution, if any.
+    :param shared_bound: if given, contains the best objective value found by all workers of a parallel search (see complete_greedy_drivers._SharedBound).
+    :param split_depth, frontier: if given, the vertices at depth split_depth are not expanded, but appended to the frontier.
+    """
+    binner, numitems, objective = search.binner, len(search.sorted_items), search.objective
+    stats = search.stats
+    stats["intermediate_partitions_checked"] += len(stack)
 
     while len(stack) > 0:
-        if time.perf_counter() > end_time:
-            logger.info("Time-limit of %s reached - stopping", time_limit)
+        if time.perf_counter() > search.end_time:
+            logger.info("Time-limit of %s reached - stopping", search.time_limit)
             break
 
         current_bins, depth = stack.pop()
         current_sums = tuple(binner.sums(current_bins))
+        if shared_bound is None:
+            bound = best_objective_value
+        else:
+            bound = min(best_objective_value, shared_bound.get())
+            if bound <= search.global_lower_bound:
+                logger.info("    The shared bound matches the global lower bound - stopping")
+                break
 
         # If we have reached the leaves of the DFS tree, check if we have an improvement:
         if depth == numitems:
-            complete_partitions_checked += 1
+            stats["complete_partitions_checked"] += 1
             new_objective_value = objective.value_to_minimize(current_sums)
             if new_objective_value < best_objective_value:
                 best_bins, best_objective_value = current_bins, new_objective_value
                 logger.info("  Found a better solution: %s, with value %s", current_bins, best_objective_value)
-                if new_objective_value <= global_lower_bound:
+                yield best_bins, best_objective_value
+                if shared_bound is not None:
+                    shared_bound.offer(new_objective_value)
+                if new_objective_value <= search.global_lower_bound:
                     logger.info("    Solution matches global lower bound - stopping")
                     break
             continue
-        # Heuristic 3: "If the sum of the remaining unassigned integers plus the smallest current subset sum is <= the largest subset sum, all remaining integers are assigned to the subset with the smallest sum, terminating that branch of the tree."
-        # Note that this heuristic is valid only for the objective "minimize largest sum"!
-        if use_heuristic_3 and objective == obj.MinimizeLargestSum:
-            if sums_of_remaining_items[depth] + current_sums[0] <= current_sums[-1]:
-                new_bins = binner.copy_bins(current_bins)
-                for i in range(depth, numitems):
-                    binner.add_item_to_bin(new_bins, sorted_items[i], 0)
-                    binner.sort_by_ascending_sum(new_bins)
-                new_depth = numitems
-                stack.append((new_bins, new_depth))
-                logger.debug("    Heuristic 3 activated")
-                times_heuristic_3_activated += 1
+        if split_depth is not None and depth >= split_depth:   # with symmetry breaking, a vertex may skip over split_depth.
+            frontier.append((current_bins, depth))
+            continue
+        # The children are pushed in reverse, so that the child in which the next item is added to the bin with the *smallest* sum is popped first.
+        stack.extend(reversed(_children(search, current_bins, current_sums, depth, bound, seen_states)))
+
+
+def _children(search: _Search, current_bins: BinsArray, current_sums: Tuple, depth: int, bound: float, seen_states: _SeenStates,
+        max_children: int = None) -> List[Tuple[BinsArray, int]]:
+    """
+    Returns the children of the given vertex that are not pruned, as pairs (bins-array, depth),
+    in the order in which they should be searched: first the child in which the next item is added to the bin with the *smallest* sum.
+    A child is pruned if its lower bound is at least the given bound, or if its state was already seen.
+
+    :param current_sums: the sums of current_bins, as a tuple.
+    :param max_children: if given, only the first max_children children are created.
+    """
+    binner, numbins, numitems = search.binner, search.numbins, len(search.sorted_items)
+    objective, sorted_items, sums_of_remaining_items = search.objective, search.sorted_items, search.sums_of_remaining_items
+    stats = search.stats
+
+    # Heuristic 3: "If the sum of the remaining unassigned integers plus the smallest current subset sum is <= the largest subset sum, all remaining integers are assigned to the subset with the smallest sum, terminating that branch of the tree."
+    # Note that this heuristic is valid only for the objective "minimize largest sum"!
+    if search.use_heuristic_3 and objective == obj.MinimizeLargestSum:
+        if sums_of_remaining_items[depth] + current_sums[0] <= current_sums[-1]:
+            new_bins = binner.copy_bins(current_bins)
+            for i in range(depth, numitems):
+                binner.add_item_and_resort(new_bins, sorted_items[i], 0)
+            logger.debug("    Heuristic 3 activated")
+            stats["times_heuristic_3_activated"] += 1
+            return [(new_bins, numitems)]
+    if search.use_symmetry_breaking and search.value_class_ends[depth] > depth + 1:
+        return _value_class_children(search, current_bins, current_sums, depth, bound, seen_states, max_children)
+    if search.vectorized:
+        return _vectorized_children(search, current_bins, current_sums, depth, bound, seen_states, max_children)
+    next_item = sorted_items[depth]
+    sum_of_remaining_items = sums_of_remaining_items[depth + 1]
+
+    # Heuristic 1: "If there are two subsets with the same sum, the current number is assigned to only one."
+    # Of several bins with the same sum, the one with the largest index is used.
+    bin_indices = []
+    previous_bin_sum = None
+    for bin_index in reversed(range(numbins)):
+        current_bin_sum = current_sums[bin_index]
+        if current_bin_sum == previous_bin_sum:
+            continue
+        previous_bin_sum = current_bin_sum
+        bin_indices.append(bin_index)
+    bin_indices.reverse()
+
+    children = []
+    for bin_index in bin_indices:
+        if len(children) == max_children:
+            break
+
+        # Fast-lower-bound heuristic - before creating the new vertex.
+        if search.use_fast_lower_bound:
+            fast_lower_bound = _fast_lower_bound(search.context, current_sums, bin_index, search.sorted_values[depth], sum_of_remaining_items)
+            if fast_lower_bound >= bound:
+                stats["times_fast_lower_bound_activated"] += 1
+                continue
+
+        if search.relative_value:
+            new_bins = binner.add_item_to_bin(binner.copy_bins(current_bins), next_item, bin_index)
+        else:
+            new_bins = binner.add_item_and_resort(binner.copy_bins(current_bins), next_item, bin_index)
+        new_sums = tuple(binner.sums(new_bins))
+
+        # Lower-bound heuristic. 
+        if search.use_lower_bound:
+            lower_bound = objective.lower_bound(new_sums, sum_of_remaining_items, are_sums_in_ascending_order=False)
+            if lower_bound >= bound:
+                logger.debug("    Lower bound %f too large", lower_bound)
+                stats["times_lower_bound_activated"] += 1
+                continue
+        if seen_states is not None:
+            new_key = search.state_key(new_bins, depth + 1)
+            if new_key in seen_states:
+                logger.debug("    State %s already seen", new_sums)
+                stats["times_seen_state_skipped"] += 1
+                continue
+            seen_states.add(new_key)  # should be after if use_lower_bound
+
+        new_vertex = (new_bins, depth + 1)
+        children.append(new_vertex)
+        stats["intermediate_partitions_checked"] += 1
+    return children
+
+
+def _vectorized_children(search: _Search, current_bins: BinsArray, current_sums: Tuple, depth: int, bound: float, seen_states: _SeenStates,
+        max_children: int = None) -> List[Tuple[BinsArray, int]]:
+    """
+    Returns the same children as _children (without the fast lower bound), but computes their sums and lower bounds with NumPy:
+    row j of the matrix new_sums contains the sums of the j-th child, and the pruned children are masked out before any bins-array is created.
+    """
+    binner, objective, stats = search.binner, search.objective, search.stats
+    next_item, value = search.sorted_items[depth], search.sorted_values[depth]
+    sum_of_remaining_items = search.sums_of_remaining_items[depth + 1]
+
+    # Heuristic 1: of several adjacent bins with the same sum, only the one with the largest index is used.
+    sums = np.array(binner.sums(current_bins))   # keeps the dtype of the sums, e.g. object for big integers.
+    bin_indices = np.flatnonzero(np.append(sums[:-1] != sums[1:], True))
+
+    new_sums = np.tile(sums, (len(bin_indices), 1))
+    new_sums[np.arange(len(bin_indices)), bin_indices] += value
+    if not search.relative_value:
+        new_sums.sort(axis=1)
+    if search.use_lower_bound:
+        not_pruned = objective.lower_bounds(new_sums, sum_of_remaining_items, are_sums_in_ascending_order=not search.relative_value) < bound
+        stats["times_lower_bound_activated"] += len(bin_indices) - int(np.count_nonzero(not_pruned))
+        child_indices = np.flatnonzero(not_pruned)
+    else:
+        child_indices = range(len(bin_indices))
+
+    # For a plain BinnerKeepingSums, the bins-array of a child is just its row of sums.
+    rows_are_bins = type(binner) is BinnerKeepingSums and not search.relative_value
+    children = []
+    for child_index in child_indices:
+        if len(children) == max_children:
+            break
+        if rows_are_bins:
+            new_bins = new_sums[child_index].copy()
+        elif search.relative_value:
+            new_bins = binner.add_item_to_bin(binner.copy_bins(current_bins), next_item, int(bin_indices[child_index]))
+        else:
+            new_bins = binner.add_item_and_resort(binner.copy_bins(current_bins), next_item, int(bin_indices[child_index]))
+        if seen_states is not None:
+            new_key = search.state_key(new_bins, depth + 1)
+            if new_key in seen_states:
+                stats["times_seen_state_skipped"] += 1
                 continue
-        next_item = sorted_items[depth]
-        sum_of_remaining_items = sums_of_remaining_items[depth + 1]
+            seen_states.add(new_key)
+        children.append((new_bins, depth + 1))
+        stats["intermediate_partitions_checked"] += 1
+    return children
+
+
+def _value_class_children(search: _Search, current_bins: BinsArray, current_sums: Tuple, depth: int, bound: float, seen_states: _SeenStates,
+        max_children: int = None) -> List[Tuple[BinsArray, int]]:
+    """
+    Returns the children of the given vertex when the next item starts a run of several equal-valued items (symmetry breaking).
+    All items of the run are assigned at once, so each child corresponds to a distribution of the number of copies among the bins (see _distributions),
+    and the permutations of identical items across bins are never created.
+    The children are ordered by ascending lower bound, and pruned as in _children (the fast lower bound is used only for min-max).
+    """
+    binner, objective, stats = search.binner, search.objective, search.stats
+    end = search.value_class_ends[depth]
+    run_items, value = search.sorted_items[depth:end], search.sorted_values[depth]
+    sum_of_remaining_items = search.sums_of_remaining_items[end]
 
-        previous_bin_sum = None
+    max_counts = None
+    if search.use_fast_lower_bound and objective == obj.MinimizeLargestSum and value > 0:
+        # The fast lower bound for min-max, applied to all copies at once: a bin whose sum reaches the bound is pruned.
+        max_counts = [max(math.ceil((bound - current_sum) / value) - 1, 0) if bound < np.inf else end - depth for current_sum in current_sums]
 
-        # We want to insert the next item to the bin with the *smallest* sum first.
-        # But, since we use a stack, we have to insert it to the bin with the *largest* sum first,
-        # so that it is pushed deeper into the stack.
-        # Therefore, we proceed in reverse, by *descending* order of sum.
-        for bin_index in reversed(range(numbins)):
+    candidates = []   # (lower bound, index, bins-array)
+    for counts in _distributions(end - depth, current_sums, max_counts):
+        # The bound is computed from the sums, before creating the new vertex.
+        new_sums = [current_sum + numcopies * value for current_sum, numcopies in zip(current_sums, counts)]
+        lower_bound = objective.lower_bound(new_sums, sum_of_remaining_items, are_sums_in_ascending_order=False)
+        if search.use_lower_bound and lower_bound >= bound:
+            stats["times_lower_bound_activated"] += 1
+            continue
 
-            # Heuristic 1: "If there are two subsets with the same sum, the current number is assigned to only one."
-            current_bin_sum = current_sums[bin_index]
-            if current_bin_sum == previous_bin_sum:
+        new_bins = binner.copy_bins(current_bins)
+        run_items_iterator = iter(run_items)
+        for bin_index, numcopies in enumerate(counts):
+            for _ in range(numcopies):
+                binner.add_item_to_bin(new_bins, next(run_items_iterator), bin_index)
+        if not search.relative_value:
+            binner.sort_by_ascending_sum(new_bins)
+        if seen_states is not None:
+            new_key = search.state_key(new_bins, end)
+            if new_key in seen_states:
+                stats["times_seen_state_skipped"] += 1
                 continue
-            previous_bin_sum = current_bin_sum
-
-            # Fast-lower-bound heuristic - before creating the new vertex.
-            # Currently implemented only for two objectives: min-max, max-min and min-dist-avg
-            if use_fast_lower_bound:
-                if objective == obj.MinimizeLargestSum:
-                    # "If an assignment to a subset creates a subset sum that equals or exceeds the largest subset sum in the best complete solution found so far, that branch is pruned from the tree."
-                    fast_lower_bound = max(current_bin_sum + binner.valueof(next_item), current_sums[-1])
-                elif objective == obj.MaximizeSmallestSum:
-                    # An adaptation of the above heuristic to maximizing the smallest sum.
-                    if bin_index == 0:
-                        new_smallest_sum = min(current_sums[0] + binner.valueof(next_item), current_sums[1])
-                    else:
-                        new_smallest_sum = current_sums[0]
-                    fast_lower_bound = -(new_smallest_sum + sum_of_remaining_items)
-                elif objective == obj.MinimizeDistAvg:
-                    if relative_value:
-                        fast_lower_bound = 0
-                        for i in range (numbins):
-                            fast_lower_bound = fast_lower_bound + max((current_sums[i]-(max(relative_value) * sum(items) - relative_value[i] * sum(items)))-sum(items)*relative_value[i],0)
-                    else:
-                        fast_lower_bound = 0
-                        avg = sum(items) / numbins
-                        for i in range (numbins):
-                            fast_lower_bound = fast_lower_bound + max(current_sums[i]-avg,0)
-                else:
-                    fast_lower_bound = -np.inf
+            seen_states.add(new_key)
+        candidates.append((lower_bound, len(candidates), new_bins))
+        stats["intermediate_partitions_checked"] += 1
+    candidates.sort(key=lambda candidate: candidate[0:2])
+    return [(new_bins, end) for _, _, new_bins in candidates[:max_children]]
+
+
+def _distributions(numcopies: int, current_sums: Tuple, max_counts: List[int] = None) -> Iterator[Tuple[int, ...]]:
+    """
+    Yields the ways to distribute numcopies identical items among bins with the given sums, as tuples with the number of copies in each bin.
+    Adjacent bins with equal sums are interchangeable, so only distributions in which their numbers of copies are non-increasing are yielded
+    (this generalizes Heuristic 1 to several items).
+
+    :param max_counts: if given, max_counts[i] is the largest number of copies allowed in bin i.
+
+    >>> list(_distributions(2, (0, 0, 5)))
+    [(2, 0, 0), (1, 1, 0), (1, 0, 1), (0, 0, 2)]
+    >>> len(list(_distributions(4, (1, 2, 3))))    # all 15 distributions, instead of 3**4 = 81 assignments.
+    15
+    >>> list(_distributions(3, (1, 2, 3), max_counts=[1, 1, 3]))
+    [(1, 1, 1), (1, 0, 2), (0, 1, 2), (0, 0, 3)]
+    """
+    numbins = len(current_sums)
+    counts = [0] * numbins
+
+    def distribute(bin_index: int, remaining: int):
+        if bin_index > 0 and current_sums[bin_index] == current_sums[bin_index - 1]:
+            max_count = min(remaining, counts[bin_index - 1])
+        else:
+            max_count = remaining
+        if max_counts is not None:
+            max_count = min(max_count, max_counts[bin_index])
+        if bin_index == numbins - 1:
+            if remaining <= max_count:
+                counts[bin_index] = remaining
+                yield tuple(counts)
+            return
+        for count in reversed(range(max_count + 1)):
+            counts[bin_index] = count
+            yield from distribute(bin_index + 1, remaining - count)
+
+    yield from distribute(0, numcopies)
+
+
+def _search_in_place(search: _Search, current_bins: BinsArray,
+        best_bins: BinsArray = None, best_objective_value: float = np.inf,
+) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Run the DFS on the single given bins-array, which is changed in-place by binner.push_item and reverted by binner.undo when backtracking.
+    Yields a copy of each solution that is better than the previous ones, with its objective value.
+    :param best_bins, best_objective_value: the incumbent solution, if any.
+    """
+    binner, numbins, numitems, relative_value = search.binner, search.numbins, len(search.sorted_items), search.relative_value
+    objective, sorted_items, sums_of_remaining_items = search.objective, search.sorted_items, search.sums_of_remaining_items
+    stats = search.stats
+    stats["intermediate_partitions_checked"] += 1
+
+    def child_order():
+        """
+        Returns the current sums, and the list of (position, bin_index) pairs of the bins into which the next item should be tried,
+        where position is the index of the bin in current_sums.
+        The bins are ordered by ascending sum, and bins with the same sum as the previous bin are skipped (Heuristic 1).
+        """
+        sums = binner.sums(current_bins)
+        if relative_value:
+            bin_indices = range(numbins)
+        else:
+            bin_indices = sorted(range(numbins), key=sums.__getitem__)
+        current_sums = tuple(sums[i] for i in bin_indices)
+        order = []
+        for position, bin_index in enumerate(bin_indices):
+            if position > 0 and current_sums[position] == current_sums[position-1]:
+                continue
+            order.append((position, bin_index))
+        return current_sums, iter(order)
+
+    def state_key(depth: int):
+        return search.state_key(current_bins, depth, ignore_order=not relative_value)
+
+    seen_states = search.new_seen_states(state_key(0))
+
+    # Each frame contains the depth of a vertex on the current path, its sums, and an iterator over its remaining children.
+    frames = [(0,) + child_order()] if numitems > 0 else []
+    if numitems == 0:
+        yield binner.copy_bins(current_bins), objective.value_to_minimize(binner.sums(current_bins))
+    try:
+        while len(frames) > 0:
+            if time.perf_counter() > search.end_time:
+                logger.info("Time-limit of %s reached - stopping", search.time_limit)
+                break
+
+            depth, current_sums, children = frames[-1]
+            position, bin_index = next(children, (None, None))
+            if position is None:    # all children were checked - backtrack.
+                frames.pop()
+                if len(frames) > 0:
+                    binner.undo(current_bins)
+                continue
+
+            next_item = sorted_items[depth]
+            sum_of_remaining_items = sums_of_remaining_items[depth + 1]
+            if search.use_fast_lower_bound:
+                fast_lower_bound = _fast_lower_bound(search.context, current_sums, position, search.sorted_values[depth], sum_of_remaining_items)
                 if fast_lower_bound >= best_objective_value:
-                    times_fast_lower_bound_activated += 1
+                    stats["times_fast_lower_bound_activated"] += 1
                     continue
 
-            new_bins = binner.add_item_to_bin(binner.copy_bins(current_bins), next_item, bin_index)
-            if(not relative_value):
-                binner.sort_by_ascending_sum(new_bins)
-            new_sums = tuple(binner.sums(new_bins))
-
-            # Lower-bound heuristic. 
-            if use_lower_bound:
+            binner.push_item(current_bins, next_item, bin_index)
+            new_depth = depth + 1
+            new_sums = binner.sums(current_bins)
+            if search.use_lower_bound:
                 lower_bound = objective.lower_bound(new_sums, sum_of_remaining_items, are_sums_in_ascending_order=False)
                 if lower_bound >= best_objective_value:
-                    logger.debug("    Lower bound %f too large", lower_bound)
-                    times_lower_bound_activated += 1
+                    stats["times_lower_bound_activated"] += 1
+                    binner.undo(current_bins)
                     continue
-            if use_set_of_seen_states:
-                if new_sums in seen_states:
-                    logger.debug("    State %s already seen", new_sums)
-                    times_seen_state_skipped += 1
+            if seen_states is not None:
+                new_key = state_key(new_depth)
+                if new_key in seen_states:
+                    stats["times_seen_state_skipped"] += 1
+                    binner.undo(current_bins)
                     continue
-                seen_states.add(new_sums)  # should be after if use_lower_bound
+                seen_states.add(new_key)
+            stats["intermediate_partitions_checked"] += 1
 
-            new_vertex = (new_bins, depth + 1)
-            stack.append(new_vertex)
-            intermediate_partitions_checked += 1
+            # Heuristic 3: assign all remaining items, one by one, to the bin with the smallest sum.
+            num_of_pushed_items = 1
+            if search.use_heuristic_3 and objective == obj.MinimizeLargestSum and new_depth < numitems \
+                and sums_of_remaining_items[new_depth] + min(new_sums) <= max(new_sums):
+                for i in range(new_depth, numitems):
+                    binner.push_item(current_bins, sorted_items[i], int(np.argmin(binner.sums(current_bins))))
+                num_of_pushed_items += numitems - new_depth
+                new_depth = numitems
+                logger.debug("    Heuristic 3 activated")
+                stats["times_heuristic_3_activated"] += 1
 
-    logger.info("Checked %d out of %d complete partitions, and %d intermediate partitions.",
-                complete_partitions_checked, numbins ** numitems, intermediate_partitions_checked)
-    logger.info("  Heuristics: fast lower bound = %d, lower bound = %d, seen state = %d, heuristic 3 = %d.",
-                times_fast_lower_bound_activated, times_lower_bound_activated, times_seen_state_skipped,
-                times_heuristic_3_activated)
-    if (relative_value):
-        for i in range(numbins):
-            binner.remove_item_from_bin(best_bins, i, 0)
+            if new_depth == numitems:
+                stats["complete_partitions_checked"] += 1
+                new_objective_value = objective.value_to_minimize(binner.sums(current_bins))
+                if new_objective_value < best_objective_value:
+                    best_bins, best_objective_value = binner.copy_bins(current_bins), new_objective_value
+                    logger.info("  Found a better solution: %s, with value %s", best_bins, best_objective_value)
+                    yield best_bins, best_objective_value
+                    if new_objective_value <= search.global_lower_bound:
+                        logger.info("    Solution matches global lower bound - stopping")
+                        break
+                for _ in range(num_of_pushed_items):
+                    binner.undo(current_bins)
+                continue
+            frames.append((new_depth,) + child_order())
+    finally:   # also when the caller stops the iteration in the middle.
+        binner.clear_trail(current_bins)
 
-    for i in range(numbins):
-        binner.sums(best_bins)[i] = math.floor(binner.sums(best_bins)[i])
-    return best_bins
+
+#
+# Other search strategies
+#
+
+def _search_with_lds(search: _Search, first_bins: BinsArray, best_bins: BinsArray = None, best_objective_value: float = np.inf) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Limited discrepancy search: run depth-first searches with an increasing limit on the number of discrepancies,
+    where adding the next item to the j-th child (in the order of _children) counts as j discrepancies.
+    Stops after an iteration in which no vertex exceeded the limit, since that iteration searched the entire tree.
+    Yields each solution that is better than the previous ones, with its objective value.
+    """
+    binner, numitems, objective = search.binner, len(search.sorted_items), search.objective
+    stats = search.stats
+    for max_discrepancies in count():
+        # The seen states are kept per iteration, since a state skipped in one iteration may be reachable with fewer discrepancies in the next one.
+        seen_states = search.new_seen_states(search.state_key(first_bins, 0))
+        stack = [(first_bins, 0, 0)]    # (bins-array, depth, number of discrepancies)
+        stats["intermediate_partitions_checked"] += 1
+        some_vertex_exceeded_the_limit = False
+        while len(stack) > 0:
+            if time.perf_counter() > search.end_time:
+                logger.info("Time-limit of %s reached - stopping", search.time_limit)
+                return
+            current_bins, depth, discrepancies = stack.pop()
+            current_sums = tuple(binner.sums(current_bins))
+            if depth == numitems:
+                stats["complete_partitions_checked"] += 1
+                new_objective_value = objective.value_to_minimize(current_sums)
+                if new_objective_value < best_objective_value:
+                    best_bins, best_objective_value = current_bins, new_objective_value
+                    logger.info("  Found a better solution: %s, with value %s (%d discrepancies)", current_bins, best_objective_value, discrepancies)
+                    yield best_bins, best_objective_value
+                    if new_objective_value <= search.global_lower_bound:
+                        logger.info("    Solution matches global lower bound - stopping")
+                        return
+                continue
+            # One child more than allowed is created, to detect that the limit was exceeded.
+            children = _children(search, current_bins, current_sums, depth, best_objective_value, seen_states,
+                                 max_children=max_discrepancies - discrepancies + 2)
+            for child_index in reversed(range(len(children))):
+                child_discrepancies = discrepancies + child_index
+                if child_discrepancies > max_discrepancies:
+                    some_vertex_exceeded_the_limit = True
+                    continue
+                child_bins, child_depth = children[child_index]
+                stack.append((child_bins, child_depth, child_discrepancies))
+        logger.info("  Completed an iteration with at most %d discrepancies", max_discrepancies)
+        if not some_vertex_exceeded_the_limit:
+            return
+
+
+def _search_with_beam(search: _Search, first_bins: BinsArray, beam_width: int, best_bins: BinsArray = None, best_objective_value: float = np.inf) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Beam search: expand the tree level by level, keeping at each level only the beam_width vertices with the smallest objective lower bound
+    (ties are broken in favor of the vertices generated first, which are closer to the greedy choice).
+    Not complete: the optimal solution may be in a vertex that was dropped from the beam.
+    Yields each solution that is better than the previous ones, with its objective value.
+    """
+    binner, numitems, objective, sums_of_remaining_items = search.binner, len(search.sorted_items), search.objective, search.sums_of_remaining_items
+    stats = search.stats
+    seen_states = search.new_seen_states(search.state_key(first_bins, 0))
+    beam = [(first_bins, 0)]
+    stats["intermediate_partitions_checked"] += 1
+    while len(beam) > 0:
+        candidates = []   # (lower bound, index, bins-array, depth)
+        for current_bins, depth in beam:
+            if time.perf_counter() > search.end_time:
+                logger.info("Time-limit of %s reached - stopping", search.time_limit)
+                return
+            current_sums = tuple(binner.sums(current_bins))
+            if depth == numitems:
+                stats["complete_partitions_checked"] += 1
+                new_objective_value = objective.value_to_minimize(current_sums)
+                if new_objective_value < best_objective_value:
+                    best_bins, best_objective_value = current_bins, new_objective_value
+                    logger.info("  Found a better solution: %s, with value %s", current_bins, best_objective_value)
+                    yield best_bins, best_objective_value
+                    if new_objective_value <= search.global_lower_bound:
+                        logger.info("    Solution matches global lower bound - stopping")
+                        return
+                continue
+            for child_bins, child_depth in _children(search, current_bins, current_sums, depth, best_objective_value, seen_states):
+                lower_bound = objective.lower_bound(binner.sums(child_bins), sums_of_remaining_items[child_depth])
+                candidates.append((lower_bound, len(candidates), child_bins, child_depth))
+        if len(candidates) > beam_width:
+            logger.debug("    Dropping %d vertices from the beam", len(candidates) - beam_width)
+        beam = [(child_bins, child_depth) for _, _, child_bins, child_depth in heapq.nsmallest(beam_width, candidates, key=lambda candidate: candidate[0:2])]
+
+
+#
+# Compiled search
+#
+
+def _use_kernel(search: _Search, engine: str, workers: int) -> bool:
+    """
+    Decides whether the search should run in the compiled kernel. Raises an error if the kernel is required but cannot be used.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"engine should be one of {ENGINES}, but it is {engine!r}")
+    if engine == "python":
+        return False
+    values = search.sorted_values
+    applicable = type(search.binner) is BinnerKeepingSums and search.objective in KERNEL_OBJECTIVES \
+        and not search.relative_value and not search.use_symmetry_breaking and not search.vectorized and workers <= 1 and search.time_limit == np.inf \
+        and all(isinstance(value, (int, np.integer)) and value >= 0 for value in values) \
+        and sum(int(value) for value in values) < MAX_EXACT_INT64_SUM
+    if engine == "kernel":
+        if not applicable:
+            raise ValueError("The kernel engine requires a BinnerKeepingSums, non-negative integer items, one of the objectives "
+                             f"{[str(objective) for objective in KERNEL_OBJECTIVES]}, no relative values, no symmetry breaking or vectorized children, a single worker and no time limit")
+        return True
+    # "auto": do not silently drop options that the kernel does not implement (use_set_of_seen_states is None by default).
+    return applicable and kernel.NUMBA_AVAILABLE and not search.use_set_of_seen_states and not search.use_heuristic_3
+
+
+def _search_with_kernel(search: _Search, best_bins: BinsArray = None, best_objective_value: float = np.inf) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Run the DFS in the compiled kernel, and reconstruct the best partition from the assignment recorded by the kernel.
+    Yields the best solution, if it is better than the incumbent.
+    """
+    binner, numbins, sorted_items = search.binner, search.numbins, search.sorted_items
+    bound = kernel.NO_BOUND if best_objective_value == np.inf else math.ceil(best_objective_value)
+    kernel_objective_value, assignment, kernel_stats = kernel.dfs_sums(
+        np.array(search.sorted_values, dtype=np.int64), numbins, KERNEL_OBJECTIVES[search.objective],
+        math.floor(search.global_lower_bound), bound, search.use_fast_lower_bound, search.use_lower_bound)
+    stats = search.stats
+    stats["intermediate_partitions_checked"] += int(kernel_stats[0])
+    stats["complete_partitions_checked"] += int(kernel_stats[1])
+    stats["times_fast_lower_bound_activated"] += int(kernel_stats[2])
+    stats["times_lower_bound_activated"] += int(kernel_stats[3])
+    if kernel_objective_value < bound:
+        best_bins = binner.new_bins(numbins)
+        for item, bin_index in zip(sorted_items, assignment):
+            binner.add_item_to_bin(best_bins, item, int(bin_index))
+        best_objective_value = search.objective.value_to_minimize(binner.sums(best_bins))
+        logger.info("  Found a better solution: %s, with value %s", best_bins, best_objective_value)
+        yield best_bins, best_objective_value
+
+
+def _fast_lower_bound(context: obj.ObjectiveContext, current_sums: Tuple, bin_index: int, value: float, sum_of_remaining_items: float)->float:
+    """
+    A lower bound on the objective value of all partitions in which the next item (with the given value) is added to the bin with the given index.
+    It is computed before creating the new vertex, in O(numbins) time.
+    Currently implemented only for three objectives: min-max, max-min and min-dist-avg.
+
+    :param context: the constants of the input, computed by objective.prepare.
+    :param current_sums: the current bin sums, in ascending order (unless relative values are given).
+    """
+    objective, numbins = context.objective, len(current_sums)
+    if objective == obj.MinimizeLargestSum:
+        # "If an assignment to a subset creates a subset sum that equals or exceeds the largest subset sum in the best complete solution found so far, that branch is pruned from the tree."
+        return max(current_sums[bin_index] + value, current_sums[-1])
+    elif objective == obj.MaximizeSmallestSum:
+        # An adaptation of the above heuristic to maximizing the smallest sum.
+        if bin_index == 0:
+            new_smallest_sum = min(current_sums[0] + value, current_sums[1])
+        else:
+            new_smallest_sum = current_sums[0]
+        return -(new_smallest_sum + sum_of_remaining_items)
+    elif objective == obj.MinimizeDistAvg:
+        fast_lower_bound = 0
+        if context.relative_values:
+            bin_offsets, bin_shares = context.bin_offsets, context.bin_shares
+            for i in range (numbins):
+                fast_lower_bound = fast_lower_bound + max((current_sums[i]-bin_offsets[i])-bin_shares[i],0)
+        else:
+            avg = context.average
+            for i in range (numbins):
+                fast_lower_bound = fast_lower_bound + max(current_sums[i]-avg,0)
+        return fast_lower_bound
+    else:
+        return -np.inf
 
 
 if __name__ == "__main__":
@@ -303,10 +1179,11 @@ if __name__ == "__main__":
     (failures, tests) = doctest.testmod(report=True, optionflags=doctest.FAIL_FAST)
     print("{} failures, {} tests".format(failures, tests))
     if failures > 0:
-        sys.exit()
-        DEMO
-        logger.setLevel(logging.INFO)
-        logger.addHandler(logging.StreamHandler())
+        sys.exit(1)
+
+    # DEMO
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
 
     from prtpy import BinnerKeepingContents, BinnerKeepingSums
 
@@ -320,31 +1197,3 @@ if __name__ == "__main__":
     anytime(BinnerKeepingSums(), 3, random_numbers, objective=obj.MaximizeSmallestSum)
     anytime(BinnerKeepingSums(), 3, random_numbers, objective=obj.MinimizeLargestSum)
     anytime(BinnerKeepingSums(), 3, random_numbers, objective=obj.MinimizeDifference)
-
-   import pandas as pd
-
-    df = pd.read_csv('Ichud Vechaluka Rishon Letzion.csv')
-
-    numbins = 0
-    relative_values = []
-    values = []
-    for i in range(len(df.values)):
-        if (str(df.values[i][11]) != "nan"):
-            numbins = numbins + 1
-            relative_values.append(float((df.values[i][11])[:-1]) / 100)
-    new_relative_values = []
-    for i in range(len(relative_values)):
-        new_relative_values.append((relative_values[i]) / sum(relative_values))
-
-    for i in range(len(df.values)):
-        values.append(int(df.values[i][3].replace(',', '')))
-    import time
-
-    start = time.time()
-
-    from prtpy import BinnerKeepingContents, BinnerKeepingSums
-
-    printbins(anytime(BinnerKeepingContents(), numbins, values, relative_value=relative_values, objective=obj.MinimizeDistAvg))
-
-    end = time.time()
-    print(end - start);
@@ -0,0 +1,285 @@
+"""
+The drivers that run several complete-greedy searches: restarts of the DFS on a Luby schedule,
+a portfolio of randomized copies with restarts, and a parallel search of the subtrees of the DFS tree.
+They run the search of complete_greedy, which calls them from anytime_solutions.
+"""
+from typing import List, Tuple, Iterator
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import math, time, multiprocessing
+
+from prtpy import BinsArray
+from prtpy.partitioning.complete_greedy import logger, _Search, _search_with_stack, _children
+
+
+#
+# Restarts
+#
+
+def _luby(i: int) -> int:
+    """
+    Returns the i-th element (starting at 1) of the Luby sequence, which is used for scheduling restarts (Luby, Sinclair and Zuckerman, 1993).
+    >>> [_luby(i) for i in range(1, 16)]
+    [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8]
+    """
+    k = i.bit_length()
+    if i == (1 << k) - 1:
+        return 1 << (k - 1)
+    return _luby(i - (1 << (k - 1)) + 1)
+
+
+def _randomized_order(search: _Search, children: List[Tuple[BinsArray, int]], rng: np.random.Generator) -> List[Tuple[BinsArray, int]]:
+    """
+    Returns the given children sorted by ascending lower bound, where children with equal lower bounds are ordered at random.
+    """
+    binner, objective, sums_of_remaining_items = search.binner, search.objective, search.sums_of_remaining_items
+    lower_bounds = [objective.lower_bound(binner.sums(child_bins), sums_of_remaining_items[child_depth]) for child_bins, child_depth in children]
+    tie_breakers = rng.random(len(children))
+    order = sorted(range(len(children)), key=lambda i: (lower_bounds[i], tie_breakers[i]))
+    return [children[i] for i in order]
+
+
+def _search_with_restarts(search: _Search, first_bins: BinsArray, restarts: int, restart_unit: int, rng: np.random.Generator,
+        randomize_first_run: bool = False, best_bins: BinsArray = None, best_objective_value: float = np.inf,
+        shared_bound: "_SharedBound" = None,
+) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Run the DFS several times: each run except the last is stopped after expanding restart_unit * luby(i) vertices,
+    and every run except the first (unless randomize_first_run) orders children with equal lower bounds at random.
+    The incumbent is kept across runs, and so is the set of seen states, except the states that were not fully searched when the run was stopped:
+    the vertices on the current path and their children that were not searched yet.
+    Yields each solution that is better than the previous ones, with its objective value.
+    """
+    binner, numitems, objective = search.binner, len(search.sorted_items), search.objective
+    stats = search.stats
+    seen_states = search.new_seen_states(search.state_key(first_bins, 0))
+    for run in range(restarts + 1):
+        max_expanded_vertices = restart_unit * _luby(run + 1) if run < restarts else np.inf
+        randomize = run > 0 or randomize_first_run
+        # Each frame is a pair (key of a vertex on the current path, the children of that vertex that were not searched yet).
+        # The first frame represents the parent of the root.
+        frames = [(None, [(first_bins, 0)])]
+        stats["intermediate_partitions_checked"] += 1
+        num_of_expanded_vertices = 0
+        while len(frames) > 0:
+            if time.perf_counter() > search.end_time:
+                logger.info("Time-limit of %s reached - stopping", search.time_limit)
+                return
+            if shared_bound is None:
+                bound = best_objective_value
+            else:
+                bound = min(best_objective_value, shared_bound.get())
+                if bound <= search.global_lower_bound:
+                    logger.info("    The shared bound matches the global lower bound - stopping")
+                    return
+            key, unsearched_children = frames[-1]
+            if len(unsearched_children) == 0:
+                frames.pop()
+                continue
+            if num_of_expanded_vertices >= max_expanded_vertices:
+                break
+
+            current_bins, depth = unsearched_children.pop()
+            current_sums = tuple(binner.sums(current_bins))
+            if depth == numitems:
+                stats["complete_partitions_checked"] += 1
+                new_objective_value = objective.value_to_minimize(current_sums)
+                if new_objective_value < best_objective_value:
+                    best_bins, best_objective_value = current_bins, new_objective_value
+                    logger.info("  Found a better solution: %s, with value %s (run %d)", current_bins, best_objective_value, run)
+                    yield best_bins, best_objective_value
+                    if shared_bound is not None:
+                        shared_bound.offer(new_objective_value)
+                    if new_objective_value <= search.global_lower_bound:
+                        logger.info("    Solution matches global lower bound - stopping")
+                        return
+                continue
+            num_of_expanded_vertices += 1
+            children = _children(search, current_bins, current_sums, depth, bound, seen_states)
+            if randomize:
+                children = _randomized_order(search, children, rng)
+            # The children are popped from the end, so they are kept in reverse order.
+            frames.append((search.state_key(current_bins, depth), children[::-1]))
+        else:   # The run searched the entire tree.
+            return
+
+        if seen_states is not None:
+            for key, unsearched_children in frames:
+                seen_states.discard(key)
+                for child_bins, child_depth in unsearched_children:
+                    seen_states.discard(search.state_key(child_bins, child_depth))
+        stats["restarts"] += 1
+        logger.info("  Restart %d after expanding %d vertices", run + 1, num_of_expanded_vertices)
+
+
+#
+# Parallel search
+#
+
+SUBTREES_PER_WORKER = 4   # More subtrees than workers, so that a worker that finishes a small subtree can take another one.
+
+class _SharedBound:
+    """
+    The best objective value found so far by all the workers of a parallel search, kept in shared memory.
+    Reading is lock-free; updating takes a lock, so that a better value is never overwritten by a worse one.
+    """
+    def __init__(self, mp_context):
+        self.value = mp_context.RawValue("d", np.inf)
+        self.lock = mp_context.Lock()
+
+    def get(self) -> float:
+        return self.value.value
+
+    def stop(self):
+        """ Makes all workers stop, by setting a bound that prunes everything. """
+        with self.lock:
+            self.value.value = -np.inf
+
+    def offer(self, objective_value: float):
+        with self.lock:
+            if objective_value < self.value.value:
+                self.value.value = _float_not_below(objective_value)
+
+
+def _float_not_below(value: float) -> float:
+    """
+    Converts the given value to a float that is at least as large, so that pruning by the shared bound remains valid for large integers.
+    >>> _float_not_below(2**62+1) >= 2**62+1
+    True
+    """
+    if isinstance(value, (int, np.integer)):
+        value = int(value)      # compare exactly, not through float64
+    result = float(value)
+    return result if result >= value else math.nextafter(result, math.inf)
+
+
+def _split_into_subtrees(search: _Search, first_bins: BinsArray, numsubtrees: int,
+        best_bins: BinsArray = None, best_objective_value: float = np.inf,
+) -> Tuple[List[Tuple[BinsArray, int]], BinsArray, float]:
+    """
+    Expand the top levels of the DFS tree, until there are at least numsubtrees vertices in the frontier (or the tree is exhausted).
+    :param best_bins, best_objective_value: the incumbent solution, if any.
+    :return: the frontier vertices (in DFS order), and the best solution found so far with its objective value.
+    """
+    incumbent = best_bins, best_objective_value
+    numitems = len(search.sorted_items)
+    split_depth = 0
+    while True:
+        split_depth += 1
+        frontier = []
+        seen_states = search.new_seen_states(search.state_key(first_bins, 0))
+        best_bins, best_objective_value = _last_solution(_search_with_stack(search, [(first_bins, 0)], seen_states, *incumbent, split_depth=split_depth, frontier=frontier), *incumbent)
+        if len(frontier) >= numsubtrees or split_depth >= numitems or time.perf_counter() > search.end_time:
+            logger.info("Split the search tree at depth %d into %d subtrees", split_depth, len(frontier))
+            return frontier, best_bins, best_objective_value
+        search.stats.clear()
+
+
+def _last_solution(solutions: Iterator[Tuple[BinsArray, float]], best_bins: BinsArray = None, best_objective_value: float = np.inf) -> Tuple[BinsArray, float]:
+    """
+    Runs the given search to its end, and returns the last (best) solution it yielded, or the given incumbent if it yielded none.
+    """
+    for best_bins, best_objective_value in solutions:
+        pass
+    return best_bins, best_objective_value
+
+
+# These are set in each worker process by _init_worker:
+_worker_search: _Search = None
+_worker_subtrees: List[Tuple[BinsArray, int]] = None
+_worker_shared_bound: _SharedBound = None
+
+def _init_worker(search: _Search, subtrees: List[Tuple[BinsArray, int]], shared_bound: _SharedBound, deadline: float):
+    global _worker_search, _worker_subtrees, _worker_shared_bound
+    search.end_time = time.perf_counter() + (deadline - time.time())   # perf_counter is not comparable between processes.
+    _worker_search, _worker_subtrees, _worker_shared_bound = search, subtrees, shared_bound
+
+
+def _search_subtree(subtree_index: int) -> Tuple[BinsArray, float, Counter]:
+    search = _worker_search
+    search.stats = Counter()
+    bins, depth = _worker_subtrees[subtree_index]
+    seen_states = search.new_seen_states(search.state_key(bins, depth))
+    best_bins, best_objective_value = _last_solution(_search_with_stack(search, [(bins, depth)], seen_states, shared_bound=_worker_shared_bound))
+    return best_bins, best_objective_value, search.stats
+
+
+def _search_in_parallel(search: _Search, first_bins: BinsArray, workers: int,
+        best_bins: BinsArray = None, best_objective_value: float = np.inf,
+) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Split the top levels of the DFS tree into subtrees, and search them in a pool of worker processes.
+    The workers share the best objective value found so far, so that a solution found by one worker prunes the subtrees of all other workers.
+    Yields each solution that is better than the previous ones (as the workers finish their subtrees), with its objective value.
+    :param best_bins, best_objective_value: the incumbent solution, if any.
+    """
+    incumbent_objective_value = best_objective_value
+    subtrees, best_bins, best_objective_value = _split_into_subtrees(search, first_bins, workers * SUBTREES_PER_WORKER, best_bins, best_objective_value)
+    if best_objective_value < incumbent_objective_value:
+        yield best_bins, best_objective_value
+    if len(subtrees) == 0 or best_objective_value <= search.global_lower_bound:
+        return
+
+    # With "fork", the search data is inherited by the workers and need not be pickled (so the binner may use a lambda as valueof).
+    mp_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    shared_bound = _SharedBound(mp_context)
+    if best_bins is not None:
+        shared_bound.offer(best_objective_value)
+    deadline = time.time() + (search.end_time - time.perf_counter())
+    with ProcessPoolExecutor(max_workers=min(workers, len(subtrees)), mp_context=mp_context,
+            initializer=_init_worker, initargs=(search, subtrees, shared_bound, deadline)) as pool:
+        futures = [pool.submit(_search_subtree, subtree_index) for subtree_index in range(len(subtrees))]
+        try:
+            for future in as_completed(futures):
+                subtree_bins, subtree_objective_value, subtree_stats = future.result()
+                search.stats.update(subtree_stats)
+                if subtree_bins is not None and subtree_objective_value < best_objective_value:
+                    best_bins, best_objective_value = subtree_bins, subtree_objective_value
+                    yield best_bins, best_objective_value
+        finally:   # If the caller stops the iteration in the middle, make the running workers stop too.
+            shared_bound.stop()
+            for future in futures:
+                future.cancel()
+
+
+def _search_portfolio_copy(copy_index: int, seed_sequence: np.random.SeedSequence, restarts: int, restart_unit: int) -> Tuple[BinsArray, float, Counter]:
+    search = _worker_search
+    search.stats = Counter()
+    first_bins, _ = _worker_subtrees[0]
+    solutions = _search_with_restarts(search, first_bins, restarts, restart_unit, np.random.default_rng(seed_sequence),
+                                      randomize_first_run=copy_index > 0, shared_bound=_worker_shared_bound)
+    best_bins, best_objective_value = _last_solution(solutions)
+    return best_bins, best_objective_value, search.stats
+
+
+def _search_portfolio(search: _Search, first_bins: BinsArray, portfolio: int, restarts: int, restart_unit: int, seed: int = None,
+        best_bins: BinsArray = None, best_objective_value: float = np.inf,
+) -> Iterator[Tuple[BinsArray, float]]:
+    """
+    Run several copies of the search with restarts in a pool of worker processes; the first copy starts deterministically, and the others at random.
+    The copies share the best objective value found so far. When the first copy finishes, its search was complete, so the other copies are stopped.
+    Yields each solution that is better than the previous ones (as the copies finish), with its objective value.
+    :param best_bins, best_objective_value: the incumbent solution, if any.
+    """
+    mp_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    shared_bound = _SharedBound(mp_context)
+    if best_bins is not None:
+        shared_bound.offer(best_objective_value)
+    deadline = time.time() + (search.end_time - time.perf_counter())
+    seed_sequences = np.random.SeedSequence(seed).spawn(portfolio)
+    with ProcessPoolExecutor(max_workers=portfolio, mp_context=mp_context,
+            initializer=_init_worker, initargs=(search, [(first_bins, 0)], shared_bound, deadline)) as pool:
+        futures = [pool.submit(_search_portfolio_copy, copy_index, seed_sequences[copy_index], restarts, restart_unit) for copy_index in range(portfolio)]
+        try:
+            for future in as_completed(futures):
+                copy_bins, copy_objective_value, copy_stats = future.result()
+                search.stats.update(copy_stats)
+                if copy_bins is not None and copy_objective_value < best_objective_value:
+                    best_bins, best_objective_value = copy_bins, copy_objective_value
+                    yield best_bins, best_objective_value
+                shared_bound.stop()
+        finally:   # If the caller stops the iteration in the middle, make the running copies stop too.
+            shared_bound.stop()
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,188 @@
+"""
+A compiled kernel for the Complete Greedy algorithm, for the case in which only the bin sums are needed.
+
+The kernel runs the same depth-first search as complete_greedy.anytime, with Heuristic 1, the fast lower bound and the objective lower bound,
+but on int64 arrays, without the binner and without the set of seen states.
+It records the bin of each item in the best partition, so that the partition can be reconstructed by the caller.
+
+If numba is installed, the kernel is compiled with numba.njit; otherwise, it runs as plain Python (correct, but not faster).
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:   # numba is optional
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+# The objectives supported by the kernel:
+MINIMIZE_LARGEST_SUM = 0
+MAXIMIZE_SMALLEST_SUM = 1
+MINIMIZE_DIFFERENCE = 2
+
+NO_BOUND = np.iinfo(np.int64).max
+
+
+@njit(cache=True)
+def _objective_value(sums, objective_code):
+    if objective_code == MINIMIZE_LARGEST_SUM:
+        return sums.max()
+    elif objective_code == MAXIMIZE_SMALLEST_SUM:
+        return -sums.min()
+    else:
+        return sums.max() - sums.min()
+
+
+@njit(cache=True)
+def _minimize_largest_sum_lower_bound(sums, sum_of_remaining_items):
+    numbins = len(sums)
+    average_ceiling = -((-(sums.sum() + sum_of_remaining_items)) // numbins)
+    return max(sums.max(), average_ceiling)
+
+
+@njit(cache=True)
+def _maximize_smallest_sum_lower_bound(sums, sum_of_remaining_items):
+    # The same algorithm as in objectives.MaximizeSmallestSum.lower_bound, in integer arithmetic.
+    sorted_sums = np.sort(sums)
+    total = sum_of_remaining_items + sorted_sums[0]
+    for i in range(1, len(sorted_sums)):
+        if total <= i * sorted_sums[i]:
+            return -(total // i)
+        total += sorted_sums[i]
+    return -(total // len(sorted_sums))
+
+
+@njit(cache=True)
+def _lower_bound(sums, sum_of_remaining_items, objective_code):
+    if objective_code == MINIMIZE_LARGEST_SUM:
+        return _minimize_largest_sum_lower_bound(sums, sum_of_remaining_items)
+    elif objective_code == MAXIMIZE_SMALLEST_SUM:
+        return _maximize_smallest_sum_lower_bound(sums, sum_of_remaining_items)
+    else:
+        return _maximize_smallest_sum_lower_bound(sums, sum_of_remaining_items) \
+             + _minimize_largest_sum_lower_bound(sums, sum_of_remaining_items)
+
+
+@njit(cache=True)
+def _fast_lower_bound(sums, bin_index, is_smallest, value, sum_of_remaining_items, objective_code):
+    # The same bound as complete_greedy._fast_lower_bound; is_smallest is True iff bin_index is the first bin in ascending order of sum.
+    if objective_code == MINIMIZE_LARGEST_SUM:
+        return max(sums[bin_index] + value, sums.max())
+    elif objective_code == MAXIMIZE_SMALLEST_SUM:
+        sorted_sums = np.sort(sums)
+        if is_smallest:
+            new_smallest_sum = sorted_sums[0] + value
+            if len(sorted_sums) > 1:
+                new_smallest_sum = min(new_smallest_sum, sorted_sums[1])
+        else:
+            new_smallest_sum = sorted_sums[0]
+        return -(new_smallest_sum + sum_of_remaining_items)
+    else:
+        return -NO_BOUND
+
+
+@njit(cache=True)
+def _fill_children(sums, children):
+    """
+    Writes into children the indices of the bins into which the next item should be tried:
+    by ascending order of sum, skipping bins with the same sum as the previous bin (Heuristic 1).
+    Returns the number of children.
+    """
+    order = np.argsort(sums, kind="mergesort")
+    numchildren = 0
+    for position in range(len(order)):
+        if position > 0 and sums[order[position]] == sums[order[position - 1]]:
+            continue
+        children[numchildren] = order[position]
+        numchildren += 1
+    return numchildren
+
+
+@njit(cache=True)
+def dfs_sums(values, numbins, objective_code, global_lower_bound, bound, use_fast_lower_bound, use_lower_bound):
+    """
+    Run the complete-greedy DFS on the given values (int64, in descending order).
+    Only solutions whose objective value is smaller than the given bound are considered (use NO_BOUND for no bound).
+
+    Returns a tuple (best_objective_value, best_assignment, stats), where:
+    * best_assignment[i] is the bin of values[i] in the best solution, or -1 if no solution better than the bound was found;
+    * stats contains the numbers of intermediate partitions, complete partitions, fast-lower-bound prunings and lower-bound prunings.
+
+    >>> values = np.array([8, 7, 6, 5, 4], dtype=np.int64)
+    >>> best_value, best_assignment, stats = dfs_sums(values, 2, MINIMIZE_LARGEST_SUM, 15, NO_BOUND, True, True)
+    >>> int(best_value), list(best_assignment)
+    (15, [0, 0, 1, 1, 1])
+    >>> best_value, best_assignment, stats = dfs_sums(values, 2, MINIMIZE_LARGEST_SUM, 15, 15, True, True)
+    >>> list(best_assignment)
+    [-1, -1, -1, -1, -1]
+    """
+    numitems = len(values)
+    sums_of_remaining_items = np.zeros(numitems + 1, dtype=np.int64)
+    for i in range(numitems - 1, -1, -1):
+        sums_of_remaining_items[i] = sums_of_remaining_items[i + 1] + values[i]
+    sums = np.zeros(numbins, dtype=np.int64)
+    children = np.zeros((numitems + 1, numbins), dtype=np.int64)
+    numchildren = np.zeros(numitems + 1, dtype=np.int64)
+    next_child = np.zeros(numitems + 1, dtype=np.int64)
+    assignment = np.zeros(numitems, dtype=np.int64)
+    best_assignment = np.full(numitems, -1, dtype=np.int64)
+    best_objective_value = bound
+    stats = np.zeros(4, dtype=np.int64)
+    stats[0] = 1
+
+    if numitems == 0:
+        value = _objective_value(sums, objective_code)
+        if value < best_objective_value:
+            best_objective_value = value
+        return best_objective_value, best_assignment, stats
+
+    numchildren[0] = _fill_children(sums, children[0])
+    depth = 0
+    while depth >= 0:
+        if next_child[depth] == numchildren[depth]:   # all children were checked - backtrack.
+            depth -= 1
+            if depth >= 0:
+                sums[assignment[depth]] -= values[depth]
+            continue
+        position = next_child[depth]
+        next_child[depth] += 1
+        bin_index = children[depth, position]
+        value = values[depth]
+        sum_of_remaining_items = sums_of_remaining_items[depth + 1]
+
+        if use_fast_lower_bound:
+            if _fast_lower_bound(sums, bin_index, position == 0, value, sum_of_remaining_items, objective_code) >= best_objective_value:
+                stats[2] += 1
+                continue
+
+        sums[bin_index] += value
+        if use_lower_bound:
+            if _lower_bound(sums, sum_of_remaining_items, objective_code) >= best_objective_value:
+                stats[3] += 1
+                sums[bin_index] -= value
+                continue
+        stats[0] += 1
+        assignment[depth] = bin_index
+
+        if depth + 1 == numitems:
+            stats[1] += 1
+            new_objective_value = _objective_value(sums, objective_code)
+            if new_objective_value < best_objective_value:
+                best_objective_value = new_objective_value
+                best_assignment[:] = assignment
+                if new_objective_value <= global_lower_bound:
+                    break
+            sums[bin_index] -= value
+            continue
+
+        depth += 1
+        numchildren[depth] = _fill_children(sums, children[depth])
+        next_child[depth] = 0
+    return best_objective_value, best_assignment, stats
@@ -32,6 +32,29 @@ def _possible_partition_difference_lower_bound(current_heap: BinsSortedByMaxDiff
     return lower_bound
 
 
+def _extensions(current_heap: BinsSortedByMaxDiff, bins1: BinsArray, bins2: BinsArray, best_difference_so_far: float) -> List[BinsSortedByMaxDiff]:
+    """
+    Returns the heaps obtained by pushing each combination of bins1 and bins2 into a clone of current_heap,
+    sorted such that the most promising heap is the last one (it is popped first from the stack).
+
+    The combinations are generated in ascending order of their spread (the difference between the largest and smallest sum).
+    Combining a bins-array of spread s with a bins-array of spread t gives a spread of at least s-t,
+    so every partition reachable from a combination of spread s has a difference of at least s minus the spreads of all other bins-arrays in the heap.
+    Once this is not better than the best difference so far, the remaining combinations are skipped.
+    """
+    binner = current_heap.binner
+    other_spreads = sum(max(sums)-min(sums) for sums in map(binner.sums, current_heap.iterator()))
+    extensions = []
+    for new_bins in binner.all_combinations(bins1, bins2, order_by_spread=True):
+        new_sums = binner.sums(new_bins)
+        if -(max(new_sums) - min(new_sums) - other_spreads) <= best_difference_so_far:
+            break
+        tmp_heap = current_heap.clone()
+        tmp_heap.push(new_bins)
+        extensions.append(tmp_heap)
+    extensions.sort(key=lambda heap: heap.topdiff())
+    return extensions
+
 
 def optimal(binner: Binner, numbins: int, items: List[any]) -> BinsArray:
     """
@@ -62,7 +85,7 @@ def optimal(binner: Binner, numbins: int, items: List[any]) -> BinsArray:
     Partitioning items with names:
     >>> from prtpy import partition, outputtypes as out
     >>> partition(algorithm=optimal, numbins=3, items={"a":1, "b":2, "c":3, "d":3, "e":5, "f":9, "g":9})
-    [['a', 'g'], ['c', 'd', 'e'], ['b', 'f']]
+    [['a', 'f'], ['c', 'd', 'e'], ['b', 'g']]
     >>> partition(algorithm=optimal, numbins=2, items={"a":1, "b":2, "c":3, "d":3, "e":5, "f":9, "g":9}, outputtype=out.Sums)
     [16.0, 16.0]
 
@@ -111,15 +134,7 @@ def optimal(binner: Binner, numbins: int, items: List[any]) -> BinsArray:
         bins1 = current_heap.pop()
         bins2 = current_heap.pop()
 
-        tmp_stack_extension = []
-
-        # for new_bins in bins1.all_combinations(bins2):
-        for new_bins in binner.all_combinations(bins1, bins2):
-            tmp_heap = current_heap.clone()
-            tmp_heap.push(new_bins)
-            tmp_stack_extension.append(tmp_heap)
-        tmp_stack_extension.sort(key=lambda heap: heap.topdiff())
-        stack.extend(tmp_stack_extension)
+        stack.extend(_extensions(current_heap, bins1, bins2, best_difference_so_far))
 
     binner.sort_by_ascending_sum(best_partition_so_far)
     return best_partition_so_far
@@ -193,13 +208,7 @@ def generator(
         bins1 = current_heap.pop()
         bins2 = current_heap.pop()
 
-        tmp_stack_extension = []
-        for new_bins in binner.all_combinations(bins1, bins2):
-            tmp_heap = current_heap.clone()
-            tmp_heap.push(new_bins)
-            tmp_stack_extension.append(tmp_heap)
-        tmp_stack_extension.sort(key=lambda heap: heap.topdiff())
-        stack.extend(tmp_stack_extension)
+        stack.extend(_extensions(current_heap, bins1, bins2, best_difference_so_far))
 
 
 if __name__ == '__main__':
@@ -11,21 +11,57 @@ Since: 2022-02
 """
 
 from prtpy import outputtypes as out, objectives as obj
-from prtpy.binners import Binner, BinnerKeepingContents, BinnerKeepingSums, printbins
+from prtpy.binners import Binner, BinnerKeepingContents, BinnerKeepingSums, BatchBinner, printbins, MAX_EXACT_INT64_SUM
+from prtpy.partitioning.greedy import greedy
+from prtpy.partitioning.karmarkar_karp_sy import kk
+from prtpy.partitioning.multifit import multifit
 from typing import List, Any, Tuple
-from dataclasses import dataclass
-import logging, numpy as np
+import logging, math, os, shutil, tempfile, numpy as np
 
 logger = logging.getLogger(__name__)
 
+# The engines that can run the DP (see the parameter engine):
+ENGINES = ("auto", "sets", "bitset")
+
+# The objectives for which, with two bins, the best partition is the one whose smaller sum is closest to half the total:
+TWO_WAY_OBJECTIVES = (obj.MinimizeDifference, obj.MinimizeLargestSum, obj.MaximizeSmallestSum, obj.MinimizeDistAvg)
+
+MAX_BITSET_TOTAL = 2**28   # With engine="auto", the bitset engine is used only if the total value is at most this (a bitset of half the total takes 16 MB).
+
+MAX_EXACT_FLOAT_SUM = 2**53   # The lower bounds of the objectives are computed in floating point, which is exact only for integers below this.
+
+DEFAULT_CHUNK_SIZE = 2**16   # With out_of_core, the number of states that are expanded, sorted or merged at once.
+
+# Heuristics that can compute an upper bound for pruning the states (see the parameter upper_bound):
+UPPER_BOUND_HEURISTICS = {"kk": kk, "greedy": greedy, "multifit": multifit}
+
 
 def optimal(
     binner: Binner, numbins: int, items: List[Any],
     objective: obj.Objective = obj.MinimizeDifference,
+    engine: str = "auto",
     **kwargs
 ):
 
     """
+    :param engine: "sets" runs the DP on sets of states; "bitset" runs a subset-sum DP on a bitset of reachable sums (see _optimal_two_way),
+           which requires two bins, non-negative integer items, and one of the objectives in TWO_WAY_OBJECTIVES;
+           "auto" (the default) chooses "bitset" whenever it can be used and the total value is at most MAX_BITSET_TOTAL.
+    :param use_symmetry_breaking: if True, an item is not added to a bin whose sum equals the sum of another bin of the same state,
+           since this would create a state that differs only in the order of the bins.
+           The states of each layer are sets, so the permutations of equal-valued items are already merged into a single state;
+           symmetry breaking avoids generating the states that differ only by permutations of equal bins, which are frequent when many items are equal.
+    :param upper_bound: the objective value of a known partition, or the name of a heuristic that computes one: "kk", "greedy" or "multifit".
+           After each item, the states whose objective.lower_bound (given the sum of the remaining items) is larger than the upper bound are pruned,
+           since they cannot lead to a partition better than the known one. The pruning is used only when all values are integers and their total is below MAX_EXACT_FLOAT_SUM.
+           With MinimizeLargestSum, dominated states are pruned too (see _undominated_states). The numbers of pruned states are logged.
+    :param backpointers_dir: (only when the partition is needed) a directory in which the backpointers of each layer are kept as np.memmap files,
+           instead of in memory (see _optimal_partition).
+    :param out_of_core: a directory in which the layers of states are kept as np.memmap files, instead of in memory (see _next_layer_out_of_core).
+           The states are processed in chunks of chunk_size states, so the memory is bounded by the chunk size rather than by the number of states.
+           Requires sums that fit in int64 or float; not used by the bitset engine.
+    :param chunk_size: the number of states in each chunk, with out_of_core (default DEFAULT_CHUNK_SIZE).
+
     The following examples are based on:
         Walter (2013), 'Comparing the minimum completion times of two longest-first scheduling-heuristics'.
 
@@ -40,9 +76,9 @@ def optimal(
     Bin #1: [46, 13], sum=59.0
     Bin #2: [27, 26, 10], sum=63.0
     >>> printbins(optimal(BinnerKeepingContents(), 3, walter_numbers, objective=obj.MinimizeLargestSum))
-    Bin #0: [46, 16], sum=62.0
-    Bin #1: [39, 13, 10], sum=62.0
-    Bin #2: [27, 26], sum=53.0
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [46, 16], sum=62.0
+    Bin #2: [39, 13, 10], sum=62.0
     >>> printbins(optimal(BinnerKeepingSums(), 3, walter_numbers, objective=obj.MaximizeSmallestSum))
     Bin #0: sum=56.0
     Bin #1: sum=56.0
@@ -51,45 +87,536 @@ def optimal(
     >>> from prtpy import partition
     >>> partition(algorithm=optimal, numbins=3, items={"a":46, "b":39, "c":27, "d":26, "e":16, "f":13, "g":10}, objective=obj.MinimizeDifference, outputtype=out.Partition)
     [['b', 'e'], ['a', 'f'], ['c', 'd', 'g']]
+
+    With two bins, the bitset engine is used:
+    >>> printbins(optimal(BinnerKeepingContents(), 2, [4,5,6,7,8], objective=obj.MinimizeLargestSum))
+    Bin #0: [4, 5, 6], sum=15.0
+    Bin #1: [7, 8], sum=15.0
+    >>> optimal(BinnerKeepingSums(), 2, [4,5,6,7,8], objective=obj.MinimizeLargestSum, engine="sets")
+    array([15., 15.])
+
+    Symmetry breaking does not change the optimal value:
+    >>> duplicate_numbers = [5,5,5,5,3,3,3,2,2]
+    >>> bins1 = optimal(BinnerKeepingContents(), 3, duplicate_numbers, objective=obj.MinimizeLargestSum, use_symmetry_breaking=True)
+    >>> bins2 = optimal(BinnerKeepingContents(), 3, duplicate_numbers, objective=obj.MinimizeLargestSum, use_symmetry_breaking=False)
+    >>> max(bins1.sums), max(bins2.sums)
+    (12.0, 12.0)
+
+    Pruning by an upper bound does not change the optimal value:
+    >>> for upper_bound in [None, "kk", "greedy", 62]:
+    ...     print(max(optimal(BinnerKeepingContents(), 3, walter_numbers, objective=obj.MinimizeLargestSum, upper_bound=upper_bound).sums),
+    ...           max(optimal(BinnerKeepingSums(), 3, walter_numbers, objective=obj.MinimizeLargestSum, upper_bound=upper_bound)))
+    62.0 62.0
+    62.0 62.0
+    62.0 62.0
+    62.0 62.0
     """
-    if isinstance(binner, BinnerKeepingSums):
-        # We need the entire partition.
-        return _optimal_partition(binner, numbins, items, objective, **kwargs)
-    else:
+    if engine not in ENGINES:
+        raise ValueError(f"engine should be one of {ENGINES}, but it is {engine!r}")
+    if engine != "sets":
+        if _can_use_bitset(binner, numbins, items, objective, max_total=np.inf if engine == "bitset" else MAX_BITSET_TOTAL):
+            return _optimal_two_way(binner, items)
+        elif engine == "bitset":
+            raise ValueError(f"The bitset engine requires 2 bins, non-negative integer items and one of the objectives {[str(o) for o in TWO_WAY_OBJECTIVES]}")
+    if type(binner) is BinnerKeepingSums:
         # We need only the sums - not the entire partition.
         return _optimal_sums(binner, numbins, items, objective, **kwargs)
+    else:
+        # We need the entire partition.
+        return _optimal_partition(binner, numbins, items, objective, **kwargs)
+
+
 
 
+def _can_use_bitset(binner: Binner, numbins: int, items: List[Any], objective: obj.Objective, max_total: float) -> bool:
+    if numbins != 2 or objective not in TWO_WAY_OBJECTIVES:
+        return False
+    values = [binner.valueof(item) for item in items]
+    return all(isinstance(value, (int, np.integer)) and value >= 0 for value in values) and sum(int(value) for value in values) <= max_total
+
+
+def _optimal_two_way(binner: Binner, items: List[Any]):
+    """
+    A DP for two bins that keeps the set of reachable subset sums as the bits of a Python integer:
+    bit s of reachable is 1 iff some subset of the items processed so far has sum s, so adding an item with value v is reachable |= reachable << v.
+    The best partition is the one in which the smaller sum is the largest reachable sum that is at most half the total.
+
+    To reconstruct the partition, the items are scanned backwards: an item is put in the smaller bin only if the remaining target sum
+    is not reachable without it. This requires the bitset before each item; only every checkpoint_interval-th bitset is kept,
+    and the bitsets in between are recomputed from the nearest checkpoint, so the memory is O(sqrt(n)) bitsets instead of n.
+
+    >>> printbins(_optimal_two_way(BinnerKeepingContents(), [1,1,1,1,2]))
+    Bin #0: [1, 1, 1], sum=3.0
+    Bin #1: [1, 2], sum=3.0
+    >>> printbins(_optimal_two_way(BinnerKeepingContents(), [10, 7, 3, 9]))
+    Bin #0: [10, 3], sum=13.0
+    Bin #1: [7, 9], sum=16.0
+    >>> printbins(_optimal_two_way(BinnerKeepingSums(), []))
+    Bin #0: sum=0.0
+    Bin #1: sum=0.0
+    """
+    items = list(items)
+    values = [int(binner.valueof(item)) for item in items]
+    numitems = len(items)
+    checkpoint_interval = max(1, math.isqrt(numitems))
+
+    # Sums above half the total cannot be a part of the smaller bin (the values are non-negative), so they are masked out.
+    total = sum(values)
+    half_mask = (1 << (total // 2 + 1)) - 1
+
+    # checkpoints[j] is the bitset of the sums reachable by items[:j*checkpoint_interval].
+    checkpoints = []
+    reachable = 1
+    for item_index, value in enumerate(values):
+        if item_index % checkpoint_interval == 0:
+            checkpoints.append(reachable)
+        reachable = (reachable | (reachable << value)) & half_mask
+    smaller_sum = reachable.bit_length() - 1
+    logger.info("Bitset DP of %d items: total %d, best smaller sum %d", numitems, total, smaller_sum)
+
+    in_smaller_bin = [False] * numitems
+    target = smaller_sum
+    for block_start in reversed(range(0, numitems, checkpoint_interval)):
+        # Recompute the bitsets before each item of the block, from the checkpoint at its start.
+        block_end = min(block_start + checkpoint_interval, numitems)
+        reachable_before = [checkpoints[block_start // checkpoint_interval]]
+        for item_index in range(block_start, block_end - 1):
+            reachable_before.append((reachable_before[-1] | (reachable_before[-1] << values[item_index])) & half_mask)
+        for item_index in reversed(range(block_start, block_end)):
+            if not (reachable_before[item_index - block_start] >> target) & 1:
+                in_smaller_bin[item_index] = True
+                target -= values[item_index]
+    assert target == 0, f"target={target}"
+
+    bins = binner.new_bins(2)
+    for item, is_in_smaller_bin in zip(items, in_smaller_bin):
+        binner.add_item_to_bin(bins, item, 0 if is_in_smaller_bin else 1)
+    return bins
 
 
 def _optimal_sums(
     binner: Binner, numbins: int, items: List[any],
     objective: obj.Objective = obj.MinimizeDifference,
+    use_symmetry_breaking: bool = False,
+    upper_bound: Any = None,
+    out_of_core: str = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
 ):
     """
     A DP that computes only the optimal sums in the bins (not the optimal partition itself).
 
     The states are of the form  (v1, v2, ..., vn) where n is the number of bins.
     The "vi" is the current sum in bin i.
+    Each layer of states is kept as a frontier of a BatchBinner: an (nstates, numbins) array of sorted sums without duplicate rows,
+    so that each item is processed by a few numpy calls. With big integers (dtype object), the layers are sets of state keys.
+
+    >>> _optimal_sums(BinnerKeepingSums(), 3, [46, 39, 27, 26, 16, 13, 10], objective=obj.MinimizeLargestSum)
+    array([53., 62., 62.])
+    >>> binner = BinnerKeepingSums()
+    >>> binner.use_exact_sums([2**61, 2**61, 2**61, 1])
+    'bigint'
+    >>> _optimal_sums(binner, 2, [2**61, 2**61, 2**61, 1])
+    array([2305843009213693953, 4611686018427387904], dtype=object)
+    >>> _optimal_sums(BinnerKeepingSums(), 3, [46, 39, 27, 26, 16, 13, 10], objective=obj.MinimizeLargestSum, upper_bound="greedy")
+    array([53., 62., 62.])
+    >>> with tempfile.TemporaryDirectory() as out_of_core:
+    ...     _optimal_sums(BinnerKeepingSums(), 3, [46, 39, 27, 26, 16, 13, 10], objective=obj.MinimizeLargestSum, out_of_core=out_of_core, chunk_size=5)
+    array([53., 62., 62.])
     """
-
     logger.info("\nDynamic Programming %s Partitioning of %d items into %d bins.", objective, len(items), numbins)
+    upper_bound = _upper_bound(binner, numbins, items, objective, upper_bound)
+    dtype = _frontier_dtype(binner, items)
+    if dtype is object:
+        if out_of_core is not None:
+            raise ValueError("out_of_core requires sums that fit in int64 or float, but the items are big integers")
+        return _optimal_sums_with_sets(binner, numbins, items, objective, use_symmetry_breaking, upper_bound)
+
+    batch_binner = BatchBinner(binner.valueof, dtype)
+    work_dir = None if out_of_core is None else tempfile.mkdtemp(prefix="dp-", dir=out_of_core)
+    layers = _layers(batch_binner, numbins, items, objective, use_symmetry_breaking, upper_bound, work_dir, chunk_size)
+    try:
+        frontier = batch_binner.new_bins(numbins)
+        num_of_processed_states = 1
+        num_of_pruned_states = num_of_dominated_states = 0
+        for item in items:
+            # Not zip(items, layers): its reused result tuple would keep the previous layer alive while the next one is computed.
+            frontier, child_indices, num_of_pruned, num_of_dominated = next(layers)
+            num_of_pruned_states += num_of_pruned
+            num_of_dominated_states += num_of_dominated
+            states_added = batch_binner.numstates(frontier)
+            logger.info("  Processed item %s and added %d states.", item, states_added)
+            num_of_processed_states += states_added
+
+        if batch_binner.numstates(frontier) == 0:
+            raise ValueError("No final states!")
+        best_final_state = binner.new_bins(numbins)
+        best_final_state[:] = frontier[_best_state_index(frontier, objective, chunk_size)]
+    finally:
+        # The memory-mapped views (ours and those kept by the suspended generator) must be released before their files are removed.
+        frontier = child_indices = None
+        layers.close()
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+    logger.info("Processed %d states. Pruned %d states by the upper bound %s and %d dominated states.", num_of_processed_states, num_of_pruned_states, upper_bound, num_of_dominated_states)
+    logger.info("Best final state: %s, value: %s", best_final_state, objective.value_to_minimize(best_final_state))
+    return best_final_state
+
+
+def _upper_bound(binner: Binner, numbins: int, items: List[Any], objective: obj.Objective, upper_bound: Any) -> float:
+    """
+    Returns the upper bound for pruning the states: np.inf if upper_bound is None, the objective value of the partition found by
+    the heuristic if upper_bound is one of UPPER_BOUND_HEURISTICS, and upper_bound itself otherwise.
+    The heuristic runs with exact sums, so that the bound is not smaller than the value of the partition it found.
+    The lower bounds of the objectives round the average sum to an integer, so they are valid only for integer values,
+    and they are computed in floating point, so they are valid only for totals below MAX_EXACT_FLOAT_SUM;
+    for other values, the bound is np.inf (no pruning).
+
+    >>> _upper_bound(BinnerKeepingSums(), 3, [46, 39, 27, 26, 16, 13, 10], obj.MinimizeLargestSum, "greedy")
+    63
+    >>> _upper_bound(BinnerKeepingSums(), 3, [46, 39, 27, 26, 16, 13, 10], obj.MinimizeLargestSum, None)
+    inf
+    >>> _upper_bound(BinnerKeepingSums(), 3, [4.5, 3, 2], obj.MinimizeLargestSum, "greedy")
+    inf
+    """
+    if upper_bound is None or len(items) == 0:
+        return np.inf
+    values = [binner.valueof(item) for item in items]
+    if not all(isinstance(value, (int, np.integer)) for value in values) or sum(abs(int(value)) for value in values) >= MAX_EXACT_FLOAT_SUM:
+        logger.info("The values are not all small integers, so the states are not pruned by the upper bound.")
+        return np.inf
+    if isinstance(upper_bound, str):
+        if upper_bound not in UPPER_BOUND_HEURISTICS:
+            raise ValueError(f"upper_bound should be a number or one of {list(UPPER_BOUND_HEURISTICS)}, but it is {upper_bound!r}")
+        heuristic_binner = BinnerKeepingSums(binner.valueof)
+        heuristic_binner.use_exact_sums(items)
+        bins = UPPER_BOUND_HEURISTICS[upper_bound](heuristic_binner, numbins, items)
+        sums = list(heuristic_binner.sums(bins))
+        sums += [0] * (numbins - len(sums))   # multifit might return fewer bins than numbins.
+        heuristic_value = objective.value_to_minimize(sums)
+        logger.info("Upper bound from %s: %s", upper_bound, heuristic_value)
+        return heuristic_value
+    return upper_bound
+
+
+def _remaining_values(values: List[float]) -> Tuple[List[float], List[float]]:
+    """
+    Returns two lists of length len(values)+1, whose i-th elements are the sum and the minimum of values[i:].
+
+    >>> _remaining_values([3, 1, 2])
+    ([6, 3, 2, 0], [1, 1, 2, inf])
+    """
+    sums_of_remaining_items = [0] * (len(values) + 1)
+    smallest_remaining_values = [np.inf] * (len(values) + 1)
+    for i in reversed(range(len(values))):
+        sums_of_remaining_items[i] = sums_of_remaining_items[i+1] + values[i]
+        smallest_remaining_values[i] = min(smallest_remaining_values[i+1], values[i])
+    return sums_of_remaining_items, smallest_remaining_values
+
+
+def _layers(
+    batch_binner: BatchBinner, numbins: int, items: List[Any],
+    objective: obj.Objective, use_symmetry_breaking: bool, upper_bound: float,
+    work_dir: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """
+    Generates the layers of the DP, one per item, as tuples (frontier, child_indices, num_of_pruned_states, num_of_dominated_states) (see _next_layer).
+    If work_dir is given, the layers are computed by _next_layer_out_of_core, so the frontier and child_indices are read-only memory-mapped arrays
+    of files in work_dir. The consumer may still hold views of a layer until it gets the next one, and an open file cannot be deleted on all platforms,
+    so the files of each layer are deleted only when the layer after the next one is ready (the files of the last two layers are left to the caller).
+    If the objective does not support sums in ascending order, its value depends on the order of the bins, so the states are kept unsorted
+    (and use_symmetry_breaking is ignored).
+    """
+    values = [batch_binner.valueof(item) for item in items]
+    sums_of_remaining_items, smallest_remaining_values = _remaining_values(values)
+    use_dominance = objective is obj.MinimizeLargestSum and all(value >= 0 for value in values)
+    sort_states = objective.supports_ascending_order
+    use_symmetry_breaking = use_symmetry_breaking and sort_states
+    frontier = batch_binner.new_bins(numbins)
+    previous_layer_paths, layer_paths = [], []
+    for item_index, item in enumerate(items):
+        bound_args = (objective, use_symmetry_breaking, upper_bound, sums_of_remaining_items[item_index+1], smallest_remaining_values[item_index+1], use_dominance)
+        if work_dir is None:
+            layer = _next_layer(batch_binner, frontier, item, *bound_args, sort_states=sort_states)
+        else:
+            paths = [os.path.join(work_dir, f"layer{item_index}.sums"), os.path.join(work_dir, f"layer{item_index}.children")]
+            layer = _next_layer_out_of_core(batch_binner, frontier, item, *bound_args, chunk_size=chunk_size, paths=paths, sort_states=sort_states)
+            for path in previous_layer_paths:
+                os.remove(path)
+            previous_layer_paths, layer_paths = layer_paths, paths
+        frontier = layer[0]
+        yield layer
+
+
+def _next_layer_out_of_core(
+    batch_binner: BatchBinner, frontier: np.ndarray, item: Any,
+    objective: obj.Objective, use_symmetry_breaking: bool,
+    upper_bound: float, sum_of_remaining_items: float, smallest_remaining_value: float, use_dominance: bool,
+    chunk_size: int, paths: List[str], sort_states: bool = True,
+) -> Tuple[np.ndarray, np.ndarray, int, int]:
+    """
+    The same as _next_layer, where the new frontier and its child_indices are written to the two files in paths,
+    and returned as read-only memory-mapped arrays of these files.
+
+    The frontier is expanded chunk by chunk: the children of each chunk of chunk_size states are expanded, pruned and sorted by _next_layer,
+    and written to a sorted run file. Then the runs are merged by an external sort-merge (see _merge_runs), which also removes
+    the states that appear in several runs. So at most about chunk_size states (times numbins children) are in memory at once.
+    The pruning is local to each chunk, so a dominated state might be kept if the state that dominates it is in another chunk.
+
+    >>> batch_binner = BatchBinner(dtype=np.int64)
+    >>> with tempfile.TemporaryDirectory() as work_dir:
+    ...     paths = [os.path.join(work_dir, "sums"), os.path.join(work_dir, "children")]
+    ...     next_frontier, child_indices, _, _ = _next_layer_out_of_core(batch_binner, np.array([[0, 3], [1, 2]]), 2, obj.MinimizeLargestSum, False, np.inf, 0, np.inf, False, chunk_size=1, paths=paths)
+    ...     print(np.array(next_frontier).tolist(), np.array(child_indices).tolist())
+    ...     del next_frontier, child_indices
+    [[0, 5], [1, 4], [2, 3]] [1, 3, 0]
+    """
+    numbins = batch_binner.numbins(frontier)
+    num_of_pruned_states = num_of_dominated_states = 0
+    runs = []
+    run_paths = []
+    try:
+        for start in range(0, batch_binner.numstates(frontier), chunk_size):
+            chunk = np.array(frontier[start:start+chunk_size])
+            children, child_indices, num_of_pruned, num_of_dominated = _next_layer(batch_binner, chunk, item, objective, use_symmetry_breaking,
+                upper_bound, sum_of_remaining_items, smallest_remaining_value, use_dominance, sort_states)
+            num_of_pruned_states += num_of_pruned
+            num_of_dominated_states += num_of_dominated
+            order = batch_binner.distinct_indices(children)   # the children are distinct, but the dominance pruning does not keep them sorted.
+            run_paths += [f"{paths[0]}.run{len(runs)}", f"{paths[1]}.run{len(runs)}"]
+            runs.append((
+                _write_array(children[order], run_paths[-2]),
+                _write_array(child_indices[order] + start*numbins, run_paths[-1]),
+            ))
+        next_frontier, next_child_indices = _merge_runs(batch_binner, runs, numbins, chunk_size, paths)
+    finally:
+        runs.clear()
+        for path in run_paths:
+            os.remove(path)
+    return next_frontier, next_child_indices, num_of_pruned_states, num_of_dominated_states
+
+
+def _write_array(array: np.ndarray, path: str) -> np.ndarray:
+    """
+    Writes the given array to a new raw file, and returns a read-only np.memmap of it.
+    """
+    array.tofile(path)
+    return _read_array(path, array.dtype, array.shape[1:])
+
+
+def _read_array(path: str, dtype, row_shape: Tuple[int]) -> np.ndarray:
+    """
+    Returns a read-only memory-mapped array of the raw file at the given path, whose rows have the given shape (an empty array if the file is empty).
+    """
+    row_size = np.dtype(dtype).itemsize * math.prod(row_shape)
+    numrows = os.path.getsize(path) // row_size
+    if numrows == 0:
+        return np.zeros((0,) + tuple(row_shape), dtype=dtype)
+    return np.asarray(np.memmap(path, dtype=dtype, mode="r", shape=(numrows,) + tuple(row_shape)))   # a plain view, without the overhead of the np.memmap subclass.
+
+
+def _merge_runs(batch_binner: BatchBinner, runs: List[Tuple[np.ndarray, np.ndarray]], numbins: int, chunk_size: int, paths: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merges sorted runs of distinct states (each with its child indices) into a single sorted run of distinct states,
+    which is written to the two files in paths and returned as read-only memory-mapped arrays.
+
+    In each round, a block of about chunk_size/len(runs) states is considered in each run. The threshold is the smallest last state among the blocks
+    of the runs that continue beyond their block: all states up to the threshold are in the blocks, so they are merged and written,
+    and each run advances past them. The block that ends at the threshold is consumed entirely, so each round makes progress.
+    The runs often cover different ranges of states, so the number of states of each block up to the threshold is found by a binary search,
+    and only these states are read.
+    A state that appears in several runs is kept once, with the child index from one of them.
+
+    >>> batch_binner = BatchBinner(dtype=np.int64)
+    >>> runs = [(np.array([[0, 5], [2, 3]]), np.array([10, 11])), (np.array([[1, 4], [2, 3], [3, 3]]), np.array([20, 21, 22]))]
+    >>> with tempfile.TemporaryDirectory() as work_dir:
+    ...     paths = [os.path.join(work_dir, "sums"), os.path.join(work_dir, "children")]
+    ...     merged, child_indices = _merge_runs(batch_binner, runs, 2, 2, paths)
+    ...     print(np.array(merged).tolist(), np.array(child_indices).tolist())
+    ...     del merged, child_indices
+    [[0, 5], [1, 4], [2, 3], [3, 3]] [10, 20, 11, 22]
+    """
+    block_size = max(1, chunk_size // max(1, len(runs)))
+    positions = [0] * len(runs)
+    dtype = runs[0][0].dtype if runs else batch_binner.dtype
+    with open(paths[0], "wb") as sums_file, open(paths[1], "wb") as child_indices_file:
+        while True:
+            active_runs = [run_index for run_index, position in enumerate(positions) if position < len(runs[run_index][0])]
+            if len(active_runs) == 0:
+                break
+            limits = [runs[run_index][0][positions[run_index]+block_size-1].tolist() for run_index in active_runs
+                if positions[run_index] + block_size < len(runs[run_index][0])]
+            threshold = min(limits) if limits else None
+            merged_sums, merged_child_indices = [], []
+            for run_index in active_runs:
+                run_sums, run_child_indices = runs[run_index]
+                position = positions[run_index]
+                block = run_sums[position:position+block_size]
+                count = len(block) if threshold is None else _count_at_most(block, threshold)
+                merged_sums.append(block[:count])
+                merged_child_indices.append(run_child_indices[position:position+count])
+                positions[run_index] += count
+            merged_sums, merged_child_indices = np.concatenate(merged_sums), np.concatenate(merged_child_indices)
+            kept = batch_binner.distinct_indices(merged_sums)
+            merged_sums[kept].tofile(sums_file)
+            merged_child_indices[kept].tofile(child_indices_file)
+    return _read_array(paths[0], dtype, (numbins,)), _read_array(paths[1], np.int64, ())
+
+
+def _count_at_most(rows: np.ndarray, threshold: List) -> int:
+    """
+    Returns the number of rows that are lexicographically at most the threshold, given that the rows are sorted lexicographically.
+    Uses a binary search, so only a few rows of a memory-mapped block are read.
+
+    >>> _count_at_most(np.array([[1, 5], [2, 3], [2, 4], [3, 0]]), [2, 3])
+    2
+    """
+    low, high = 0, len(rows)
+    while low < high:
+        middle = (low + high) // 2
+        if rows[middle].tolist() <= threshold:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _best_state_index(frontier: np.ndarray, objective: obj.Objective, chunk_size: int) -> int:
+    """
+    Returns the index of the first state of the frontier with the smallest objective value, reading chunk_size states at a time.
+    The states of the frontier are sorted, unless the objective does not support sums in ascending order (see _layers).
+
+    >>> _best_state_index(np.array([[1, 5], [2, 4], [3, 3], [0, 6]]), obj.MinimizeLargestSum, chunk_size=2)
+    2
+    """
+    best_index, best_value = None, None
+    for start in range(0, len(frontier), chunk_size):
+        values = objective.values_to_minimize(np.asarray(frontier[start:start+chunk_size]), are_sums_in_ascending_order=objective.supports_ascending_order)
+        index = int(np.argmin(values))
+        if best_value is None or values[index] < best_value:
+            best_index, best_value = start + index, values[index]
+    return best_index
+
+
+def _next_layer(
+    batch_binner: BatchBinner, frontier: np.ndarray, item: Any,
+    objective: obj.Objective, use_symmetry_breaking: bool,
+    upper_bound: float, sum_of_remaining_items: float, smallest_remaining_value: float, use_dominance: bool,
+    sort_states: bool = True,
+) -> Tuple[np.ndarray, np.ndarray, int, int]:
+    """
+    Computes the next layer of the DP from the given frontier (whose rows are sorted and distinct).
+    If sort_states is False, the rows are not sorted, and the j-th bin below is the bin with index j.
+
+    Returns a tuple (next_frontier, child_indices, num_of_pruned_states, num_of_dominated_states), where:
+    * next_frontier contains the distinct sorted states obtained by adding the item to a bin of a state in frontier,
+      without the states pruned by the upper bound and the dominated states;
+    * child_indices[i] = p*numbins + j means that next_frontier[i] was obtained by adding the item to the j-th smallest bin of frontier[p].
+
+    >>> batch_binner = BatchBinner(dtype=np.int64)
+    >>> next_frontier, child_indices, _, _ = _next_layer(batch_binner, np.array([[0, 3], [1, 2]]), 2, obj.MinimizeLargestSum, False, np.inf, 0, np.inf, False)
+    >>> next_frontier
+    array([[0, 5],
+           [1, 4],
+           [2, 3]])
+    >>> child_indices
+    array([1, 3, 0])
+    """
+    numbins = batch_binner.numbins(frontier)
+    children = batch_binner.add_item_to_all_bins(frontier, item)
+    child_indices = np.arange(len(children))
+    if use_symmetry_breaking:
+        # The rows are sorted, so a bin with the same sum as the previous bin is adjacent to it; its children are dropped.
+        is_new_sum = np.ones(frontier.shape, dtype=bool)
+        is_new_sum[:, 1:] = frontier[:, 1:] != frontier[:, :-1]
+        child_indices = child_indices[is_new_sum.ravel()]
+        children = children[child_indices]
+    if sort_states:
+        batch_binner.sort_by_ascending_sum(children)
+    kept = batch_binner.distinct_indices(children)
+    next_frontier, child_indices = children[kept], child_indices[kept]
+
+    num_of_pruned_states = num_of_dominated_states = 0
+    if upper_bound < np.inf:
+        is_promising = objective.lower_bounds(next_frontier, sum_of_remaining_items, are_sums_in_ascending_order=sort_states) <= upper_bound
+        num_of_pruned_states = len(next_frontier) - np.count_nonzero(is_promising)
+        next_frontier, child_indices = next_frontier[is_promising], child_indices[is_promising]
+        if use_dominance:
+            undominated = _undominated_states(next_frontier, upper_bound, smallest_remaining_value)
+            num_of_dominated_states = len(next_frontier) - len(undominated)
+            next_frontier, child_indices = next_frontier[undominated], child_indices[undominated]
+    return next_frontier, child_indices, num_of_pruned_states, num_of_dominated_states
+
+
+def _undominated_states(frontier: np.ndarray, upper_bound: float, smallest_remaining_value: float) -> np.ndarray:
+    """
+    Returns the indices of the states of the frontier that are not dominated under MinimizeLargestSum,
+    given that some partition has largest sum upper_bound, and that the remaining values are non-negative.
+
+    A bin is closed if adding the smallest remaining value to it would exceed upper_bound; in a partition that is not worse than the known one,
+    a closed bin gets no more items. Two states with the same open sums can be completed in exactly the same ways,
+    so only the one whose closed sums have the smallest maximum is kept.
+    The rows of frontier are sorted, so the closed bins of each state are at the end of its row.
 
+    >>> frontier = np.array([[1, 9, 11], [1, 10, 10], [2, 9, 10], [3, 8, 10]])
+    >>> _undominated_states(frontier, upper_bound=12, smallest_remaining_value=4)
+    array([1, 2, 3])
+    """
+    closed = frontier > upper_bound - smallest_remaining_value
+    if not closed.any():
+        return np.arange(len(frontier))
+    open_sums = np.where(closed, frontier.max() + 1, frontier)   # the closed sums are replaced by a value larger than all sums.
+    order = np.lexsort((frontier[:, -1],) + tuple(open_sums.T[::-1]))   # by the open sums, then by the largest sum.
+    open_sums = open_sums[order]
+    is_first_of_group = np.ones(len(order), dtype=bool)
+    is_first_of_group[1:] = (open_sums[1:] != open_sums[:-1]).any(axis=1)
+    return order[is_first_of_group]
+
+
+def _frontier_dtype(binner: BinnerKeepingSums, items: List[Any]):
+    """
+    The dtype of the sums in the frontier: the dtype of the binner, except that integer items whose total fits in int64 are summed exactly in int64.
+    """
+    values = [binner.valueof(item) for item in items]
+    if binner.dtype is not object and all(isinstance(value, (int, np.integer)) for value in values) \
+            and sum(abs(int(value)) for value in values) < MAX_EXACT_INT64_SUM:
+        return np.int64
+    return binner.dtype
+
+
+def _optimal_sums_with_sets(
+    binner: Binner, numbins: int, items: List[any],
+    objective: obj.Objective = obj.MinimizeDifference,
+    use_symmetry_breaking: bool = False,
+    upper_bound: float = np.inf,
+):
+    """
+    The same DP as _optimal_sums, where each layer is a python set of state keys. Used for sums that are python objects (big integers).
+    Only the states whose lower bound is at most upper_bound are kept.
+    """
     first_state = binner.new_bins(numbins)
     num_of_processed_states = 1
+    num_of_pruned_states = 0
+    sums_of_remaining_items, _ = _remaining_values([binner.valueof(item) for item in items])
 
-    # Construct initial states:
-    current_states = {tuple(binner.sums(first_state))}
-    for item in items:
+    # Construct initial states. Each state is kept as a compact key of its (sorted) sums.
+    current_states = {binner.state_key(first_state)}
+    for item_index, item in enumerate(items):
         value = binner.valueof(item)
 
         # Construct next states:
         next_states = set()
-        for state in current_states:
+        for state_key in current_states:
+            state = binner.sums_from_key(state_key)
             for ibin in range(numbins):
-                next_state = binner.add_item_to_bin(binner.copy_bins(state), item, ibin)
-                binner.sort_by_ascending_sum(next_state)
-                next_states.add(tuple(binner.sums(next_state)))
+                if use_symmetry_breaking and ibin > 0 and state[ibin] == state[ibin-1]:
+                    continue   # the state sums are sorted, so bins with equal sums are adjacent.
+                next_state = binner.add_item_and_resort(binner.copy_bins(state), item, ibin)
+                next_states.add(binner.state_key(next_state))
+        if upper_bound < np.inf:
+            num_of_states = len(next_states)
+            next_states = {state_key for state_key in next_states
+                if objective.lower_bound(binner.sums_from_key(state_key), sums_of_remaining_items[item_index+1], are_sums_in_ascending_order=True) <= upper_bound}
+            num_of_pruned_states += num_of_states - len(next_states)
         states_added = len(next_states)
         logger.info("  Processed item %s and added %d states.", item, states_added)
         num_of_processed_states += states_added
@@ -97,9 +624,9 @@ def _optimal_sums(
 
     if len(current_states) == 0:
         raise ValueError("No final states!")
-    best_final_state = min(current_states, key=objective.value_to_minimize)
+    best_final_state = min(map(binner.sums_from_key, current_states), key=objective.value_to_minimize)
     best_final_state_value = objective.value_to_minimize(best_final_state)
-    logger.info("Processed %d states.", num_of_processed_states)
+    logger.info("Processed %d states. Pruned %d states by the upper bound %s.", num_of_processed_states, num_of_pruned_states, upper_bound)
     logger.info("Best final state: %s, value: %s", best_final_state, best_final_state_value)
     return best_final_state
 
@@ -107,71 +634,137 @@ def _optimal_sums(
 def _optimal_partition(
     binner: Binner, numbins: int, items: List[any],
     objective: obj.Objective = obj.MinimizeDifference,
+    use_symmetry_breaking: bool = False,
+    upper_bound: Any = None,
+    backpointers_dir: str = None,
+    out_of_core: str = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
 ):
     """
     A DP that computes both the optimal sums and the optimal partition.
 
     The states are of the form  (v1, v2, ..., vn) where n is the number of bins.
     The "vi" is the current sum in bin i.
+    The layers of states are computed as in _optimal_sums. For each state of each layer, only two numbers are kept:
+    the index of its parent state in the previous layer, and the rank (int8) of the bin, in the sorted sums of the parent, to which the item was added.
+    After the last item, the ranks are recovered by walking these arrays backwards from the best final state;
+    then each item is added to the bin that has the recorded rank in the current sorted sums.
+    The bins of the result are sorted by ascending sum, unless the value of the objective depends on their order.
+
+    :param backpointers_dir: if given, the arrays of each layer are written to np.memmap files in this directory (and deleted at the end),
+           so that only the current frontier is kept in memory. With out_of_core, the backpointers are kept in its directory by default.
+
+    >>> printbins(_optimal_partition(BinnerKeepingContents(), 3, [46, 39, 27, 26, 16, 13, 10], objective=obj.MinimizeLargestSum))
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [46, 16], sum=62.0
+    Bin #2: [39, 13, 10], sum=62.0
+    >>> with tempfile.TemporaryDirectory() as backpointers_dir:
+    ...     printbins(_optimal_partition(BinnerKeepingContents(), 3, [46, 39, 27, 26, 16, 13, 10], objective=obj.MinimizeLargestSum, backpointers_dir=backpointers_dir))
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [46, 16], sum=62.0
+    Bin #2: [39, 13, 10], sum=62.0
+    >>> with tempfile.TemporaryDirectory() as out_of_core:
+    ...     printbins(_optimal_partition(BinnerKeepingContents(), 3, [46, 39, 27, 26, 16, 13, 10], objective=obj.MinimizeLargestSum, out_of_core=out_of_core, chunk_size=5))
+    Bin #0: [27, 26], sum=53.0
+    Bin #1: [46, 16], sum=62.0
+    Bin #2: [39, 13, 10], sum=62.0
     """
     items = list(items)
     # allow to iterate twice. See https://stackoverflow.com/q/70381559/827927
-    State = Tuple[float]
-
-    @dataclass
-    class StateRecord:
-        state: State
-        prev: Any  # StateRecord
-        ibin: int  # the index of the bin to which the last item was added in order to get to this state.
-        def __hash__(self):
-            return hash(self.state)
-        def __eq__(self, other):
-            return self.state == other.state
-
-    # Construct initial states:
-    zero_values = numbins * (0,)
-    current_state_records = {StateRecord(zero_values, None, None)}
-    num_of_processed_states = len(current_state_records)
-
-    for item in items:
-        value = binner.valueof(item)
-
-        # Construct next state records:
-        next_state_records = set()
-        for record in current_state_records:
-            for ibin in range(numbins):
-                next_state = list(record.state)
-                next_state[ibin] += value
-                next_state_record = StateRecord(tuple(next_state), record, ibin)
-                next_state_records.add(next_state_record)
-        logger.info("  Processed item %s and added %d state reccords.", item, len(next_state_records))
-        num_of_processed_states += len(next_state_records)
-        current_state_records = next_state_records
-
-    logger.info("Processed %d states.", num_of_processed_states)
-    if len(current_state_records) == 0:
-        raise ValueError("No final states!")
-    best_final_record = min(
-        current_state_records, key=lambda record: objective.value_to_minimize(record.state)
-    )
-
-    # construct path to solution
-    path = []
-    record = best_final_record
-    while record.prev is not None:
-        path.insert(0, record.ibin)
-        record = record.prev
-    logger.info("Path to best solution: %s", path)
-
-    # construct solution
+    upper_bound = _upper_bound(binner, numbins, items, objective, upper_bound)
+    values = [binner.valueof(item) for item in items]
+    dtype = _frontier_dtype(binner, items)
+    if dtype is not np.int64 and all(isinstance(value, (int, np.integer)) for value in values):
+        dtype = object   # integers whose sums might overflow int64 are summed exactly, as python ints.
+    if dtype is object and out_of_core is not None:
+        raise ValueError("out_of_core requires sums that fit in int64 or float, but the items are big integers")
+    batch_binner = BatchBinner(binner.valueof, dtype)
+    rank_dtype = np.int8 if numbins <= np.iinfo(np.int8).max else np.int32
+
+    work_dir = None if out_of_core is None else tempfile.mkdtemp(prefix="dp-", dir=out_of_core)
+    if backpointers_dir is None:
+        backpointers_dir = work_dir
+    frontier = batch_binner.new_bins(numbins)
+    num_of_processed_states = 1
+    num_of_pruned_states = num_of_dominated_states = 0
+    layers = []   # layers[i] is a pair (parents, ranks) for the states after items[i].
+    backpointer_paths = []
+    frontier_layers = _layers(batch_binner, numbins, items, objective, use_symmetry_breaking, upper_bound, work_dir, chunk_size)
+    try:
+        for item_index, item in enumerate(items):
+            parent_dtype = np.int32 if batch_binner.numstates(frontier) <= np.iinfo(np.int32).max else np.int64
+            # Not zip(items, frontier_layers): its reused result tuple would keep the previous layer alive while the next one is computed.
+            frontier, child_indices, num_of_pruned, num_of_dominated = next(frontier_layers)
+            layers.append(_store_backpointers(child_indices, numbins, parent_dtype, rank_dtype, backpointers_dir, item_index, backpointer_paths, chunk_size))
+            child_indices = None
+            num_of_pruned_states += num_of_pruned
+            num_of_dominated_states += num_of_dominated
+            states_added = batch_binner.numstates(frontier)
+            logger.info("  Processed item %s and added %d states.", item, states_added)
+            num_of_processed_states += states_added
+
+        logger.info("Processed %d states. Pruned %d states by the upper bound %s and %d dominated states.", num_of_processed_states, num_of_pruned_states, upper_bound, num_of_dominated_states)
+        if batch_binner.numstates(frontier) == 0:
+            raise ValueError("No final states!")
+
+        # construct path to solution, by walking the backpointers from the best final state.
+        state_index = _best_state_index(frontier, objective, chunk_size)
+        path = [0] * len(items)
+        for item_index in reversed(range(len(items))):
+            path[item_index] = int(layers[item_index][1][state_index])
+            state_index = layers[item_index][0][state_index]
+        logger.info("Path to best solution (ranks of bins): %s", path)
+    finally:
+        # The memory-mapped views (ours and those kept by the suspended generator) must be released before their files are removed.
+        frontier = child_indices = None
+        frontier_layers.close()
+        layers.clear()
+        for backpointer_path in backpointer_paths:
+            os.remove(backpointer_path)
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+
+    # construct solution: the sorted sums of the partial solution are the parent state, so the rank determines the bin.
+    # The sums are tracked in the dtype of the frontier, since the sums of the binner might be rounded.
+    # If the states are unsorted (see _layers), the rank is the bin itself, and the order of the bins is kept in the result.
     result_bins = binner.new_bins(numbins)
+    sums = batch_binner.new_bins(numbins)[0]
     for item_index, item in enumerate(items):
-        ibin = path[item_index]
+        ibin = int(np.argsort(sums, kind="stable")[path[item_index]]) if objective.supports_ascending_order else path[item_index]
         logger.info("  Item %d (%s): bin %d", item_index, item, ibin,)
         binner.add_item_to_bin(result_bins, item, ibin)
+        sums[ibin] += values[item_index]
+    if objective.supports_ascending_order:
+        binner.sort_by_ascending_sum(result_bins)
     return result_bins
 
 
+def _store_backpointers(
+    child_indices: np.ndarray, numbins: int, parent_dtype, rank_dtype,
+    backpointers_dir: str, item_index: int, paths: List[str], chunk_size: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the pair (parents, ranks) = divmod(child_indices, numbins), with the given dtypes (see _next_layer).
+    If backpointers_dir is given, they are written, chunk_size at a time, to new .npy files in that directory, whose paths are appended to paths,
+    and read-only memory-mapped arrays of these files are returned.
+    """
+    if backpointers_dir is None or len(child_indices) == 0:
+        parents, ranks = np.divmod(child_indices, numbins)
+        return parents.astype(parent_dtype), ranks.astype(rank_dtype)
+    parents_path = os.path.join(backpointers_dir, f"parents{item_index}.npy")
+    ranks_path = os.path.join(backpointers_dir, f"ranks{item_index}.npy")
+    parents = np.lib.format.open_memmap(parents_path, mode="w+", dtype=parent_dtype, shape=(len(child_indices),))
+    paths.append(parents_path)
+    ranks = np.lib.format.open_memmap(ranks_path, mode="w+", dtype=rank_dtype, shape=(len(child_indices),))
+    paths.append(ranks_path)
+    for start in range(0, len(child_indices), chunk_size):
+        parents[start:start+chunk_size], ranks[start:start+chunk_size] = np.divmod(np.asarray(child_indices[start:start+chunk_size]), numbins)
+    parents.flush()
+    ranks.flush()
+    del parents, ranks
+    return np.load(parents_path, mmap_mode="r"), np.load(ranks_path, mmap_mode="r")
+
+
 if __name__ == "__main__":
     # DOCTEST
     import doctest, sys
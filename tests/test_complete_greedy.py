@@ -2,9 +2,13 @@
 Tests for the CG (Complete Greedy) partitioning algorithm.
 """
 
-import unittest
+import importlib, unittest
+from unittest import mock
 
+import numpy as np
 import prtpy
+from prtpy.partitioning.complete_greedy import anytime, anytime_solutions
+from prtpy.partitioning import complete_greedy_kernel
 prt = prtpy.partitioning
 out = prtpy.outputtypes
 obj = prtpy.objectives
@@ -19,6 +23,202 @@ class TestCG(unittest.TestCase):
                 algorithm1=prt.integer_programming, kwargs1={"objective": obj.MinimizeDifference}, 
                 algorithm2=prt.complete_greedy, kwargs2={})
 
+    def test_compact_partition(self):
+        items = [46, 39, 27, 26, 16, 13, 10]
+        for numbins in [2,3,4]:
+            expected = prtpy.partition(algorithm=prt.complete_greedy, numbins=numbins, items=items, outputtype=out.Partition)
+            actual = prtpy.partition(algorithm=prt.complete_greedy, numbins=numbins, items=items, outputtype=out.CompactPartition)
+            assert actual == expected
+
+    def test_in_place(self):
+        for numbins in [2,3,4]:
+            assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                numitems=8, bitsperitem=8,
+                outputtype=out.Difference,
+                algorithm1=prt.complete_greedy, kwargs1={},
+                algorithm2=prt.complete_greedy, kwargs2={"in_place": True})
+
+    def test_reused_binner(self):
+        # The relative values are removed by item index, so the items of each bin must keep their insertion order.
+        items = [400, 500, 600, 700, 800]
+        expected = prt.complete_greedy(prtpy.BinnerKeepingContents(), 2, items, [0.3, 0.7], objective=obj.MinimizeDistAvg)
+        binner = prtpy.BinnerKeepingAssignment()
+        for _ in range(3):
+            actual = prt.complete_greedy(binner, 2, items, [0.3, 0.7], objective=obj.MinimizeDistAvg)
+            assert list(actual[0]) == list(expected[0]) and actual[1] == expected[1]
+
+    def test_zero_valued_items(self):
+        # A child that gets a zero-valued item has the same sums as its parent, so the seen states must be distinguished by depth.
+        for items in [[0], [0, 0], [1, 0], [3, 0, 0, 2, 0]]:
+            for kwargs in [{}, {"in_place": True}, {"strategy": "lds"}, {"restarts": 3, "restart_unit": 1}, {"use_symmetry_breaking": True}, {"vectorized": True}]:
+                bins = prt.complete_greedy(prtpy.BinnerKeepingContents(), 2, items, **kwargs)
+                assert sorted(bins.lists()[0] + bins.lists()[1]) == sorted(items)
+
+    def test_bounded_seen_states(self):
+        for numbins in [2,3,4]:
+            assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                numitems=10, bitsperitem=8,
+                outputtype=out.Difference,
+                algorithm1=prt.complete_greedy, kwargs1={},
+                algorithm2=prt.complete_greedy, kwargs2={"max_seen_states": 20})
+
+    def test_warm_start(self):
+        for numbins in [2,3,4]:
+            for warm_start in ["kk", "greedy", "multifit"]:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=10, bitsperitem=8,
+                    outputtype=out.Difference,
+                    algorithm1=prt.complete_greedy, kwargs1={},
+                    algorithm2=prt.complete_greedy, kwargs2={"warm_start": warm_start, "workers": 2 if numbins==4 else 1})
+        # multifit might return fewer bins than numbins; the heuristics do not support empty inputs.
+        for objective, outputtype in [(obj.MinimizeDifference, out.Difference), (obj.MinimizeLargestSum, out.LargestSum), (obj.MaximizeSmallestSum, out.SmallestSum)]:
+            for warm_start in ["kk", "greedy", "multifit"]:
+                for items in [[10, 10, 1], []]:
+                    expected = prtpy.partition(algorithm=prt.complete_greedy, numbins=4, items=items, outputtype=outputtype, objective=objective)
+                    actual = prtpy.partition(algorithm=prt.complete_greedy, numbins=4, items=items, outputtype=outputtype, objective=objective, warm_start=warm_start)
+                    assert actual == expected
+
+    def test_kernel(self):
+        for numbins in [2,3,4]:
+            for objective, outputtype in [(obj.MinimizeDifference, out.Difference), (obj.MinimizeLargestSum, out.LargestSum), (obj.MaximizeSmallestSum, out.SmallestSum)]:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=10, bitsperitem=8,
+                    outputtype=outputtype,
+                    algorithm1=prt.complete_greedy, kwargs1={"objective": objective, "engine": "python"},
+                    algorithm2=prt.complete_greedy, kwargs2={"objective": objective, "engine": "kernel"})
+        with self.assertRaises(ValueError):
+            prtpy.partition(algorithm=prt.complete_greedy, numbins=2, items=[1.5, 2, 3], outputtype=out.Sums, engine="kernel")
+
+    def test_kernel_engine_selection(self):
+        # By default, and with options that the kernel does not implement, anytime_solutions runs the Python search, and it yields the intermediate solutions.
+        items = [4, 5, 6, 7, 8]
+        for kwargs in [{}, {"engine": "auto", "use_set_of_seen_states": True}, {"engine": "auto", "use_heuristic_3": True}]:
+            solutions = list(anytime_solutions(prtpy.BinnerKeepingSums(), 2, items, objective=obj.MinimizeLargestSum, **kwargs))
+            assert len(solutions) > 1
+        kernel_solutions = list(anytime_solutions(prtpy.BinnerKeepingSums(), 2, items, objective=obj.MinimizeLargestSum, engine="kernel"))
+        assert len(kernel_solutions) == 1
+        assert kernel_solutions[-1][1]["objective_value"] == solutions[-1][1]["objective_value"]
+        # anytime returns only the best solution, so by default it runs in the kernel whenever numba is available,
+        # unless an option that only the Python search implements is requested.
+        complete_greedy = importlib.import_module("prtpy.partitioning.complete_greedy")
+        for kwargs, expected in [({}, complete_greedy_kernel.NUMBA_AVAILABLE), ({"use_set_of_seen_states": True}, False), ({"use_heuristic_3": True}, False)]:
+            with mock.patch.object(complete_greedy, "_search_with_kernel", wraps=complete_greedy._search_with_kernel) as search_with_kernel:
+                bins = anytime(prtpy.BinnerKeepingSums(), 2, items, objective=obj.MinimizeLargestSum, **kwargs)
+            assert search_with_kernel.called == expected
+            assert max(bins) == kernel_solutions[-1][1]["objective_value"]
+
+    @unittest.skipUnless(complete_greedy_kernel.NUMBA_AVAILABLE, "numba is not installed")
+    def test_compiled_kernel(self):
+        for numbins in [2,3,4]:
+            for objective, outputtype in [(obj.MinimizeDifference, out.Difference), (obj.MinimizeLargestSum, out.LargestSum), (obj.MaximizeSmallestSum, out.SmallestSum)]:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=14, bitsperitem=16,
+                    outputtype=outputtype,
+                    algorithm1=prt.complete_greedy, kwargs1={"objective": objective},
+                    algorithm2=prt.complete_greedy, kwargs2={"objective": objective, "engine": "auto", "use_set_of_seen_states": False})
+
+    def test_strategies(self):
+        for numbins in [2,3,4]:
+            assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                numitems=10, bitsperitem=8,
+                outputtype=out.Difference,
+                algorithm1=prt.complete_greedy, kwargs1={},
+                algorithm2=prt.complete_greedy, kwargs2={"strategy": "lds"})
+            items = np.random.randint(1, 2**8, 10)
+            optimal = prtpy.partition(algorithm=prt.complete_greedy, numbins=numbins, items=items, outputtype=out.Difference)
+            beam = prtpy.partition(algorithm=prt.complete_greedy, numbins=numbins, items=items, outputtype=out.Difference, strategy="beam", beam_width=5)
+            assert beam >= optimal
+        with self.assertRaises(ValueError):
+            prtpy.partition(algorithm=prt.complete_greedy, numbins=2, items=[1,2,3], strategy="bfs")
+
+    def test_symmetry_breaking(self):
+        for numbins in [2,3,4]:
+            for kwargs in [{}, {"use_set_of_seen_states": False}, {"strategy": "lds"}, {"workers": 2}]:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=12, bitsperitem=3,
+                    outputtype=out.Difference,
+                    algorithm1=prt.complete_greedy, kwargs1={},
+                    algorithm2=prt.complete_greedy, kwargs2={"use_symmetry_breaking": True, **kwargs})
+        items = [5,5,5,5,3,3,3,2]
+        partition = prtpy.partition(algorithm=prt.complete_greedy, numbins=3, items=items, outputtype=out.Partition, use_symmetry_breaking=True)
+        assert sorted(sum(partition, [])) == sorted(items)
+        with self.assertRaises(ValueError):
+            prtpy.partition(algorithm=prt.complete_greedy, numbins=2, items=items, use_symmetry_breaking=True, in_place=True)
+
+    def test_vectorized(self):
+        for numbins in [2,3,4,8]:
+            for outputtype in [out.Difference, out.LargestSum, out.SmallestSum]:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=10, bitsperitem=8,
+                    outputtype=outputtype,
+                    algorithm1=prt.complete_greedy, kwargs1={},
+                    algorithm2=prt.complete_greedy, kwargs2={"vectorized": True})
+        items = [2**61, 2**61, 2**61, 5, 3]
+        expected = prtpy.partition(algorithm=prt.complete_greedy, numbins=2, items=items, outputtype=out.Sums)
+        actual = prtpy.partition(algorithm=prt.complete_greedy, numbins=2, items=items, outputtype=out.Sums, vectorized=True)
+        assert actual == expected
+
+    def test_restarts(self):
+        for numbins in [2,3,4]:
+            for kwargs in [{"restarts": 10, "restart_unit": 5}, {"restarts": 10, "restart_unit": 5, "max_seen_states": 20}, {"portfolio": 2, "restarts": 3, "restart_unit": 5}]:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=10, bitsperitem=8,
+                    outputtype=out.Difference,
+                    algorithm1=prt.complete_greedy, kwargs1={},
+                    algorithm2=prt.complete_greedy, kwargs2=kwargs)
+        items = np.random.randint(1, 2**16, 12)
+        for kwargs in [{"restarts": 5, "restart_unit": 10, "seed": 3}, {"portfolio": 3, "seed": 3}]:
+            solutions = list(anytime_solutions(prtpy.BinnerKeepingSums(), 3, items, objective=obj.MinimizeLargestSum, **kwargs))
+            values = [stats["objective_value"] for _, stats in solutions]
+            assert values == sorted(values, reverse=True)
+        with self.assertRaises(ValueError):
+            prtpy.partition(algorithm=prt.complete_greedy, numbins=2, items=[1,2,3], restarts=2, in_place=True)
+
+    def test_parallel(self):
+        for numbins in [2,3,4]:
+            assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                numitems=10, bitsperitem=8,
+                outputtype=out.Difference,
+                algorithm1=prt.complete_greedy, kwargs1={},
+                algorithm2=prt.complete_greedy, kwargs2={"workers": 3})
+
+    def test_anytime_solutions(self):
+        items = np.random.randint(1, 2**16, 12)
+        for kwargs in [{}, {"in_place": True}, {"workers": 2}, {"warm_start": "kk"}]:
+            binner = prtpy.BinnerKeepingSums()
+            values = [stats["objective_value"] for bins, stats in anytime_solutions(binner, 3, items, **kwargs)]
+            assert values == sorted(values, reverse=True) and len(set(values)) == len(values)
+            assert values[-1] == obj.MinimizeDifference.value_to_minimize(prt.complete_greedy(binner, 3, items))
+
+    def test_anytime_solutions_stopped_early(self):
+        binner = prtpy.BinnerKeepingContents()
+        solutions = anytime_solutions(binner, 3, list(range(1, 30)), in_place=True)
+        next(solutions)
+        solutions.close()
+        assert binner.trails == {}
+
+    def test_anytime_forwards_options(self):
+        items = [46, 39, 27, 26, 16, 13, 10]
+        for kwargs in [{"restarts": 2, "restart_unit": 5, "seed": 1}, {"workers": 2}, {"strategy": "lds"}]:
+            bins = anytime(prtpy.BinnerKeepingSums(), 3, items, objective=obj.MinimizeLargestSum, **kwargs)
+            assert max(bins) == 62
+        with self.assertRaises(TypeError):
+            anytime(prtpy.BinnerKeepingSums(), 3, items, no_such_option=True)
+
+    def test_trails_of_discarded_bins(self):
+        for binner in [prtpy.BinnerKeepingSums(), prtpy.BinnerKeepingContents(), prtpy.BinnerKeepingAssignment()]:
+            bins = binner.push_item(binner.new_bins(2), 1, 0)
+            del bins
+            assert binner.trails == {}
+            bins = binner.new_bins(2)
+            binner.push_item(bins, 2, 1)
+            binner.undo(bins)
+            try:
+                binner.undo(bins)
+                assert False, "undo with an empty trail should fail"
+            except IndexError:
+                pass
+
 
 if __name__ == '__main__':
     unittest.main()
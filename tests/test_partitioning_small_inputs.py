@@ -4,9 +4,14 @@ Test all supported partition algorithms on small inputs of all supported types.
 Programmer: Erel Segal-Halevi
 Since: 2022
 """
-import prtpy, unittest
+import prtpy, unittest, itertools, os, shutil, tempfile
+import numpy as np
+from unittest import mock
 from utils import functions_in_class
 
+dp = prtpy.partitioning.dp
+OBJECTIVES = [(prtpy.obj.MinimizeDifference, prtpy.out.Difference), (prtpy.obj.MinimizeLargestSum, prtpy.out.LargestSum), (prtpy.obj.MaximizeSmallestSum, prtpy.out.SmallestSum)]
+
 class TestPartitionAlgorithms(unittest.TestCase):
     def test_with_list_input(self):
         items = [11,22]
@@ -40,6 +45,164 @@ class TestPartitionAlgorithms(unittest.TestCase):
             result = prtpy.partition(algorithm=algorithm, numbins=numbins, items=items, outputtype=prtpy.out.SmallestSum)
             assert (result==11)
 
+    def test_with_counted_partition(self):
+        items = [11,11,11,22]
+        numbins = 2
+        for algorithm in functions_in_class(prtpy.partitioning):
+            result = prtpy.partition(algorithm=algorithm, numbins=numbins, items=items, outputtype=prtpy.out.CountedPartition)
+            assert sorted(result[0]+result[1])==items
+
+    def test_with_copies(self):
+        items = [5]*6 + [7]*6
+        numbins = 2
+        for algorithm in functions_in_class(prtpy.partitioning):
+            for use_copies in [False, True]:
+                result = prtpy.partition(algorithm=algorithm, numbins=numbins, items=items, outputtype=prtpy.out.Partition, use_copies=use_copies)
+                assert sorted(result[0]+result[1])==items
+
+    def test_with_persistent_partition(self):
+        items = [11,22,33]
+        numbins = 2
+        for algorithm in functions_in_class(prtpy.partitioning):
+            expected = prtpy.partition(algorithm=algorithm, numbins=numbins, items=items, outputtype=prtpy.out.Partition)
+            actual = prtpy.partition(algorithm=algorithm, numbins=numbins, items=items, outputtype=prtpy.out.PersistentPartition)
+            assert sorted(map(sorted,actual))==sorted(map(sorted,expected))
+
+    def test_with_exact_sums(self):
+        items = [2**61+1, 2**61, 2**61, 2**61, 1, 1]   # the total is above 2**62, so the sums are kept as Python ints.
+        numbins = 2
+        for algorithm in functions_in_class(prtpy.partitioning):
+            if algorithm in [prtpy.partitioning.integer_programming, prtpy.partitioning.cbldm]:
+                continue   # these algorithms compute the sums in floating point.
+            result = prtpy.partition(algorithm=algorithm, numbins=numbins, items=items, outputtype=prtpy.out.Sums, exact=True)
+            assert sum(result)==sum(items)
+
+
+def dp_partition_value(numbins, items, objective, **kwargs):
+    """ Runs the DP with a binner that keeps the contents (unlike compare_algorithms, which keeps only the sums), and returns the objective value of its partition. """
+    lists = prtpy.partition(algorithm=dp, numbins=numbins, items=items, outputtype=prtpy.out.Partition, objective=objective, **kwargs)
+    assert sorted(sum(lists, [])) == sorted(items)
+    return objective.value_to_minimize(sorted(map(sum, lists)))
+
+
+class TestDynamicProgramming(unittest.TestCase):
+    def test_bitset_engine(self):
+        for objective, outputtype in OBJECTIVES:
+            assert prtpy.compare_algorithms_on_random_items(numbins=2,
+                numitems=10, bitsperitem=8,
+                outputtype=outputtype,
+                algorithm1=dp, kwargs1={"objective": objective, "engine": "sets"},
+                algorithm2=dp, kwargs2={"objective": objective, "engine": "bitset"})
+            items = list(np.random.randint(1, 2**8, 10))
+            assert dp_partition_value(2, items, objective, engine="sets") == dp_partition_value(2, items, objective, engine="bitset")
+
+    def test_multiway(self):
+        for numbins in [3, 4]:
+            for objective, outputtype in OBJECTIVES:
+                assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                    numitems=8, bitsperitem=8,
+                    outputtype=outputtype,
+                    algorithm1=prtpy.partitioning.complete_greedy, kwargs1={"objective": objective},
+                    algorithm2=dp, kwargs2={"objective": objective})
+                # The sums binner and the contents binner are dispatched to different DPs, which should find the same value.
+                items = list(np.random.randint(1, 2**8, 8))
+                sums = prtpy.partition(algorithm=dp, numbins=numbins, items=items, outputtype=prtpy.out.SortedSums, objective=objective)
+                assert objective.value_to_minimize(sums) == dp_partition_value(numbins, items, objective)
+
+    def test_weighted_objective(self):
+        # The value of a weighted objective depends on the order of the bins, so it is not computed from sorted sums.
+        objective = prtpy.obj.MaximizeSmallestWeightedSum([1, 2])
+        sums = prtpy.partition(algorithm=dp, numbins=2, items=[1,2,3,4,5], outputtype=prtpy.out.Sums, objective=objective)
+        assert list(sums) == [5, 10]
+        objective = prtpy.obj.MaximizeSmallestWeightedSum([1, 2, 3])
+        items = list(np.random.randint(1, 2**6, 7))
+        optimal_value = min(objective.value_to_minimize([sum(item for item, ibin in zip(items, assignment) if ibin == jbin) for jbin in range(3)])
+            for assignment in itertools.product(range(3), repeat=len(items)))
+        sums = prtpy.partition(algorithm=dp, numbins=3, items=items, outputtype=prtpy.out.Sums, objective=objective)
+        assert objective.value_to_minimize(sums) == optimal_value
+
+    def test_pruning(self):
+        # Items of 4 bits have many duplicates, for symmetry breaking.
+        for bitsperitem in [4, 8]:
+            for objective, outputtype in OBJECTIVES:
+                for upper_bound in ["kk", "greedy", "multifit"]:
+                    for use_symmetry_breaking in [False, True]:
+                        kwargs = {"objective": objective, "upper_bound": upper_bound, "use_symmetry_breaking": use_symmetry_breaking}
+                        assert prtpy.compare_algorithms_on_random_items(numbins=3,
+                            numitems=9, bitsperitem=bitsperitem,
+                            outputtype=outputtype,
+                            algorithm1=dp, kwargs1={"objective": objective},
+                            algorithm2=dp, kwargs2=kwargs)
+                        items = list(np.random.randint(1, 2**bitsperitem, 9))
+                        assert dp_partition_value(3, items, objective) == dp_partition_value(3, items, **kwargs)
+                # The tightest upper bound is the optimal value itself:
+                items = list(np.random.randint(1, 2**bitsperitem, 9))
+                optimal_value = dp_partition_value(3, items, objective)
+                assert dp_partition_value(3, items, objective, upper_bound=optimal_value) == optimal_value
+
+    def test_backpointers(self):
+        # The backpointers kept in files should reconstruct exactly the same partition as those kept in memory.
+        for numbins in [2, 3, 4]:
+            for objective, _ in OBJECTIVES:
+                items = list(np.random.randint(1, 2**8, 9))
+                expected = prtpy.partition(algorithm=dp, numbins=numbins, items=items, objective=objective, engine="sets")
+                with tempfile.TemporaryDirectory() as backpointers_dir:
+                    actual = prtpy.partition(algorithm=dp, numbins=numbins, items=items, objective=objective, engine="sets", backpointers_dir=backpointers_dir, chunk_size=5)
+                    assert os.listdir(backpointers_dir) == []
+                assert actual == expected
+                assert list(map(sum, actual)) == sorted(map(sum, actual))
+
+    def test_weighted_partition(self):
+        # With a weighted objective, the bins are not interchangeable, so the partition keeps the order of the weights.
+        objective = prtpy.obj.MaximizeSmallestWeightedSum([1, 2])
+        lists = prtpy.partition(algorithm=dp, numbins=2, items=[1,2,3,4,5], objective=objective)
+        assert list(map(sum, lists)) == [5, 10]   # e.g. [[1, 4], [2, 3, 5]]; the partition [[5], [1, 2, 3, 4]] is equally good.
+        objective = prtpy.obj.MaximizeSmallestWeightedSum([3, 1, 2])
+        items = list(np.random.randint(1, 2**6, 7))
+        sums = prtpy.partition(algorithm=dp, numbins=3, items=items, outputtype=prtpy.out.Sums, objective=objective)
+        with tempfile.TemporaryDirectory() as out_of_core:
+            for kwargs in [{}, {"out_of_core": out_of_core, "chunk_size": 4}]:
+                lists = prtpy.partition(algorithm=dp, numbins=3, items=items, objective=objective, **kwargs)
+                assert sorted(sum(lists, [])) == sorted(items)
+                assert objective.value_to_minimize(list(map(sum, lists))) == objective.value_to_minimize(sums)
+
+    def test_out_of_core(self):
+        with tempfile.TemporaryDirectory() as out_of_core:
+            for numbins in [2, 3]:
+                for objective, outputtype in OBJECTIVES:
+                    for chunk_size in [1, 7]:
+                        for extra_kwargs in [{}, {"upper_bound": "kk", "use_symmetry_breaking": True}]:
+                            kwargs = {"objective": objective, "engine": "sets", "out_of_core": out_of_core, "chunk_size": chunk_size, **extra_kwargs}
+                            assert prtpy.compare_algorithms_on_random_items(numbins=numbins,
+                                numitems=8, bitsperitem=6,
+                                outputtype=outputtype,
+                                algorithm1=dp, kwargs1={"objective": objective, "engine": "sets"},
+                                algorithm2=dp, kwargs2=kwargs)
+                            items = list(np.random.randint(1, 2**6, 8))
+                            assert dp_partition_value(numbins, items, objective, engine="sets") == dp_partition_value(numbins, items, **kwargs)
+            assert os.listdir(out_of_core) == []
+
+    @unittest.skipUnless(os.path.exists("/proc/self/maps"), "requires /proc/self/maps")
+    def test_out_of_core_files_are_unmapped_before_removal(self):
+        # On some platforms (e.g. Windows), a file cannot be removed while it is memory-mapped.
+        remove, rmtree = os.remove, shutil.rmtree
+        mapped_when_removed = []
+        def check_not_mapped(path):
+            with open("/proc/self/maps") as maps:
+                if os.path.abspath(path) in maps.read():
+                    mapped_when_removed.append(path)
+        def checked_remove(path):
+            check_not_mapped(path)
+            remove(path)
+        def checked_rmtree(path):
+            check_not_mapped(path)
+            rmtree(path)
+        items = [46, 39, 27, 26, 16, 13, 10, 8, 5]
+        with tempfile.TemporaryDirectory() as out_of_core, mock.patch("os.remove", checked_remove), mock.patch("shutil.rmtree", checked_rmtree):
+            for outputtype in [prtpy.out.Sums, prtpy.out.Partition]:
+                prtpy.partition(algorithm=prtpy.partitioning.dp, numbins=3, items=items, outputtype=outputtype, out_of_core=out_of_core, chunk_size=4)
+        assert mapped_when_removed == []
+
 
 if __name__ == "__main__":
     unittest.main()